@@ -2,6 +2,7 @@
 import sys
 import qtawesome as qta # must be imported before any other qt imports
 from custom.videographicsitem import VideoPlayer
+from custom.homography import HomographyPreview
 from PyQt5 import QtGui, QtWidgets, QtCore
 from views.safety_main import Ui_TransportationSafety
 
@@ -21,25 +22,36 @@ except:
 
 import os
 import numpy as np
-from app_config import get_default_project_dir, create_default_project_dir, get_project_path, update_config_with_sections, get_config_with_sections, get_config_path, get_identifier
+from app_config import get_default_project_dir, create_default_project_dir, get_project_path, update_config_with_sections, get_config_with_sections, get_config_path, get_identifier, config_transaction
 
 import pm
 import message_helper
 import project_selector
 from cloud_api import api
-from cloud_api import SingleAPICallbackProcess
+from cloud_api import api_executor, APIExecutor
+from cloud_api import async_api, coroutine
 from cloud_api import StatusPoller
+from custom import main_thread
 from video import save_video_frame
 from utils.path_replacer import replace_path_delimiters
 from utils.image_draw import draw_circle, draw_text
+from utils.homography_solver import projectArray, find_homography, HomographyError
+from utils.raw_image import open_image
+
+# Points with more than this many aerial image pixels of error are reported as
+# misplaced and left out of the homography, once there are enough points to tell
+HOMOGRAPHY_RANSAC_PIXELS = 10
+HOMOGRAPHY_RANSAC_MIN_POINTS = 6
+
+# Building a tile pyramid for a big image can take minutes, so it gets a worker
+# of its own instead of holding up API calls on api_executor
+tile_executor = APIExecutor(max_workers=1)
 
 
 class MainGUI(QtWidgets.QMainWindow):
     test_feature_callback_signal = QtCore.pyqtSignal()
-    get_feature_video_callback_signal = QtCore.pyqtSignal()
 
     test_object_callback_signal = QtCore.pyqtSignal()
-    get_object_video_callback_signal = QtCore.pyqtSignal()
 
     analysis_callback_signal = QtCore.pyqtSignal()
     results_callback_signal = QtCore.pyqtSignal()
@@ -71,10 +83,8 @@ class MainGUI(QtWidgets.QMainWindow):
 
         # Connect callback signals
         self.test_feature_callback_signal.connect(self.get_feature_video)
-        self.get_feature_video_callback_signal.connect(self.open_feature_video)
 
         self.test_object_callback_signal.connect(self.get_object_video)
-        self.get_object_video_callback_signal.connect(self.open_object_video)
 
         self.analysis_callback_signal.connect(self.runResults)
         self.results_callback_signal.connect(self.retrieveResults)
@@ -136,7 +146,8 @@ class MainGUI(QtWidgets.QMainWindow):
             )
 
         # runResults button
-        self.ui.runAnalysisButton.clicked.connect(self.runAnalysis)
+        # Coroutines take no arguments, so don't let clicked pass its checked flag
+        self.ui.runAnalysisButton.clicked.connect(lambda: self.runAnalysis())
 
 
 ###########################################################################################################################################
@@ -148,6 +159,9 @@ class MainGUI(QtWidgets.QMainWindow):
         self.ui.homography_hslider_zoom_computed_image.zoom_target = self.ui.homography_results
         self.ui.homography_cameraview.status_label = self.ui.homography_camera_status_label
         self.ui.homography_aerialview.status_label = self.ui.homography_aerial_status_label
+        self.ui.homography_cameraview.tile_executor = tile_executor
+        self.ui.homography_aerialview.tile_executor = tile_executor
+        self.homography_preview = HomographyPreview(self.ui.homography_cameraview, self.ui.homography_aerialview, self)
         self.ui.homography_compute_button.clicked.connect(self.homography_compute)
         self.show()
 
@@ -158,11 +172,12 @@ class MainGUI(QtWidgets.QMainWindow):
 
 ######################################################################################################
 
+    @coroutine
     def test_feature(self):
         frame_start = get_config_with_sections(get_config_path(), "config", "frame_start")
         num_frames = get_config_with_sections(get_config_path(), "config", "num_frames")
 
-        success, error_message, _ = api.testConfig(get_identifier(),\
+        success, error_message, _ = yield async_api.testConfig(get_identifier(),\
                             'feature',\
                             frame_start = frame_start,\
                             num_frames = num_frames)
@@ -184,19 +199,15 @@ class MainGUI(QtWidgets.QMainWindow):
         # We have to close the file so that the process can write to it. See #108.
         self.feature_tracking_video_player.closeFile()
 
-        SingleAPICallbackProcess(
-            target = api.getTestConfig,
-            args = (get_identifier(), 'feature', os.path.join(get_project_path(), 'feature_video')),
-            callback = self.get_feature_video_callback,
-            return_error=True,
-        ).start()
+        api_executor.submit_for_project(
+            get_identifier(),
+            api.getTestConfig,
+            get_identifier(), 'feature', os.path.join(get_project_path(), 'feature_video')
+        ).add_done_callback(self.get_feature_video_callback)
 
-    def get_feature_video_callback(self,error_message):
-        # Emitting the signal will call open_feature_video on the main thread
-        if error_message is None:
-            self.get_feature_video_callback_signal.emit()
-        else:
-            self.error_signal.emit(error_message)
+    def get_feature_video_callback(self, future):
+        # Called on the main thread once the download has finished
+        self.handle_api_result(future, self.open_feature_video)
 
     def open_feature_video(self):
         project_path = get_project_path()
@@ -205,10 +216,11 @@ class MainGUI(QtWidgets.QMainWindow):
             if os.path.exists(video_path):
                 self.feature_tracking_video_player.openFile(video_path)
 
+    @coroutine
     def test_object(self):
         frame_start = get_config_with_sections(get_config_path(), "config", "frame_start")
         num_frames = get_config_with_sections(get_config_path(), "config", "num_frames")
-        success, err, _ = api.testConfig(get_identifier(),\
+        success, err, _ = yield async_api.testConfig(get_identifier(),\
                             'object',\
                             frame_start = frame_start,\
                             num_frames = num_frames)
@@ -231,19 +243,15 @@ class MainGUI(QtWidgets.QMainWindow):
         # We have to close the file so that the process can write to it. See #108.
         self.roadusers_tracking_video_player.closeFile()
 
-        SingleAPICallbackProcess(
-            target = api.getTestConfig,
-            args = (get_identifier(), 'object', os.path.join(get_project_path(), 'object_video')),
-            callback = self.get_object_video_callback,
-            return_error=True,
-        ).start()
+        api_executor.submit_for_project(
+            get_identifier(),
+            api.getTestConfig,
+            get_identifier(), 'object', os.path.join(get_project_path(), 'object_video')
+        ).add_done_callback(self.get_object_video_callback)
 
-    def get_object_video_callback(self,error_message):
-        # Emitting the signal will call open_feature_video on the main thread
-        if error_message is None:
-            self.get_object_video_callback_signal.emit()
-        else:
-            self.error_signal.emit(error_message)
+    def get_object_video_callback(self, future):
+        # Called on the main thread once the download has finished
+        self.handle_api_result(future, self.open_object_video)
 
     def open_object_video(self):
         project_path = get_project_path()
@@ -255,12 +263,13 @@ class MainGUI(QtWidgets.QMainWindow):
 ######################################################################################################
 
     # for the runAnalysis button
+    @coroutine
     def runAnalysis(self):
         """
         Runs TrafficIntelligence trackers and support scripts.
         """
         email = get_config_with_sections(get_config_path(), 'info', 'email')
-        success, err, _ = api.analysis(get_identifier(), email=email)
+        success, err, _ = yield async_api.analysis(get_identifier(), email=email)
 
         if success:
             StatusPoller(get_identifier(), 'safety_analysis', 15, self.analysisCallback).start()
@@ -275,17 +284,19 @@ class MainGUI(QtWidgets.QMainWindow):
         else:
             self.error_signal.emit(error_message)
 
+    @coroutine
     def runResults(self):
         """Runs server methods that generate safety metric results and visualizations"""
         identifier = get_identifier()
         results_dir = os.path.join(get_project_path(), 'results')
         ttc_threshold = self.ui.timeToCollisionLineEdit.text()
-        success, err, _ = api.results(identifier, results_dir, ttc_threshold)
+        success, err, artifacts = yield async_api.results(identifier, results_dir, ttc_threshold)
 
-        if success:
+        # Artifacts that were retrieved are kept even if others failed
+        if artifacts and artifacts['highlight_video'][0]:
             StatusPoller(identifier, 'highlight_video', 15, self.resultsCallback).start()
             self.show_message('Creating a safety report now. This will take around five minutes.\n\nPlease keep the application open during this. If you close the application, your results will not be automatically downloaded')
-        else:
+        if not success:
             self.show_error(err)
 
     def resultsCallback(self, error_message):
@@ -295,9 +306,10 @@ class MainGUI(QtWidgets.QMainWindow):
         else:
             self.error_signal.emit(error_message)
 
+    @coroutine
     def retrieveResults(self):
         results_dir = os.path.join(get_project_path(), 'results')
-        success, err, _ = api.retrieveResults(get_identifier(), results_dir)
+        success, err, _ = yield async_api.retrieveResults(get_identifier(), results_dir)
 
         if not success:
             self.show_error(err)
@@ -339,6 +351,22 @@ class MainGUI(QtWidgets.QMainWindow):
     def show_error(self, error):
         self.show_message(error, error=True)
 
+    def handle_api_result(self, future, on_success):
+        """
+        Shows the error from a finished api_executor call, or calls on_success if
+        the call succeeded.
+        """
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.show_error(str(future.exception()))
+            return
+        success, err, _ = future.result()
+        if success:
+            on_success()
+        else:
+            self.show_error(err)
+
     def show_message(self, message, error=False):
         title = None
         if error:
@@ -429,28 +457,24 @@ class MainGUI(QtWidgets.QMainWindow):
             self.show_error('To compute the homography, please choose at least 4 points on each image.')
             return
 
-        update_config_with_sections(get_config_path(), "homography", "unitpixelratio", str(self.unitPixRatio))
-        homography_path = os.path.join(get_project_path(), "homography")
-
-        # Finally, upload to server
-        success, err, _ = api.configHomography(\
-            get_identifier(),\
-            self.unitPixRatio,\
-            self.ui.homography_aerialview.list_points(),\
-            self.ui.homography_cameraview.list_points())
-
-        if not success:
-            self.show_error(err)
+        # Solve locally so the results show right away; the server gets the
+        # points that were used in the background
+        ransac_threshold = None
+        if len(self.worldPts) >= HOMOGRAPHY_RANSAC_MIN_POINTS:
+            ransac_threshold = HOMOGRAPHY_RANSAC_PIXELS * self.unitPixRatio
+        try:
+            self.homography, errors, inliers = find_homography(self.videoPts, self.worldPts,\
+                                                    ransac_threshold=ransac_threshold)
+        except HomographyError as e:
+            self.show_error('Could not compute the homography: {}. Please choose different points.'.format(e))
             return
+        # Errors in aerial image pixels, like the points were chosen
+        self.homography_errors = errors / self.unitPixRatio
 
-        success, err, homography = api.getHomography(\
-            get_identifier(),\
-            homography_path)
-
-        if not success:
-            self.show_error(err)
-
-        self.homography = np.array(homography)
+        update_config_with_sections(get_config_path(), "homography", "unitpixelratio", str(self.unitPixRatio))
+        np.savetxt(os.path.join(homography_path, 'homography.txt'), self.homography)
+        # Outliers were left out here, so the server's solve must not see them either
+        self.upload_homography(self.unscaled_world_pts[inliers].tolist(), self.videoPts[inliers].tolist())
 
         corr_path = os.path.join(homography_path, "point-correspondences.txt")
         points_path = os.path.join(homography_path, "image-points.txt")
@@ -466,6 +490,24 @@ class MainGUI(QtWidgets.QMainWindow):
 
         self.homography_display_results()
 
+        print("Homography reprojection error (aerial pixels): mean {:.2f}, max {:.2f}".format(\
+            self.homography_errors.mean(), self.homography_errors.max()))
+        if not inliers.all():
+            misplaced = ', '.join(str(i + 1) for i in np.flatnonzero(~inliers))
+            self.show_message('Point(s) {} do not agree with the others and were left out of the homography. '\
+                'Please check that they are placed on the same spot in both images.'.format(misplaced))
+
+    @coroutine
+    def upload_homography(self, aerial_pts, camera_pts):
+        success, err, _ = yield async_api.configHomography(\
+            get_identifier(),\
+            self.unitPixRatio,\
+            aerial_pts,\
+            camera_pts)
+
+        if not success:
+            self.show_error(err)
+
     def homography_display_results(self):
         blue = (213,94,0)
         red = (0,114,178)
@@ -475,8 +517,9 @@ class MainGUI(QtWidgets.QMainWindow):
         thickness = 6
 
         homography_path = os.path.join(get_project_path(), "homography")
-        worldImg = Image.open(os.path.join(homography_path, "aerial.png"))
-        videoImg = Image.open(os.path.join(homography_path, "camera.png"))
+        # From the raw copies written at project creation when there are some
+        worldImg = open_image(os.path.join(homography_path, "aerial.png"))
+        videoImg = open_image(os.path.join(homography_path, "camera.png"))
 
         invHomography = np.linalg.inv(self.homography)
 
@@ -618,47 +661,50 @@ class configGui_features(configGuiWidget):
 
         self.setWindowTitle('Input config')
 
+    @coroutine
     def saveConfig_features(self):
         """
         Save configuration
         """
         config_path = get_config_path()
 
-        frame_start = str(self.input1.text())
-        if frame_start != "":
-            update_config_with_sections(config_path, "config", "frame_start", frame_start)
+        # One write for all the options
+        with config_transaction(config_path):
+            frame_start = str(self.input1.text())
+            if frame_start != "":
+                update_config_with_sections(config_path, "config", "frame_start", frame_start)
 
-        num_frames = str(self.input2.text())
-        if num_frames != "":
-            update_config_with_sections(config_path, "config", "num_frames", num_frames)
+            num_frames = str(self.input2.text())
+            if num_frames != "":
+                update_config_with_sections(config_path, "config", "num_frames", num_frames)
 
-        max_features_per_frame = str(self.input3.text())
-        if max_features_per_frame != "":
-            update_config_with_sections(config_path, "config", "max_features_per_frame", max_features_per_frame)
-        else: max_features_per_frame = None
+            max_features_per_frame = str(self.input3.text())
+            if max_features_per_frame != "":
+                update_config_with_sections(config_path, "config", "max_features_per_frame", max_features_per_frame)
+            else: max_features_per_frame = None
 
-        num_displacement_frames = str(self.input5.text())
-        if num_displacement_frames != "":
-            update_config_with_sections(config_path, "config", "num_displacement_frames", num_displacement_frames)
-        else: num_displacement_frames = None
+            num_displacement_frames = str(self.input5.text())
+            if num_displacement_frames != "":
+                update_config_with_sections(config_path, "config", "num_displacement_frames", num_displacement_frames)
+            else: num_displacement_frames = None
 
-        min_feature_displacement = str(self.input6.text())
-        if min_feature_displacement != "":
-            update_config_with_sections(config_path, "config", "min_feature_displacement", min_feature_displacement)
-        else: min_feature_displacement = None
+            min_feature_displacement = str(self.input6.text())
+            if min_feature_displacement != "":
+                update_config_with_sections(config_path, "config", "min_feature_displacement", min_feature_displacement)
+            else: min_feature_displacement = None
 
-        max_iterations_to_persist = str(self.input8.text())
-        if max_iterations_to_persist != "":
-            update_config_with_sections(config_path, "config", "max_iterations_to_persist", max_iterations_to_persist)
-        else: max_iterations_to_persist = None
+            max_iterations_to_persist = str(self.input8.text())
+            if max_iterations_to_persist != "":
+                update_config_with_sections(config_path, "config", "max_iterations_to_persist", max_iterations_to_persist)
+            else: max_iterations_to_persist = None
 
-        min_feature_frames = str(self.input10.text())
-        if min_feature_frames != "":
-            update_config_with_sections(config_path, "config", "min_feature_frames", min_feature_frames)
-        else: min_feature_frames = None
+            min_feature_frames = str(self.input10.text())
+            if min_feature_frames != "":
+                update_config_with_sections(config_path, "config", "min_feature_frames", min_feature_frames)
+            else: min_feature_frames = None
 
 
-        success, err, _ = api.configFiles(get_identifier(),\
+        success, err, _ = yield async_api.configFiles(get_identifier(),\
                      max_features_per_frame = max_features_per_frame,\
                      num_displacement_frames = num_displacement_frames,\
                      min_feature_displacement = min_feature_displacement,\
@@ -736,31 +782,34 @@ class configGui_object(configGuiWidget):
 
         self.setWindowTitle('Input config')
 
+    @coroutine
     def saveConfig_objects(self):
         """
         Save configuration
         """
         config_path = get_config_path()
 
-        frame_start = str(self.input1.text())
-        if frame_start != "":
-            update_config_with_sections(config_path, "config", "frame_start", frame_start)
+        # One write for all the options
+        with config_transaction(config_path):
+            frame_start = str(self.input1.text())
+            if frame_start != "":
+                update_config_with_sections(config_path, "config", "frame_start", frame_start)
 
-        num_frames = str(self.input2.text())
-        if num_frames != "":
-            update_config_with_sections(config_path, "config", "num_frames", num_frames)
+            num_frames = str(self.input2.text())
+            if num_frames != "":
+                update_config_with_sections(config_path, "config", "num_frames", num_frames)
 
-        max_connection_distance = str(self.input3.text())
-        if max_connection_distance != "":
-            update_config_with_sections(config_path, "config", "max_connection_distance", max_connection_distance)
-        else: max_connection_distance = None
+            max_connection_distance = str(self.input3.text())
+            if max_connection_distance != "":
+                update_config_with_sections(config_path, "config", "max_connection_distance", max_connection_distance)
+            else: max_connection_distance = None
 
-        max_segmentation_distance = str(self.input4.text())
-        if max_segmentation_distance != "":
-            update_config_with_sections(config_path, "config", "max_segmentation_distance", max_segmentation_distance)
-        else: max_segmentation_distance = None
+            max_segmentation_distance = str(self.input4.text())
+            if max_segmentation_distance != "":
+                update_config_with_sections(config_path, "config", "max_segmentation_distance", max_segmentation_distance)
+            else: max_segmentation_distance = None
 
-        success, err, _ = api.configFiles(get_identifier(),\
+        success, err, _ = yield async_api.configFiles(get_identifier(),\
                      max_connection_distance = max_connection_distance,\
                      max_segmentation_distance = max_segmentation_distance)
 
@@ -785,20 +834,6 @@ class configGui_object(configGuiWidget):
             self.input4.setText(max_segmentation_distance)
 
 ##########################################################################################################################
-def projectArray(homography, points):
-    '''Returns the coordinates of the projected points through homography
-    (format: array 2xN points)
-    '''
-    if points.shape[0] != 2:
-        raise Exception('points of dimension {0} {1}'.format(points.shape[0], points.shape[1]))
-
-    if (homography is not None) and homography.size>0:
-        augmentedPoints = np.append(points,[[1]*points.shape[1]], 0)
-        prod = np.dot(homography, augmentedPoints)
-        return prod[0:2]/prod[2]
-    else:
-        return points
-
 ##########################################################################################################################
 def main():
     app.exec_()
@@ -808,5 +843,6 @@ if __name__ == '__main__':
     multiprocess.freeze_support()
     patch_multiprocess()
     app = QtWidgets.QApplication(sys.argv)
+    main_thread.install()
     ex = MainGUI()
     sys.exit(main())
@@ -1,12 +1,21 @@
 # app_config.py
-from ConfigParser import SafeConfigParser, NoSectionError, NoOptionError
+from ConfigParser import NoSectionError
+from contextlib import contextmanager
 import os
+from utils.file_hash import hash_file
+from utils.config_store import config_store
 
 application_name = "SantosGUI"
 
 class AppConfig(object):
     DEFAULT_PROJECT_DIR = os.path.realpath(os.path.join(os.path.expanduser('~'), "Documents", application_name, "project_dir"))
     CURRENT_PROJECT_PATH = None
+    UPLOAD_INDEX_PATH = os.path.realpath(os.path.join(os.path.expanduser('~'), "Documents", application_name, "upload_index.json"))
+    ARTIFACT_CACHE_DIR = os.path.realpath(os.path.join(os.path.expanduser('~'), "Documents", application_name, "artifact_cache"))
+    # How new projects store their video, cheapest first (see utils.file_copy.store_file).
+    # 'reference' always succeeds, so 'copy' is only used once 'reference' is
+    # dropped, to always keep a file in the project directory.
+    VIDEO_STORAGE_MODES = ('reflink', 'hardlink', 'reference', 'copy')
 
 def get_default_project_dir():
     return AppConfig.DEFAULT_PROJECT_DIR
@@ -15,6 +24,15 @@ def create_default_project_dir():
     if not os.path.exists(AppConfig.DEFAULT_PROJECT_DIR):
         os.makedirs(AppConfig.DEFAULT_PROJECT_DIR)
 
+def get_upload_index_path():
+    return AppConfig.UPLOAD_INDEX_PATH
+
+def get_artifact_cache_dir():
+    return AppConfig.ARTIFACT_CACHE_DIR
+
+def get_video_storage_modes():
+    return AppConfig.VIDEO_STORAGE_MODES
+
 def get_project_path():
     return AppConfig.CURRENT_PROJECT_PATH
 
@@ -29,16 +47,47 @@ def get_identifier():
         return get_config_with_sections(config_path, "info", "identifier")
     return None
 
-def get_project_video_path():
-    config_path = get_config_path()
-    if config_path:
+def get_project_video_path(project_path=None):
+    """
+    Path of the video of the project at project_path (the current project by
+    default), or None if it is missing or changed since the project was created.
+    """
+    project_path = project_path or get_project_path()
+    if project_path:
+        config_path = os.path.join(project_path, "config.cfg")
+        if get_config_with_sections(config_path, "video", "storage") == 'reference':
+            return _referenced_video_path(config_path)
         video = get_config_with_sections(config_path, "video", "name")
         if video:
-            return os.path.join(get_project_path(), video)
+            path = os.path.join(project_path, video)
+            if os.path.exists(path):
+                return path
+            print("ERR: project_video(): Video {} is missing".format(path))
         else:
             print("ERR: project_video(): Couldn't get video")
     return None
 
+def _referenced_video_path(config_path):
+    # The project points at the original video instead of holding a copy, so
+    # make sure it is still there and still the same file
+    source = get_config_with_sections(config_path, "video", "source")
+    if not source or not os.path.exists(source):
+        print("ERR: project_video(): Video {} is missing".format(source))
+        return None
+    stat = os.stat(source)
+    size = get_config_with_sections(config_path, "video", "size")
+    mtime = get_config_with_sections(config_path, "video", "mtime")
+    if size == str(stat.st_size) and mtime == str(int(stat.st_mtime)):
+        return source
+
+    # Touched since the project was created; only the contents matter
+    sha256 = get_config_with_sections(config_path, "video", "sha256")
+    if sha256 and stat.st_size == int(size or -1) and hash_file(source) == sha256:
+        update_config_with_sections(config_path, "video", "mtime", str(int(stat.st_mtime)))
+        return source
+    print("ERR: project_video(): Video {} has changed since the project was created".format(source))
+    return None
+
 def get_font_path(font_filename):
     return os.path.join(os.path.dirname(__file__), 'datas', 'fonts', font_filename)
 
@@ -59,15 +108,37 @@ def update_config_with_sections(config_path, section, option, value):
     if not os.path.exists(config_path):
         print("ERR [update_config_with_sections()]: File {} does not exist.".format(config_path))
         return -1
-    cfp = SafeConfigParser()
-    cfp.read(config_path)
-    if section not in cfp.sections():  # If the given section does not exist,
-        cfp.add_section(section)        # then create it.
-    cfp.set(section, option, value)  # Set the option-value pair
-    with open(config_path, "wb") as cfg_file:
-        cfp.write(cfg_file)  # Write changes
+    # Creates the section if needed. The file is written shortly after, once
+    # for all the changes made until then (see utils.config_store)
+    config_store(config_path).set(section, option, value)
 
 
+def config_transaction(config_path):
+    """
+    Context manager that makes the update_config_with_sections() calls on
+    config_path inside it all or nothing: if the block raises, none of them
+    are kept, and no other thread sees them half done.
+
+    Args:
+        config_path (str): Path to the config file
+    """
+    if config_path == None:
+        return _no_transaction()
+    return config_store(config_path).transaction()
+
+@contextmanager
+def _no_transaction():
+    yield None
+
+def flush_config(config_path):
+    """Writes the pending changes to config_path now."""
+    if config_path != None:
+        config_store(config_path).flush()
+
+def write_config(config_path, parser):
+    """Replaces config_path with the contents of the SafeConfigParser parser."""
+    config_store(config_path).replace(parser)
+
 def get_config_with_sections(config_path, section, option):
     """
     Checks the configuration file for the specified option
@@ -84,16 +155,7 @@ def get_config_with_sections(config_path, section, option):
     if not os.path.exists(config_path):
         print("ERR [get_config_with_sections()]: File {} does not exist.".format(config_path))
         return None
-    cfp = SafeConfigParser()
-    cfp.read(config_path)
-    try:
-        value = cfp.get(section, option)
-    except NoSectionError:
-        return None
-    except NoOptionError:
-        return None
-    else:
-        return value
+    return config_store(config_path).get(section, option)
 
 def get_config_section(config_path, section):
     """
@@ -110,10 +172,8 @@ def get_config_section(config_path, section):
     if not os.path.exists(config_path):
         print("ERR [get_config_section()]: File {} does not exist.".format(config_path))
         return None
-    cfp = SafeConfigParser()
-    cfp.read(config_path)
     try:
-        tuples = cfp.items(section)
+        tuples = config_store(config_path).items(section)
     except NoSectionError:
         print("ERR [get_config_section()]: Section {} is not available in {}.".format(section, config_path))
         return None
@@ -138,12 +198,7 @@ def config_section_exists(config_path, section):
     if not os.path.exists(config_path):
         print("ERR [config_section_exists()]: File {} does not exist.".format(config_path))
         return None
-    cfp = SafeConfigParser()
-    cfp.read(config_path)
-    if section in cfp.sections():  # If the given section exists,
-        return True                # then return True.
-    else:                          # Otherwise,
-        return False               # then return False
+    return config_store(config_path).has_section(section)
 
 def update_config_without_sections(config_path, update_dict):
     """helper function to edit cfg files that look like tracking.cfg
@@ -1,20 +1,418 @@
 ###This will hold all api calls for TrafficCloud
 import os
+import sys
+import json
 import requests
+from requests.adapters import HTTPAdapter
 from requests_toolbelt import MultipartEncoder
 from app_config import AppConfig as ac
-from app_config import get_project_path
-from threading import Timer
+from app_config import get_project_path, get_upload_index_path, get_artifact_cache_dir
+from utils.upload_index import UploadIndex
+from utils.artifact_cache import ArtifactCache
+from utils.download_sink import DownloadSink, DOWNLOAD_BUFFER_SIZE, preallocate
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
+from threading import Lock, Thread, Condition, Event, local
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
-from multiprocess import Process, Queue
-from Queue import Empty as EmptyQueue
-import time, signal
+from multiprocess import Pool as ProcessPool
+from Queue import Queue as ThreadQueue
+from collections import deque
+import time
+import heapq
+import random
+import copy
+import types
+import inspect
+import functools
+import traceback
+
+# Default request timeouts in seconds
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+
+# Chunked upload settings
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_PARALLEL_PARTS = 4
+UPLOAD_STATE_FILE = 'upload_state.json'
+
+# Downloads are written to <file>.part and renamed when complete. Files of at
+# least DOWNLOAD_PARALLEL_THRESHOLD bytes are fetched as DOWNLOAD_PARALLEL_PARTS
+# byte ranges at once, if the server supports it.
+DOWNLOAD_PART_SUFFIX = '.part'
+DOWNLOAD_PARALLEL_THRESHOLD = 64 * 1024 * 1024
+DOWNLOAD_PARALLEL_PARTS = 4
+# Bytes written between saves of a download's progress
+DOWNLOAD_STATE_INTERVAL = 8 * 1024 * 1024
+
+# Artifacts fetched or started by CloudWizard.results, and how many at once
+RESULT_ARTIFACTS = ['road_user_counts', 'speed_distribution', 'turning_counts',\
+                    'report', 'highlight_video']
+RESULTS_WORKERS = 4
+
+# How old a cached project status may be when checking that earlier steps
+# have finished, and when the status scheduler polls
+STATUS_CACHE_TTL = 2
+STATUS_POLL_MAX_AGE = 1
+
+# Status streaming settings. The server sends a heartbeat well within the
+# read timeout, so a timeout means the connection is dead.
+STATUS_STREAM_CONNECT_TIMEOUT = 10
+STATUS_STREAM_READ_TIMEOUT = 60
+
+###############################################################################
+# Cancellable Operations
+###############################################################################
+
+class OperationCancelled(requests.exceptions.RequestException):
+    pass
+
+class DownloadError(requests.exceptions.RequestException):
+    pass
+
+# Errors that mean a request did not complete. Every API call returns these as
+# (False, message, None) rather than raising them.
+NETWORK_ERRORS = (requests.exceptions.ConnectionError,\
+                  requests.exceptions.Timeout,\
+                  OperationCancelled)
+
+_operation_local = local()
+
+def current_operation():
+    """Returns the Operation the calling thread is running under, or None."""
+    return getattr(_operation_local, 'operation', None)
+
+class Operation(object):
+    """
+    Cancellable handle for API work belonging to one project identifier.
+
+    While used as a context manager (with api.operation(identifier): ...), every
+    request made on that thread checks it before sending, and downloads check it
+    between chunks. Responses are never closed from the cancelling thread, since
+    urllib3 connections are not safe to close while another thread reads them;
+    the read timeout bounds how long a stalled download takes to notice.
+    """
+    _registry = {}          # identifier -> set of live operations
+    _registry_lock = Lock()
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+        self._cancelled = Event()
+        self._lock = Lock()
+        self._futures = []
+        self._depth = 0
+        with Operation._registry_lock:
+            Operation._registry.setdefault(identifier, set()).add(self)
+
+    @classmethod
+    def for_identifier(cls, identifier):
+        with cls._registry_lock:
+            return list(cls._registry.get(identifier, []))
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise OperationCancelled('Operation cancelled')
+
+    def cancel(self):
+        self._cancelled.set()
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self.finish()
+
+    def finish(self):
+        """Removes this operation from the registry once its work is over."""
+        with Operation._registry_lock:
+            live = Operation._registry.get(self.identifier)
+            if live is not None:
+                live.discard(self)
+                if not live:
+                    del Operation._registry[self.identifier]
+
+    def add_future(self, future):
+        with self._lock:
+            self._futures.append(future)
+        if self.cancelled:
+            future.cancel()
+
+    def __enter__(self):
+        # The same operation may be entered from several threads at once,
+        # e.g. by the workers of a parallel upload.
+        if not hasattr(_operation_local, 'previous'):
+            _operation_local.previous = []
+        _operation_local.previous.append(current_operation())
+        _operation_local.operation = self
+        with self._lock:
+            self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _operation_local.operation = _operation_local.previous.pop()
+        with self._lock:
+            self._depth -= 1
+            done = self._depth == 0
+        if done:
+            self.finish()
+        return False
+
+    def run(self, function, *args, **kwargs):
+        """Calls function under this operation, e.g. from a worker thread."""
+        with self:
+            return function(*args, **kwargs)
+
+###############################################################################
+# Retries and Metrics
+###############################################################################
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter, limited by a retry budget.
+
+    Each retry spends one token from the budget and each successful request
+    earns back `refill` tokens, up to `budget`. When a server is down, clients
+    therefore stop piling retries onto it instead of multiplying the load.
+    """
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=8, budget=10, refill=0.1):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.refill = refill
+        self._tokens = float(budget)
+        self._lock = Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def should_retry(self, attempt):
+        """attempt is the number of tries made so far. Spends a token if it returns True."""
+        if attempt >= self.max_attempts:
+            return False
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def record_success(self):
+        with self._lock:
+            self._tokens = min(self.budget, self._tokens + self.refill)
+
+class APIMetrics(object):
+    """Request, retry and failure counts and latencies per route."""
+    def __init__(self):
+        self._lock = Lock()
+        self._routes = {}
+
+    def __getstate__(self):
+        return {'_routes': self.snapshot()}
+
+    def __setstate__(self, state):
+        self._lock = Lock()
+        self._routes = state['_routes']
+
+    def _route(self, route):
+        return self._routes.setdefault(route, {
+            'requests': 0, 'retries': 0, 'failures': 0,
+            'total_latency': 0.0, 'max_latency': 0.0,
+            'bytes_downloaded': 0, 'download_time': 0.0
+        })
+
+    def record(self, route, latency, success=True):
+        with self._lock:
+            entry = self._route(route)
+            entry['requests'] += 1
+            if not success:
+                entry['failures'] += 1
+            entry['total_latency'] += latency
+            entry['max_latency'] = max(entry['max_latency'], latency)
+
+    def record_transfer(self, route, num_bytes, seconds):
+        with self._lock:
+            entry = self._route(route)
+            entry['bytes_downloaded'] += num_bytes
+            entry['download_time'] += seconds
+
+    def record_retry(self, route):
+        with self._lock:
+            self._route(route)['retries'] += 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the metrics as {route: {name: value}}, with mean_latency
+        and download throughput in bytes per second added.
+        """
+        with self._lock:
+            out = {}
+            for (route, entry) in self._routes.iteritems():
+                out[route] = dict(entry)
+                if entry['requests']:
+                    out[route]['mean_latency'] = entry['total_latency'] / entry['requests']
+                if entry['download_time'] > 0:
+                    out[route]['throughput'] = entry['bytes_downloaded'] / entry['download_time']
+            return out
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
+
+# Responses that mean the server or a proxy had a temporary problem
+RETRY_STATUS_CODES = (502, 503, 504)
+
+###############################################################################
+# Status Cache
+###############################################################################
+
+class StatusCache(object):
+    """
+    Most recent status of each project identifier and when it was fetched.
+
+    Every status fetched or streamed from the server is put here, so checks
+    made right after (precondition checks, other pollers) don't ask again.
+    Requests that change a project invalidate its entry. Each invalidation
+    bumps a generation number, and a fetch that started before it is not
+    stored, so a response racing with a change can't bring back old state.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}      # identifier -> (time fetched, status_dict)
+        self._generations = {}  # identifier -> number of invalidations
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def generation(self, identifier):
+        with self._lock:
+            return self._generations.get(identifier, 0)
+
+    def get(self, identifier, max_age):
+        """Returns a copy of the status if it is less than max_age seconds old, else None."""
+        with self._lock:
+            entry = self._entries.get(identifier)
+        if entry is None or time.time() - entry[0] >= max_age:
+            return None
+        return copy.deepcopy(entry[1])
+
+    def put(self, identifier, status_dict, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generations.get(identifier, 0):
+                return
+            self._entries[identifier] = (time.time(), copy.deepcopy(status_dict))
+
+    def invalidate(self, identifier=None):
+        """Forgets identifier's status, or every status if identifier is None."""
+        with self._lock:
+            identifiers = [identifier] if identifier is not None else list(self._entries)
+            for i in identifiers:
+                self._entries.pop(i, None)
+                self._generations[i] = self._generations.get(i, 0) + 1
+
+# What to print and tell the user when a step hasn't finished yet
+PRECONDITION_HINTS = {
+    'homography': 'Check your homography and upload (again).',
+    'object_tracking': 'Check object tracking and run (again).',
+    'safety_analysis': 'Check safety analysis and run (again).'
+}
+PRECONDITION_ACTIONS = {
+    'homography': 'Upload homography',
+    'object_tracking': 'Run object tracking',
+    'safety_analysis': 'Run safety analysis'
+}
 
 class CloudWizard:
-    def __init__(self, ip_addr, port=8888):
+    def __init__(self, ip_addr, port=8888,\
+                 pool_connections=4,\
+                 pool_maxsize=8,\
+                 pool_block=False,\
+                 keep_alive=True,\
+                 connect_timeout=CONNECT_TIMEOUT,\
+                 read_timeout=READ_TIMEOUT,\
+                 retry_policy=None,\
+                 download_buffer_size=DOWNLOAD_BUFFER_SIZE):
+        # Connection pool settings. pool_connections is the number of hosts
+        # to keep a pool for, pool_maxsize is the number of connections kept
+        # alive per host, and pool_block makes callers wait for a free
+        # connection instead of opening a throwaway one when the pool is full.
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        # Seconds to wait for a connection, and between bytes of a response
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = APIMetrics()
+        self.status_cache = StatusCache()
+        self.status_cache_ttl = STATUS_CACHE_TTL
+        # Bytes read per call while downloading; 1-8 MB keeps up with fast links
+        self.download_buffer_size = download_buffer_size
+
+        self._session = None
+        self._session_pid = None
+        self.upload_index = UploadIndex(get_upload_index_path())
+        self.artifact_cache = ArtifactCache(get_artifact_cache_dir())
         self.set_url(ip_addr, port=port)
 
+    def __getstate__(self):
+        # Sessions hold open sockets, which must not be shared with the
+        # multiprocess children this object is pickled into. Each process
+        # builds its own session on first use instead.
+        state = self.__dict__.copy()
+        state['_session'] = None
+        state['_session_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def session(self):
+        """
+        Returns the pooled requests.Session for the current process, creating
+        it if this is the first call in this process.
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = self._create_session()
+            self._session_pid = os.getpid()
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,\
+                              pool_maxsize=self.pool_maxsize,\
+                              pool_block=self.pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self):
+        """
+        Closes all pooled connections. A new session is created on next use.
+        """
+        if self._session is not None and self._session_pid == os.getpid():
+            self._session.close()
+        self._session = None
+        self._session_pid = None
+
     def set_url(self, ip_addr, port=8888):
         protocol = self.protocol_from_url_string(ip_addr)
         if protocol == None:
@@ -34,13 +432,15 @@ class CloudWizard:
             targ = protocol + addr + ':{}/'.format(port)
          
         try:    
-            r = requests.get(targ)
+            r = self.session.get(targ, timeout=(self.connect_timeout, self.read_timeout))
             if targ != r.url:
                 targ = str(r.url)
         except Exception as e:
             print e
             print "Could not resolve address!"
         self.server_addr = targ
+        # Unknown until the first attempt to stream status from this server
+        self.supports_status_stream = None
 
     def parse_error(self, r):
         content_type = r.headers['content-type']
@@ -63,25 +463,405 @@ class CloudWizard:
 # Helper Methods
 ###############################################################################
 
-    def writeToPath(self,request, file_path,file_name):
+    def writeToPath(self, request, file_path, file_name, parallel = DOWNLOAD_PARALLEL_PARTS):
+        '''
+            Streams the body of request to file_path/file_name. Returns
+            (success, error_message).
+
+            The body goes to file_name.part and is renamed into place once
+            complete, so file_name is either the old file or the whole new one.
+            If the server accepts byte ranges, a dropped connection is resumed
+            where it stopped, a failed download is continued by the next call
+            as long as the server's ETag or Last-Modified still match, and files
+            of at least DOWNLOAD_PARALLEL_THRESHOLD bytes are fetched as
+            parallel ranges.
+        '''
         path = os.path.join(file_path, file_name)
-        if os.path.exists(path):
-            os.remove(path)
-
+        part_path = path + DOWNLOAD_PART_SUFFIX
         if not os.path.exists(file_path):
             os.makedirs(file_path)
 
-        with open(path, 'wb') as f:
-            print('Dumping "{0}"...'.format(path))
-            for chunk in request.iter_content(chunk_size=2048):
-                if chunk:
-                    f.write(chunk)
+        size = self._expected_length(request) if request.status_code == 200 else None
+        ranged = size is not None and request.headers.get('accept-ranges') == 'bytes'
+        validator = request.headers.get('etag') or request.headers.get('last-modified')
+
+        state = self._load_download_state(part_path, request.url, size, validator) if ranged else None
+        if state is None:
+            state = {
+                'url': request.url,
+                'size': size,
+                'validator': validator,
+                'segments': self._split_download(size, parallel if ranged else 1)
+            }
+            with open(part_path, 'wb'):
+                pass
+            if size:
+                preallocate(part_path, size)
+        else:
+            print('Continuing "{0}" from an earlier download...'.format(path))
+
+        # The response already in hand covers a fresh single-part download.
+        # Anything else is fetched with range requests.
+        pending = [segment for segment in state['segments'] if segment[1] != segment[2]]
+        first_response = None
+        if len(pending) == 1 and pending[0][1] == 0:
+            first_response = request
+        else:
+            request.close()
+
+        print('Dumping "{0}"...'.format(path))
+        started = time.time()
+        already_done = sum(segment[1] - segment[0] for segment in state['segments'])
+        lock = Lock()
+        stop = Event()
+        operation = current_operation()
+
+        def fetch(segment, response=None):
+            try:
+                self._download_segment(request.request, part_path, segment, state, lock,\
+                                       ranged, response, stop)
+            except:
+                # No point in the other parts carrying on
+                stop.set()
+                raise
+
+        try:
+            if len(pending) > 1:
+                pool = ThreadPool(len(pending))
+                try:
+                    if operation is not None:
+                        pool.map(lambda segment: operation.run(fetch, segment), pending)
+                    else:
+                        pool.map(fetch, pending)
+                finally:
+                    pool.close()
+                    pool.join()
+            elif pending:
+                fetch(pending[0], first_response)
+        except (DownloadError,) + NETWORK_ERRORS + (requests.exceptions.ChunkedEncodingError,) as e:
+            if ranged and validator and not isinstance(e, DownloadError):
+                # Keep what arrived so the next call can pick up from there
+                self._save_download_state(part_path, state, lock)
+            else:
+                self._clear_download(part_path)
+            if isinstance(e, DownloadError):
+                print(str(e))
+                return (False, str(e))
+            return self.connectionError(e)[:2]
+
+        if os.path.exists(path) and sys.platform == 'win32':
+            os.remove(path)
+        os.rename(part_path, path)
+        self._clear_download(part_path, keep_part = True)
+
+        elapsed = time.time() - started
+        received = sum(segment[1] - segment[0] for segment in state['segments']) - already_done
+        self.metrics.record_transfer(request.request.path_url.split('?')[0].lstrip('/'), received, elapsed)
+        print('Downloaded {0:.1f} MB in {1:.1f} s ({2:.1f} MB/s)'.format(\
+            received / 1048576.0, elapsed, received / 1048576.0 / max(elapsed, 1e-6)))
+        return (True, None)
+
+    def _download(self, route, payload, file_path, file_name):
+        '''
+            GETs route and saves the body to file_path/file_name, returning
+            (success, err, data). If the artifact cache holds a copy from an
+            earlier download, the request is conditional and a 304 from the
+            server reuses that copy instead of transferring the file again.
+        '''
+        key = self.artifact_cache.key(self.server_addr, route, payload)
+        headers = self.artifact_cache.validators(key)
+
+        try:
+            r = self._get(route, params = payload, stream = True, headers = headers)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
+
+        path = os.path.join(file_path, file_name)
+        if r.status_code == 304 and headers:
+            r.close()
+            if self.artifact_cache.restore(key, path):
+                print('"{0}" is unchanged, using the cached copy'.format(path))
+                return (True, None, None)
+            # The cached copy disappeared in the meantime
+            self.artifact_cache.remove(key)
+            return self._download(route, payload, file_path, file_name)
+
+        success, err, data = self.parse_error(r)
+        if success:
+            success, err = self.writeToPath(r, file_path, file_name)
+        if success:
+            self.artifact_cache.store(key, payload.get('identifier'), path,\
+                r.headers.get('etag'), r.headers.get('last-modified'))
+
+        return (success, err, data)
+
+    def _download_segment(self, prepared, part_path, segment, state, lock, ranged,\
+                          response=None, stop=None):
+        # Fills segment = [start, done, end] of the part file, sending range
+        # requests as needed and retrying dropped connections. end is None if
+        # the length is unknown, in which case the segment ends with the body.
+        # Returns early, leaving the segment unfinished, once stop is set.
+        operation = current_operation()
+        route = prepared.path_url.split('?')[0].lstrip('/')
+        attempt = 1
+        last_saved = segment[1]
+        with open(part_path, 'r+b') as f:
+            sink = DownloadSink(f, self.download_buffer_size)
+            while True:
+                try:
+                    if response is None:
+                        response = self._send_range(prepared, segment, state, ranged)
+                    f.seek(segment[1])
+                    if segment[2] is None:
+                        f.truncate()
+                    for n in self._copy_body(response, sink, segment):
+                        segment[1] += n
+                        if operation is not None:
+                            operation.check()
+                        if stop is not None and stop.is_set():
+                            response.close()
+                            return
+                        if segment[1] - last_saved >= DOWNLOAD_STATE_INTERVAL:
+                            f.flush()
+                            self._save_download_state(part_path, state, lock)
+                            last_saved = segment[1]
+                    if segment[2] is not None and segment[1] < segment[2]:
+                        # A connection closed early is not always reported by urllib3
+                        raise requests.exceptions.ChunkedEncodingError('Response ended prematurely')
+                    if segment[2] is None:
+                        segment[2] = segment[1]
+                    return
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,\
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    if response is not None:
+                        response.close()
+                        response = None
+                    f.flush()
+                    if not self.retry_policy.should_retry(attempt):
+                        raise
+                    self.metrics.record_retry(route)
+                    self._sleep(self.retry_policy.delay(attempt))
+                    attempt += 1
+                    print('Resuming "{0}" at byte {1}...'.format(part_path, segment[1]))
+
+    def _copy_body(self, response, sink, segment):
+        # Writes the body through sink one buffer at a time, yielding the size
+        # of each block. Plain bodies are read straight off the connection with
+        # readinto; compressed ones have to go through requests to be decoded.
+        if response.headers.get('content-encoding', 'identity') != 'identity':
+            for chunk in response.iter_content(chunk_size=len(sink.buffer)):
+                yield sink.write(chunk)
+            return
+        try:
+            while segment[2] is None or segment[1] < segment[2]:
+                limit = None if segment[2] is None else segment[2] - segment[1]
+                n = sink.write_from(response.raw, limit)
+                if not n:
+                    return
+                yield n
+        # Reading the raw stream skips the error translation iter_content does
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+    def _send_range(self, prepared, segment, state, ranged):
+        # Requests what is left of segment. If the server can't send a range,
+        # the segment starts over from the beginning of the file.
+        operation = current_operation()
+        if operation is not None:
+            operation.check()
+        prepared = prepared.copy()
+        if ranged:
+            end = '' if segment[2] is None else segment[2] - 1
+            prepared.headers['Range'] = 'bytes={}-{}'.format(segment[1], end)
+            if state['validator']:
+                prepared.headers['If-Range'] = state['validator']
+
+        r = self.session.send(prepared, stream=True,\
+                              timeout=(self.connect_timeout, self.read_timeout))
+        if r.status_code in RETRY_STATUS_CODES:
+            r.close()
+            raise requests.exceptions.ConnectionError('Server returned {}'.format(r.status_code))
+        if r.status_code == 200 and segment[0] == 0 and len(state['segments']) == 1:
+            segment[1] = 0
+            return r
+        if r.status_code != 206:
+            r.close()
+            # Either an error or the file changed on the server since we started
+            raise DownloadError('Could not resume download of "{}" (status {})'\
+                                .format(prepared.path_url, r.status_code))
+        return r
+
+    def _expected_length(self, request):
+        # Body length promised by the response, if it can be checked against bytes written
+        length = request.headers.get('content-length')
+        if length is None or request.headers.get('content-encoding', 'identity') != 'identity':
+            return None
+        return int(length)
+
+    def _split_download(self, size, parts):
+        # Segments are [start, bytes done up to, end]
+        if size is None:
+            return [[0, 0, None]]
+        if size < DOWNLOAD_PARALLEL_THRESHOLD or parts < 2:
+            return [[0, 0, size]]
+        step = -(-size // parts)
+        return [[start, start, min(start + step, size)] for start in xrange(0, size, step)]
+
+    def _load_download_state(self, part_path, url, size, validator):
+        # Earlier progress on this download, if the part file is still for the same content
+        state_path = part_path + '.json'
+        if not validator or not os.path.exists(part_path) or not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            return None
+        if state.get('url') != url or state.get('size') != size or state.get('validator') != validator:
+            return None
+        return state
+
+    def _save_download_state(self, part_path, state, lock):
+        state_path = part_path + '.json'
+        with lock:
+            tmp_path = state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            if os.path.exists(state_path) and sys.platform == 'win32':
+                os.remove(state_path)
+            os.rename(tmp_path, state_path)
+
+    def _clear_download(self, part_path, keep_part = False):
+        paths = [part_path + '.json'] if keep_part else [part_path, part_path + '.json']
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _request(self, method, route, idempotent=None, **kwargs):
+        # Every call gets a connect and read timeout unless it passes its own,
+        # and is tied to the current operation so it can be cancelled.
+        #
+        # Connection failures, timeouts and 502/503/504 responses are retried
+        # with backoff if the request is idempotent. GETs are by default, POSTs
+        # only when the caller says so.
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        if idempotent is None:
+            idempotent = method == 'GET'
+        operation = current_operation()
+
+        attempt = 0
+        while True:
+            if operation is not None:
+                operation.check()
+            attempt += 1
+            start = time.time()
+            try:
+                r = self.session.request(method, self.server_addr + route, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.metrics.record(route, time.time() - start, success=False)
+                if not (idempotent and self.retry_policy.should_retry(attempt)):
+                    raise
+                print "{} {} failed ({}), retrying".format(method, route, e)
+            else:
+                if r.status_code in RETRY_STATUS_CODES and idempotent\
+                        and self.retry_policy.should_retry(attempt):
+                    self.metrics.record(route, time.time() - start, success=False)
+                    print "{} {} returned {}, retrying".format(method, route, r.status_code)
+                    r.close()
+                else:
+                    self.metrics.record(route, time.time() - start, success=r.status_code < 500)
+                    if r.status_code < 500:
+                        self.retry_policy.record_success()
+                    if method != 'GET':
+                        self._invalidate_status(kwargs)
+                    return r
+
+            self.metrics.record_retry(route)
+            self._sleep(self.retry_policy.delay(attempt))
+
+    def _invalidate_status(self, kwargs):
+        # Anything but a GET may have changed the project it names
+        for source in (kwargs.get('json'), kwargs.get('params')):
+            if isinstance(source, dict) and source.get('identifier'):
+                self.status_cache.invalidate(source['identifier'])
+
+    def _require_finished(self, identifier, status_names, message):
+        '''
+            Checks that every status in status_names has finished (status 2)
+            before starting something that depends on them. A recently cached
+            status is good enough to pass. Returns (success, err, status_dict),
+            where err is message formatted with what still needs to be done.
+        '''
+        status_dict = self.status_cache.get(identifier, self.status_cache_ttl)
+        if status_dict is None or self._unfinished(status_dict, status_names):
+            # Never refuse based on a cached status, it may be out of date
+            success, err, status_dict = self.getProjectStatus(identifier)
+            if not success:
+                return (success, err, status_dict)
+
+        unfinished = self._unfinished(status_dict, status_names)
+        if unfinished:
+            print PRECONDITION_HINTS[unfinished]
+            return (False, message.format(PRECONDITION_ACTIONS[unfinished]), None)
+        return (True, None, status_dict)
+
+    def _unfinished(self, status_dict, status_names):
+        for status_name in status_names:
+            if status_dict[status_name]['status'] != 2:
+                return status_name
+        return None
+
+    def _sleep(self, seconds):
+        # Wakes up early if the current operation is cancelled
+        operation = current_operation()
+        if operation is not None:
+            operation._cancelled.wait(seconds)
+            operation.check()
+        else:
+            time.sleep(seconds)
+
+    def _get(self, route, **kwargs):
+        return self._request('GET', route, **kwargs)
+
+    def _post(self, route, **kwargs):
+        return self._request('POST', route, **kwargs)
+
+    def _cancelled(self):
+        operation = current_operation()
+        return operation is not None and operation.cancelled
 
-    def connectionError(self):
-        message = 'Connection to server "{}" is offline'.format(self.server_addr)
+    def connectionError(self, error=None):
+        if isinstance(error, OperationCancelled) or self._cancelled():
+            message = 'Operation cancelled'
+        elif isinstance(error, requests.exceptions.Timeout) or 'timed out' in str(error):
+            # Timeouts while streaming a body arrive wrapped in a ConnectionError
+            message = 'Request to server "{}" timed out'.format(self.server_addr)
+        else:
+            message = 'Connection to server "{}" is offline'.format(self.server_addr)
         print(message)
         return (False, message, None)
 
+    def operation(self, identifier):
+        '''
+            Returns a new Operation for identifier. Use it as a context manager
+            around API calls to make them cancellable with cancel_all(identifier).
+        '''
+        return Operation(identifier)
+
+    def cancel_all(self, identifier):
+        '''
+            Cancels every operation and stops every StatusPoller for identifier.
+            Call when switching away from a project so its work stops using
+            bandwidth and threads.
+        '''
+        if identifier is None:
+            return
+        for operation in Operation.for_identifier(identifier):
+            operation.cancel()
+        status_scheduler.cancel_all(identifier)
+
     @classmethod
     def ip_and_port_from_url_string(cls, url):
         # Strip protocol if exists
@@ -127,21 +907,248 @@ class CloudWizard:
             try:
                 if m.len/(1024*1024) >= 100:
                     # We need to set the Content-Type header
-                    r = requests.post(\
-                        self.server_addr + 'uploadVideo', data = m,\
+                    r = self._post('uploadVideo', data = m,\
                         headers = {'Content-Type': m.content_type})
                 else:
-                    r = requests.post(\
-                        self.server_addr + 'uploadVideo', files = files)
-            except requests.exceptions.ConnectionError as e:
-                return self.connectionError()
+                    r = self._post('uploadVideo', files = files)
+            except NETWORK_ERRORS as e:
+                return self.connectionError(e)
+
+        success, err, data = self.parse_error(r)
+        if success:
+            data = data['identifier']
+
+        return (success, err, data)
+
+    def uploadVideoChunked(self, video_path, state_dir,\
+                           chunk_size=UPLOAD_CHUNK_SIZE,\
+                           parallel=UPLOAD_PARALLEL_PARTS,\
+                           progress_callback=None,\
+                           content_hash=None,\
+                           reader=None):
+        '''
+            Uploads the video in fixed-size parts, several at a time. Every part
+            the server confirms is recorded in state_dir, so calling this again
+            after a crash or dropped connection only sends the missing parts.
+
+            progress_callback, if given, is called with (bytes_confirmed, total_bytes).
+
+            If content_hash is given and the server already has a video with that
+            hash, it creates a new project on its stored copy and that project's
+            identifier is returned without sending any parts. Projects on the
+            same footage never share an identifier.
+
+            reader, a utils.tee_reader.TeeReader over video_path with a block_size
+            of chunk_size, makes the parts come from one sequential read that also
+            feeds the reader's other consumers (e.g. a hash and a local copy). The
+            whole file is read even if parts are already confirmed, and the hash
+            of a HashConsumer among them is sent when completing the upload.
+
+            Falls back to uploadVideo if the server does not support chunked uploads.
+        '''
+        if reader is not None and reader.block_size != chunk_size:
+            raise ValueError("reader.block_size must equal chunk_size")
+        size = os.path.getsize(video_path)
+        state = self._load_upload_state(state_dir, video_path, chunk_size)
+
+        payload = {
+            'filename': os.path.basename(video_path),
+            'size': size,
+            'chunk_size': chunk_size,
+            'upload_id': state.get('upload_id'),
+            'sha256': content_hash
+        }
+
+        try:
+            r = self._post('uploadVideo/init', json = payload)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
+
+        if r.status_code == 404:
+            print "Server does not support chunked uploads, uploading in one request"
+            if reader is not None:
+                reader.read_all()
+            return self.uploadVideo(video_path)
+
+        success, err, data = self.parse_error(r)
+        if not success:
+            return (success, err, data)
+
+        if data.get('identifier'):
+            self._clear_upload_state(state_dir)
+            return (True, None, data['identifier'])
+
+        # If the server has forgotten the previous upload, start over
+        if data['upload_id'] != state.get('upload_id'):
+            state['upload_id'] = data['upload_id']
+            state['confirmed'] = []
+        confirmed = set(state['confirmed'])
+        self._save_upload_state(state_dir, state)
+
+        offsets = [o for o in xrange(0, size, chunk_size) if o not in confirmed]
+        progress = sum(min(chunk_size, size - o) for o in confirmed)
+        lock = Lock()
+        operation = current_operation()
+
+        def upload_part(offset, data=None):
+            if operation is not None and operation.cancelled:
+                return (False, 'Operation cancelled', None)
+
+            if data is None:
+                with open(video_path, 'rb') as video:
+                    video.seek(offset)
+                    data = video.read(chunk_size)
+
+            params = {'upload_id': state['upload_id'], 'offset': offset}
+            try:
+                # Sending the same part twice is harmless, so it can be retried
+                r = self._post('uploadVideo/chunk', params = params, data = data,\
+                    headers = {'Content-Type': 'application/octet-stream'}, idempotent = True)
+                if operation is not None:
+                    operation.check()
+            except NETWORK_ERRORS as e:
+                return self.connectionError(e)
+
+            success, err, resp = self.parse_error(r)
+            if not success:
+                return (success, err, resp)
+
+            with lock:
+                state['confirmed'].append(offset)
+                self._save_upload_state(state_dir, state)
+            return (True, None, len(data))
+
+        if reader is not None:
+            failure = self._upload_parts_from_reader(reader, upload_part, confirmed,\
+                                                     parallel, progress, progress_callback)
+            if failure:
+                return failure
+            if operation is not None:
+                operation.check()
+            content_hash = content_hash or reader.hexdigest
+        elif offsets:
+            failure = None
+            pool = ThreadPool(max(1, min(parallel, len(offsets))))
+            try:
+                for result in pool.imap_unordered(upload_part, offsets):
+                    if not result[0]:
+                        failure = result
+                        break
+                    # Progress is reported from the calling thread, not the workers
+                    progress += result[2]
+                    if progress_callback:
+                        progress_callback(progress, size)
+            finally:
+                pool.terminate()
+                pool.join()
+            # Confirmed parts are kept in the state file for the next attempt
+            if failure:
+                return failure
+
+        try:
+            r = self._post('uploadVideo/complete', json = {'upload_id': state['upload_id'], 'sha256': content_hash})
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         success, err, data = self.parse_error(r)
         if success:
             data = data['identifier']
+            self._clear_upload_state(state_dir)
 
         return (success, err, data)
 
+    def _upload_parts_from_reader(self, reader, upload_part, confirmed, parallel, progress, progress_callback):
+        # Blocks are read in order on this thread and sent by a pool, with at
+        # most parallel parts in memory. Returns the first failure, or None.
+        pool = ThreadPool(max(1, parallel))
+        pending = deque()
+        try:
+            for (offset, data) in reader:
+                if offset not in confirmed:
+                    pending.append(pool.apply_async(upload_part, (offset, data)))
+                # Wait for the oldest parts once enough are in flight, and for
+                # all of them at the end
+                while pending and (len(pending) >= parallel or reader.complete):
+                    result = pending.popleft().get()
+                    if not result[0]:
+                        return result
+                    progress += result[2]
+                    if progress_callback:
+                        progress_callback(progress, reader.size)
+        finally:
+            reader.close()
+            pool.terminate()
+            pool.join()
+        return None
+
+    def rememberVideoHash(self, video_path, content_hash):
+        '''
+            Records the content hash of video_path, so uploading it again can
+            send the hash with the upload init without reading the file first.
+        '''
+        self.upload_index.add_file_hash(video_path, content_hash)
+
+    def knownVideoHash(self, video_path):
+        '''
+            Returns the content hash recorded for video_path when it was last
+            uploaded, or None if it has to be read to find out.
+        '''
+        return self.upload_index.file_hash(video_path)
+
+    def has_pending_upload(self, state_dir, video_path):
+        '''
+            Returns True if state_dir holds an unfinished chunked upload of video_path.
+        '''
+        state = self._read_upload_state(state_dir)
+        return state is not None and state.get('video_path') == os.path.abspath(video_path)
+
+    def _read_upload_state(self, state_dir):
+        path = os.path.join(state_dir, UPLOAD_STATE_FILE)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def _load_upload_state(self, state_dir, video_path, chunk_size):
+        stat = os.stat(video_path)
+        fresh = {
+            'video_path': os.path.abspath(video_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'chunk_size': chunk_size,
+            'server': self.server_addr,
+            'upload_id': None,
+            'confirmed': []
+        }
+
+        state = self._read_upload_state(state_dir)
+        if state is None:
+            return fresh
+        # Only resume if it is the same, unchanged file going to the same server
+        for key in ['video_path', 'size', 'mtime', 'chunk_size', 'server']:
+            if state.get(key) != fresh[key]:
+                return fresh
+        return state
+
+    def _save_upload_state(self, state_dir, state):
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        path = os.path.join(state_dir, UPLOAD_STATE_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        if os.path.exists(path) and sys.platform == 'win32':
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def _clear_upload_state(self, state_dir):
+        path = os.path.join(state_dir, UPLOAD_STATE_FILE)
+        if os.path.exists(path):
+            os.remove(path)
+
     def uploadMask(self, identifier, mask_path):
         print "uploadMask called"
         with open(mask_path, 'rb') as mask:
@@ -150,9 +1157,9 @@ class CloudWizard:
             payload = {'identifier': identifier}
 
             try:
-                r = requests.post(self.server_addr + 'mask', json = payload, files = files)
-            except requests.exceptions.ConnectionError as e:
-                return self.connectionError()
+                r = self._post('mask', json = payload, files = files)
+            except NETWORK_ERRORS as e:
+                return self.connectionError(e)
 
             return self.parse_error(r)
 
@@ -175,10 +1182,9 @@ class CloudWizard:
         }
 
         try:
-            r = requests.post(\
-                self.server_addr + 'homography', json = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._post('homography', json = payload, idempotent = True)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         return self.parse_error(r)
 
@@ -186,10 +1192,9 @@ class CloudWizard:
         payload = {'identifier': identifier}
 
         try:
-            r = requests.get(\
-                self.server_addr + 'homography', params = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._get('homography', params = payload)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         success, err, data = self.parse_error(r)
         if not success:
@@ -223,9 +1228,9 @@ class CloudWizard:
         }
 
         try:
-            r = requests.post(self.server_addr + 'config', json = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._post('config', json = payload, idempotent = True)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         return self.parse_error(r)
 
@@ -237,14 +1242,11 @@ class CloudWizard:
             print "ERROR: Invalid flag"
             return (False, 'Invalid test flag: '+str(test_flag))
 
-        success, error_message, status_dict = self.getProjectStatus(identifier)
+        success, error_message, status_dict = self._require_finished(identifier,\
+            ['homography'], '{} before testing configuration')
         if not success:
             return (success, error_message, status_dict)
 
-        if status_dict["homography"]['status'] != 2:
-            print "Check your homography and upload (again)."
-            return (False, 'Upload homography before testing configuration', None)
-
         payload = {
             'test_flag': test_flag,
             'identifier': identifier,
@@ -253,9 +1255,9 @@ class CloudWizard:
         }
 
         try:
-            r = requests.post(self.server_addr + 'testConfig', json = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._post('testConfig', json = payload)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         return self.parse_error(r)
 
@@ -274,22 +1276,13 @@ class CloudWizard:
             print "ERROR: Invalid flag"
             return (False, 'Invalid test flag: '+str(test_flag), None)
 
-        try:
-            r = requests.get(self.server_addr + 'testConfig', params = payload, stream=True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
-        if success:
-            self.writeToPath(r, file_path,file_name)
-
-        return (success, err, data)
+        return self._download('testConfig', payload, file_path, file_name)
 
     def defaultConfig(self):
         try:
-            r = requests.get(self.server_addr + 'defaultConfig')
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._get('defaultConfig')
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         return self.parse_error(r)
 
@@ -299,92 +1292,162 @@ class CloudWizard:
 
     def analysis(self, identifier, email=None):
 
-        success, error_message, status_dict = self.getProjectStatus(identifier)
+        success, error_message, status_dict = self._require_finished(identifier,\
+            ['homography'], '{} before running analysis.')
         if not success:
             return (success, error_message, status_dict)
 
-        if status_dict["homography"]['status'] != 2:
-            print "Check your homography and upload (again)."
-            return (False, 'Upload homography before running analysis.', None)
-
         payload = {
             'identifier': identifier,
             'email': email
         }
 
         try:
-            r = requests.post(self.server_addr + 'analysis', json = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._post('analysis', json = payload)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
-        return self.parse_error(r)
+        return self._rerun_started(identifier, r)
 
     def objectTracking(self, identifier, email=None):
 
-        success, error_message, status_dict = self.getProjectStatus(identifier)
+        success, error_message, status_dict = self._require_finished(identifier,\
+            ['homography'], '{} before running object tracking.')
         if not success:
             return (success, error_message, status_dict)
 
-        if status_dict["homography"]['status'] != 2:
-            print "Check your homography and upload (again)."
-            return (False, 'Upload homography before running object tracking.', None)
-
         payload = {
             'identifier': identifier,
             'email': email
         }
 
         try:
-            r = requests.post(self.server_addr + 'objectTracking', json = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._post('objectTracking', json = payload)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
-        return self.parse_error(r)
+        return self._rerun_started(identifier, r)
 
     def safetyAnalysis(self, identifier, email=None):
 
-        success, error_message, status_dict = self.getProjectStatus(identifier)
+        success, error_message, status_dict = self._require_finished(identifier,\
+            ['homography', 'object_tracking'], '{} before running safety analysis.')
         if not success:
             return (success, error_message, status_dict)
 
-        if status_dict["homography"]['status'] != 2:
-            print "Check your homography and upload (again)."
-            return (False, 'Upload homography before running safety analysis.')
-        elif status_dict["object_tracking"]['status'] != 2:
-            print "Check object tracking and run (again)."
-            return (False, 'Run object tracking before running safety analysis.')
-
         payload = {
             'identifier': identifier,
             'email': email
         }
 
         try:
-            r = requests.post(self.server_addr + 'safetyAnalysis', json = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._post('safetyAnalysis', json = payload)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
-        return self.parse_error(r)
+        return self._rerun_started(identifier, r)
+
+    def _rerun_started(self, identifier, r):
+        # The project's results are about to be replaced, so cached copies of
+        # the old ones are no use any more
+        success, error_message, data = self.parse_error(r)
+        if success:
+            self.artifact_cache.invalidate(identifier)
+        return (success, error_message, data)
 
 ###############################################################################
 # Status Checking Functions
 ###############################################################################
 
-    def getProjectStatus(self, identifier):
+    def getProjectStatus(self, identifier, max_age = None):
+        '''
+            Returns (success, err, status_dict). If max_age is given, a cached
+            status younger than max_age seconds is returned without asking the
+            server. Every status fetched is cached.
+        '''
+        if max_age:
+            status_dict = self.status_cache.get(identifier, max_age)
+            if status_dict is not None:
+                return (True, None, status_dict)
 
         payload = {
             'identifier': identifier,
         }
 
+        generation = self.status_cache.generation(identifier)
         try:
-            r = requests.get(self.server_addr + 'status', params = payload)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._get('status', params = payload)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         success, err, data = self.parse_error(r)
         if not success:
             return (success, err, data)
 
+        status_dict = self._parse_status(data)
+        self.status_cache.put(identifier, status_dict, generation)
+        return (True, None, status_dict)
+
+    def streamProjectStatus(self, identifier, on_status, should_stop = None,\
+                            read_timeout = STATUS_STREAM_READ_TIMEOUT):
+        '''
+            Listens to the server's status/stream endpoint (Server-Sent Events) and
+            calls on_status(status_dict) every time the project's status changes.
+            Keeps listening until on_status returns False, should_stop() returns
+            True (checked on every event and heartbeat), or the stream ends.
+
+            If the server does not have the endpoint, returns (False, err, None) and
+            sets self.supports_status_stream to False so callers can poll instead.
+        '''
+        payload = {
+            'identifier': identifier,
+        }
+
+        try:
+            r = self._get('status/stream', params = payload, stream = True,\
+                headers = {'Accept': 'text/event-stream'},\
+                timeout = (STATUS_STREAM_CONNECT_TIMEOUT, read_timeout))
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
+
+        if r.status_code in (404, 405, 501):
+            r.close()
+            self.supports_status_stream = False
+            return (False, 'Server does not support status streaming', None)
+
+        if 'text/event-stream' not in r.headers.get('content-type', ''):
+            r.close()
+            return self.parse_error(r)
+
+        self.supports_status_stream = True
+        try:
+            event_data = []
+            # chunk_size=1 so each event is handled as soon as it arrives
+            for line in r.iter_lines(chunk_size=1):
+                if line.startswith('data:'):
+                    event_data.append(line[5:].strip())
+                elif line == '' and event_data:
+                    data = json.loads('\n'.join(event_data))
+                    event_data = []
+                    if 'error' in data:
+                        return (False, data['error'].get('error_message', 'An error occurred'), data)
+                    status_dict = self._parse_status(data)
+                    self.status_cache.put(identifier, status_dict)
+                    if on_status(status_dict) is False:
+                        return (True, None, None)
+                # Anything else is a comment/heartbeat line
+                if should_stop and should_stop():
+                    return (True, None, None)
+        except NETWORK_ERRORS + (requests.exceptions.ChunkedEncodingError,) as e:
+            if isinstance(e, OperationCancelled) or self._cancelled():
+                return (False, 'Operation cancelled', None)
+            return (False, 'Status stream was interrupted', None)
+        finally:
+            r.close()
+
+        return (True, None, None)
+
+    def _parse_status(self, data):
         status_dict = {}
         for (k,v) in data.iteritems():
             status_dict[k] = {}
@@ -393,70 +1456,79 @@ class CloudWizard:
                     status_dict[k][key] = int(val)
                 else:
                     status_dict[k][key] = val
-
-        return (True, None, status_dict)
+        return status_dict
 
 ###############################################################################
 # Results Functions
 ###############################################################################
 
-    def results(self, identifier, file_path, ttc_threshold = None):
+    def results(self, identifier, file_path, ttc_threshold = None,\
+                progress_callback = None, max_workers = RESULTS_WORKERS):
+        '''
+            Downloads the result images and report and starts the highlight video,
+            all at the same time on a pool of at most max_workers threads.
+
+            A failing artifact does not stop the others. data is a dictionary from
+            artifact name (see RESULT_ARTIFACTS) to that call's (success, err, data)
+            tuple, and err lists every failure if success is False.
+
+            progress_callback, if given, is called on the calling thread with
+            (artifact_name, artifacts_done, artifacts_total, result) as each finishes.
+        '''
         print "results called with identifier = {}, ttc_threshold = {}" \
                 .format(identifier, ttc_threshold)
 
-        # sync calls
-        s, err, data = self.roadUserCounts(identifier,\
-                    file_path)
-        if not s:
-            return (s, err, data)
-
-        s, err, data= self.speedDistribution(identifier,\
-                    file_path)
-        if not s:
-            return (s, err, data)
-
-        s, err, data = self.turningCounts(identifier,\
-                    file_path)
-        if not s:
-            return (s, err, data)
-
-        s, err, data = self.makeReport(identifier,\
-                    file_path)
-        if not s:
-            return (s, err, data)
-
-        # async calls
-        s, err, data = self.highlightVideo(identifier,\
-                    ttc_threshold)
-        if not s:
-            return (s, err, data)
+        calls = {
+            'road_user_counts': (self.roadUserCounts, (identifier, file_path)),
+            'speed_distribution': (self.speedDistribution, (identifier, file_path)),
+            'turning_counts': (self.turningCounts, (identifier, file_path)),
+            'report': (self.makeReport, (identifier, file_path)),
+            'highlight_video': (self.highlightVideo, (identifier, ttc_threshold))
+        }
 
-        return (True, None, None)
+        operation = current_operation()
+
+        def run(name):
+            method, args = calls[name]
+            try:
+                if operation is not None:
+                    return (name, operation.run(method, *args))
+                return (name, method(*args))
+            except Exception as e:
+                return (name, (False, str(e), None))
+
+        results = {}
+        pool = ThreadPool(max(1, min(max_workers, len(RESULT_ARTIFACTS))))
+        try:
+            for (name, result) in pool.imap_unordered(run, RESULT_ARTIFACTS):
+                results[name] = result
+                if progress_callback:
+                    progress_callback(name, len(results), len(RESULT_ARTIFACTS), result)
+        finally:
+            pool.close()
+            pool.join()
+
+        errors = ['{}: {}'.format(name, results[name][1]) for name in RESULT_ARTIFACTS if not results[name][0]]
+        if errors:
+            return (False, '\n'.join(errors), results)
+
+        return (True, None, results)
 
     def highlightVideo(self, identifier, ttc_threshold = None):
-        success, error_message, status_dict = self.getProjectStatus(identifier)
+        success, error_message, status_dict = self._require_finished(identifier,\
+            ['homography', 'object_tracking', 'safety_analysis'], '{} before creating a highlight video.')
         if not success:
             return (success, error_message, status_dict)
 
-        if status_dict["homography"]['status'] != 2:
-            print "Check your homography and upload (again)."
-            return (False, 'Upload homography before creating a highlight video.')
-        elif status_dict["object_tracking"]['status'] != 2:
-            print "Check object tracking and run (again)."
-            return (False, 'Run object tracking before creating a highlight video.')
-        elif status_dict["safety_analysis"]['status'] != 2:
-            print "Check safety analysis and run (again)."
-            return (False, 'Run safety analysis before creating a highlight video.')
-
         payload = {
             'identifier': identifier,
             'ttc_threshold': ttc_threshold
         }
 
         try:
-            r = requests.post(self.server_addr + 'highlightVideo', json = payload, stream = True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
+            r = self._post('highlightVideo', json = payload, stream = True)
+        except NETWORK_ERRORS as e:
+            return self.connectionError(e)
 
         return self.parse_error(r)
 
@@ -467,16 +1539,7 @@ class CloudWizard:
             'identifier': identifier
         }
 
-        try:
-            r = requests.get(self.server_addr + 'highlightVideo', params = payload, stream = True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
-        if success:
-            self.writeToPath(r, file_path, 'highlight.mp4')
-
-        return (success, err, data)
+        return self._download('highlightVideo', payload, file_path, 'highlight.mp4')
 
     def makeReport(self, identifier, file_path):
 
@@ -484,16 +1547,7 @@ class CloudWizard:
             'identifier': identifier,
         }
 
-        try:
-            r = requests.get(self.server_addr + 'makeReport', params  = payload, stream = True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
-        if success:
-            self.writeToPath(r, file_path, 'santosreport.pdf')
-
-        return (success, err, data)
+        return self._download('makeReport', payload, file_path, 'santosreport.pdf')
 
     def retrieveResults(self, identifier, file_path):
 
@@ -501,16 +1555,7 @@ class CloudWizard:
             'identifier': identifier,
         }
 
-        try:
-            r = requests.get(self.server_addr + 'retrieveResults', params = payload, stream=True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
-        if success:
-            self.writeToPath(r, file_path, 'results.zip')
-
-        return (success, err, data)
+        return self._download('retrieveResults', payload, file_path, 'results.zip')
 
     def roadUserCounts(self, identifier, file_path):
 
@@ -518,16 +1563,7 @@ class CloudWizard:
             'identifier': identifier,
         }
 
-        try:
-            r = requests.get(self.server_addr + 'roadUserCounts', params = payload, stream=True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
-        if success:
-            self.writeToPath(r, file_path, 'road_user_icon_counts.jpg')
-
-        return (success, err, data)
+        return self._download('roadUserCounts', payload, file_path, 'road_user_icon_counts.jpg')
 
     def speedDistribution(self, identifier, file_path):
 
@@ -535,16 +1571,7 @@ class CloudWizard:
             'identifier': identifier
         }
 
-        try:
-            r = requests.get(self.server_addr + 'speedDistribution', params = payload, stream=True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
-        if success:
-            self.writeToPath(r, file_path, 'velocityPDF.jpg')
-
-        return (success, err, data)
+        return self._download('speedDistribution', payload, file_path, 'velocityPDF.jpg')
 
     def turningCounts(self, identifier, file_path):
         print "turningCounts called with identifier = {}"\
@@ -554,16 +1581,7 @@ class CloudWizard:
             'identifier': identifier
         }
 
-        try:
-            r = requests.get(self.server_addr + 'turningCounts', params = payload, stream=True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
-        if success:
-            self.writeToPath(r, file_path, 'turningCounts.jpg')
-
-        return (success, err, data)
+        return self._download('turningCounts', payload, file_path, 'turningCounts.jpg')
 
 ###############################################################################
 # Compare Methods
@@ -580,17 +1598,8 @@ class CloudWizard:
             'only_show_85th': only_show_85th
         }
 
-        try:
-            r = requests.get(self.server_addr + 'compareSpeeds', params = payload, stream=True)
-        except requests.exceptions.ConnectionError as e:
-            return self.connectionError()
-
-        success, err, data = self.parse_error(r)
         imgname = 'compare85th.jpg' if only_show_85th else 'comparePercentiles.jpg'
-        if success:
-            self.writeToPath(r, file_path, imgname)
-
-        return (success, err, data)
+        return self._download('compareSpeeds', payload, file_path, imgname)
 
 
 # Define singleton to be used everywhere
@@ -600,32 +1609,278 @@ api = CloudWizard('localhost')
 # Poll for Status with Callback
 ###############################################################################
 
+class StatusScheduler(object):
+    """
+    Polls project status for every StatusPoller from a fixed, small set of threads.
+
+    Wake-ups are kept in a priority queue keyed by time. All pollers subscribed to
+    the same identifier share one getProjectStatus request per tick, and the
+    result is handed to each of them.
+
+    If push is True and the server has a status/stream endpoint, each identifier
+    instead gets one streaming connection and pollers are called back as soon as
+    the status changes. Polling takes over if the stream is unavailable or drops.
+    """
+    def __init__(self, num_threads=2, push=True):
+        self._num_threads = num_threads
+        self._threads = []
+        self.push = push
+        self._streams = set()       # identifiers with a status stream open
+        self._cond = Condition()
+        self._heap = []             # (wake_time, identifier)
+        self._next_wake = {}        # identifier -> wake_time of its live heap entry
+        self._subscribers = {}      # identifier -> [StatusPoller]
+        self._in_flight = set()     # identifiers currently being requested
+
+    def subscribe(self, poller, delay=0):
+        with self._cond:
+            self._ensure_threads()
+            pollers = self._subscribers.setdefault(poller.identifier, [])
+            if poller not in pollers:
+                pollers.append(poller)
+            if poller.identifier in self._streams:
+                return
+            if self.push and api.supports_status_stream is not False:
+                self._streams.add(poller.identifier)
+                thread = Thread(target=self._stream, args=(poller.identifier,),\
+                                name='StatusStream-{}'.format(poller.identifier))
+                thread.daemon = True
+                thread.start()
+            elif poller.identifier not in self._in_flight:
+                self._schedule(poller.identifier, time.time() + delay)
+
+    def unsubscribe(self, poller):
+        with self._cond:
+            pollers = self._subscribers.get(poller.identifier, [])
+            if poller in pollers:
+                pollers.remove(poller)
+            if not pollers:
+                self._subscribers.pop(poller.identifier, None)
+                self._next_wake.pop(poller.identifier, None)
+
+    def cancel_all(self, identifier):
+        """Stops every poller for identifier without calling their callbacks."""
+        with self._cond:
+            pollers = self._subscribers.pop(identifier, [])
+            self._next_wake.pop(identifier, None)
+        for poller in pollers:
+            poller.is_running = False
+
+    def _schedule(self, identifier, wake_time):
+        # Only ever move a wake-up earlier. Stale heap entries are skipped when popped.
+        current = self._next_wake.get(identifier)
+        if current is not None and current <= wake_time:
+            return
+        self._next_wake[identifier] = wake_time
+        heapq.heappush(self._heap, (wake_time, identifier))
+        self._cond.notify()
+
+    def _ensure_threads(self):
+        if self._threads:
+            return
+        for i in range(self._num_threads):
+            thread = Thread(target=self._run, name='StatusScheduler-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_due(self):
+        """Blocks until an identifier is due and returns it. Must hold self._cond."""
+        while True:
+            if not self._heap:
+                self._cond.wait()
+                continue
+            wake_time, identifier = self._heap[0]
+            if self._next_wake.get(identifier) != wake_time:
+                heapq.heappop(self._heap)
+                continue
+            delay = wake_time - time.time()
+            if delay > 0:
+                self._cond.wait(delay)
+                continue
+            heapq.heappop(self._heap)
+            del self._next_wake[identifier]
+            return identifier
+
+    def _dispatch(self, identifier, success, err, status_dict):
+        """Hands a status result to every poller of identifier. Returns False if there are none."""
+        with self._cond:
+            pollers = list(self._subscribers.get(identifier, []))
+
+        for poller in pollers:
+            try:
+                poller._handle_status(success, err, status_dict)
+            except Exception as e:
+                print "StatusPoller callback for {} raised: {}".format(poller.status_name, e)
+        return len(pollers) > 0
+
+    def _stream(self, identifier):
+        def should_stop():
+            with self._cond:
+                return not self._subscribers.get(identifier)
+
+        def on_status(status_dict):
+            self._dispatch(identifier, True, None, status_dict)
+
+        try:
+            success, err, _ = api.streamProjectStatus(identifier, on_status, should_stop=should_stop)
+        except Exception as e:
+            success, err = (False, str(e))
+        if not success:
+            print "Status stream for {} ended ({}), polling instead".format(identifier, err)
+
+        with self._cond:
+            self._streams.discard(identifier)
+            if self._subscribers.get(identifier):
+                self._schedule(identifier, time.time())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                identifier = self._next_due()
+                self._in_flight.add(identifier)
+
+            try:
+                success, err, status_dict = api.getProjectStatus(identifier, max_age=STATUS_POLL_MAX_AGE)
+            except Exception as e:
+                success, err, status_dict = (False, str(e), None)
+
+            with self._cond:
+                self._in_flight.discard(identifier)
+
+            self._dispatch(identifier, success, err, status_dict)
+
+            with self._cond:
+                remaining = self._subscribers.get(identifier)
+                if remaining:
+                    interval = min(p.interval for p in remaining)
+                    self._schedule(identifier, time.time() + interval)
+
+# Shared by every StatusPoller
+status_scheduler = StatusScheduler()
+
+class PollingPolicy(object):
+    """
+    Decides how long a StatusPoller waits between polls.
+
+    Polls every `initial` seconds at first and multiplies the wait by `factor`
+    each time nothing changes, up to `maximum`. Any change resets it to `initial`.
+    Each wait is randomly stretched or shrunk by up to `jitter` (a fraction) so
+    many clients do not poll the server in lockstep. If the server reports an
+    'eta' (seconds left) or 'progress' (0 to 1), the wait is capped so the poll
+    lands close to the expected finish. The jitter is drawn from
+    random_source (anything with uniform(a, b), e.g. a seeded random.Random),
+    the random module by default.
+    """
+    def __init__(self, initial=2, maximum=30, factor=1.5, jitter=0.2, random_source=None):
+        self.initial = float(initial)
+        self.maximum = float(max(initial, maximum))
+        self.factor = factor
+        self.jitter = jitter
+        self.random_source = random_source or random
+        self.reset()
+
+    def reset(self):
+        self._current = self.initial
+        self._started = time.time()
+
+    def next_interval(self, changed, status=None):
+        if changed:
+            self._current = self.initial
+        else:
+            self._current = min(self._current * self.factor, self.maximum)
+
+        interval = self._current
+        eta = self._eta(status)
+        if eta is not None:
+            interval = min(interval, max(self.initial, eta))
+
+        if self.jitter:
+            interval *= self.random_source.uniform(1 - self.jitter, 1 + self.jitter)
+        return interval
+
+    def _eta(self, status):
+        if not status:
+            return None
+        try:
+            if status.get('eta') is not None:
+                return float(status['eta'])
+            if status.get('progress') is not None:
+                progress = float(status['progress'])
+                if 0 < progress < 1:
+                    elapsed = time.time() - self._started
+                    return elapsed * (1 - progress) / progress
+        except (TypeError, ValueError):
+            pass
+        return None
+
+# Policy settings per status name. Status names not listed here poll at the
+# fixed interval given to their StatusPoller.
+POLLING_POLICIES = {
+    'feature_test': {'initial': 2, 'maximum': 10},
+    'object_test': {'initial': 2, 'maximum': 10},
+    'object_tracking': {'initial': 5, 'maximum': 60},
+    'safety_analysis': {'initial': 5, 'maximum': 60},
+    'highlight_video': {'initial': 5, 'maximum': 60},
+}
+
+def register_polling_policy(status_name, factory):
+    """
+    Sets the policy used for status_name. factory is either a dictionary of
+    PollingPolicy arguments or a callable that returns a new policy object with
+    a next_interval(changed, status) method.
+    """
+    POLLING_POLICIES[status_name] = factory
+
+def polling_policy_for(status_name, interval):
+    factory = POLLING_POLICIES.get(status_name)
+    if factory is None:
+        return PollingPolicy(initial=interval, maximum=interval, jitter=0)
+    if isinstance(factory, dict):
+        return PollingPolicy(**factory)
+    return factory()
+
 class StatusPoller(object):
-    def __init__(self, identifier, status_name, interval, callback):
-        self._timer = None
+    def __init__(self, identifier, status_name, interval, callback, scheduler=None, policy=None,\
+                 max_failures=3):
         self.identifier = identifier
         self.status_name = status_name
         self.interval = interval
         self.callback = callback
         self.is_running = False
         self.has_run = False
+        self._scheduler = scheduler or status_scheduler
+        self._policy = policy or polling_policy_for(status_name, interval)
+        self._last_status = None
+        # Consecutive failed polls tolerated before giving up
+        self.max_failures = max_failures
+        self._failures = 0
+
+    def _handle_status(self, success, err, status_dict):
+        if not self.is_running:
+            return
 
-    def _run(self):
-        self.is_running = False
-        self.start()
-
-        self._poll_for_status()
-
-    def _poll_for_status(self):
-        success, err, status_dict = api.getProjectStatus(self.identifier)
+        if success and self.status_name in status_dict:
+            # The scheduler reads self.interval when planning the next poll
+            status = status_dict[self.status_name]
+            self.interval = self._policy.next_interval(status != self._last_status, status)
+            self._last_status = status
 
         if not success:
-            self.callback(err)
+            self._failures += 1
+            if self._failures < self.max_failures and err != 'Operation cancelled':
+                print('{} poll failed ({}), trying again'.format(self.status_name, err))
+                return
             self.stop()
+            self.callback(err)
             return
+        self._failures = 0
 
         if self.status_name not in status_dict.keys():
             print(self.status_name + ' not in status dictionary')
+            self.stop()
+            self.callback(self.status_name + ' is not a known status')
+            return
 
         status = status_dict[self.status_name]['status']
         if status == 2:
@@ -636,162 +1891,447 @@ class StatusPoller(object):
             print(self.status_name + ' is still running')
         elif status == -1:
             print(self.status_name + ' failed')
+            self.stop()
             if 'failure_message' in status_dict[self.status_name]:
                 self.callback(status_dict[self.status_name]['failure_message'])
             else:
                 self.callback(self.status_name + ' failed.')
-            self.stop()
         else:
             print(self.status_name + ' is not running, not continuing to poll for status')
-            self.callback(self.status_name + ' is not running, not continuing to poll for status')
             self.stop()
+            self.callback(self.status_name + ' is not running, not continuing to poll for status')
 
     def start(self):
         if not self.is_running:
-            # If it's the first time, run it immediately
-            if not self.has_run:
-                self._timer = Timer(0, self._run)
-                self.has_run = True
-            else:
-                self._timer = Timer(self.interval, self._run)
-            self._timer.start()
             self.is_running = True
+            # If it's the first time, poll immediately
+            delay = self.interval if self.has_run else 0
+            self.has_run = True
+            self._scheduler.subscribe(self, delay=delay)
 
     def stop(self):
-        self._timer.cancel()
         self.is_running = False
+        self._scheduler.unsubscribe(self)
 
 ###############################################################################
-# Run Function on Process with Callback
+# Run API Calls on a Worker Pool
 ###############################################################################
 
-class CallbackProcess(object):
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs={},\
-                        callback=None, callback_args=(), callback_kwargs={},\
-                        interval=1, timeout=0):
-
-        self._q = Queue()
-
-        self._args = tuple(args)
-        self._kwargs = dict(kwargs)
-        self._method = self._wrap(target, self._q)
-        self._p = Process(target=self._method, group=group, name=name, args=self._args, kwargs=self._kwargs)
+class CancelledError(Exception):
+    pass
+
+def _call_now(function, *args, **kwargs):
+    function(*args, **kwargs)
+
+class APIFuture(object):
+    """
+    Result of a call submitted to an APIExecutor. Callbacks added with
+    add_done_callback are called with the future as argument through the
+    executors' callback dispatcher (see APIExecutor.set_callback_dispatcher).
+    """
+    PENDING, RUNNING, FINISHED, CANCELLED = range(4)
+
+    def __init__(self):
+        self._cond = Condition()
+        self._state = APIFuture.PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._listeners = []
+
+    def cancel(self):
+        """Cancels the call if it has not started yet. Returns True if it was cancelled."""
+        with self._cond:
+            if self._state == APIFuture.CANCELLED:
+                return True
+            if self._state != APIFuture.PENDING:
+                return False
+            self._state = APIFuture.CANCELLED
+            self._cond.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == APIFuture.CANCELLED
+
+    def running(self):
+        return self._state == APIFuture.RUNNING
+
+    def done(self):
+        return self._state in (APIFuture.FINISHED, APIFuture.CANCELLED)
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, function):
+        with self._cond:
+            if not self.done():
+                self._callbacks.append(function)
+                return
+        APIExecutor.callback_dispatcher(function, self)
+
+    def _add_listener(self, function):
+        # Like add_done_callback, but function runs right away on the thread
+        # that finishes the future. Only for quick bookkeeping between futures.
+        with self._cond:
+            if not self.done():
+                self._listeners.append(function)
+                return
+        function(self)
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self.done():
+                self._cond.wait(timeout)
+            if self._state == APIFuture.CANCELLED:
+                raise CancelledError()
+            if not self.done():
+                raise RuntimeError('Timed out waiting for API call')
+
+    def _set_running(self):
+        with self._cond:
+            if self._state != APIFuture.PENDING:
+                return False
+            self._state = APIFuture.RUNNING
+            return True
+
+    def _set_result(self, result):
+        with self._cond:
+            self._result = result
+            self._state = APIFuture.FINISHED
+            self._cond.notify_all()
+        self._run_callbacks()
+
+    def _set_exception(self, exception):
+        with self._cond:
+            self._exception = exception
+            self._state = APIFuture.FINISHED
+            self._cond.notify_all()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        with self._cond:
+            callbacks, self._callbacks = self._callbacks, []
+            listeners, self._listeners = self._listeners, []
+        for function in listeners:
+            function(self)
+        for function in callbacks:
+            APIExecutor.callback_dispatcher(function, self)
+
+def _call_in_process(function, args, kwargs):
+    # Exceptions are returned rather than raised, since multiprocess pools
+    # in Python 2 have no error callback.
+    try:
+        return (True, function(*args, **kwargs))
+    except Exception as e:
+        return (False, e)
+
+class APIExecutor(object):
+    """
+    Persistent pool of worker threads for API calls, which spend their time
+    waiting on the network. A process pool can be used for CPU-bound work with
+    submit_process. Both are created on first use and reused for every call.
+    """
+    # Called as dispatcher(function, future) to run every done callback.
+    # Without a GUI callbacks run on the thread that finished the future.
+    callback_dispatcher = staticmethod(_call_now)
+
+    def __init__(self, max_workers=4, max_processes=2):
+        self.max_workers = max_workers
+        self.max_processes = max_processes
+        self._queue = ThreadQueue()
+        self._threads = []
+        self._idle = 0
+        self._lock = Lock()
+        self._process_pool = None
 
-        self._callback = callback
-        self._callback_args = callback_args
-        self._callback_kwargs = callback_kwargs
+    @classmethod
+    def set_callback_dispatcher(cls, dispatcher):
+        """
+        Makes dispatcher(function, *args) run the done callbacks of all futures,
+        e.g. custom.main_thread.call_on_main_thread to run them on the Qt main
+        thread.
+        """
+        cls.callback_dispatcher = staticmethod(dispatcher)
+
+    def submit(self, function, *args, **kwargs):
+        future = APIFuture()
+        with self._lock:
+            self._queue.put((future, function, args, kwargs))
+            # Only start another thread if the waiting ones can't take every call
+            if self._queue.qsize() > self._idle and len(self._threads) < self.max_workers:
+                thread = Thread(target=self._work, name='APIExecutor-{}'.format(len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def submit_for_project(self, identifier, function, *args, **kwargs):
+        """
+        Like submit, but the call runs under an Operation for identifier, so
+        api.cancel_all(identifier) cancels it if pending or stops its requests
+        if running.
+        """
+        operation = Operation(identifier)
+        future = self.submit(operation.run, function, *args, **kwargs)
+        operation.add_future(future)
+        return future
+
+    def submit_process(self, function, *args, **kwargs):
+        future = APIFuture()
+        if self._process_pool is None:
+            self._process_pool = ProcessPool(self.max_processes)
+
+        def finish(ret):
+            success, value = ret
+            if success:
+                future._set_result(value)
+            else:
+                future._set_exception(value)
+
+        future._set_running()
+        self._process_pool.apply_async(_call_in_process, (function, args, kwargs), callback=finish)
+        return future
+
+    def shutdown(self):
+        with self._lock:
+            for _ in self._threads:
+                self._queue.put(None)
+            self._threads = []
+        if self._process_pool is not None:
+            self._process_pool.close()
+            self._process_pool = None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            item = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            if item is None:
+                return
+            future, function, args, kwargs = item
+            if future._set_running():
+                try:
+                    future._set_result(function(*args, **kwargs))
+                except Exception as e:
+                    future._set_exception(e)
 
-        self._interval = interval
-        self._timeout = timeout
-        self._start_time = 0
-        self._count = 0
+# Shared by every caller of the API
+api_executor = APIExecutor()
 
-        self._done = False
-        self.results = []
+###############################################################################
+# Asynchronous Client
+###############################################################################
 
-    def start(self):
-        self._p.start()
-        self._start_time=time.time()
-        Timer(self._interval,self._check_queue).start()
-
-    # Override to determine what to do when something is grabbed from the queue
-    # By default this adds the first value returned from the target function to the results list
-    # and sets the internal boolean to be done.
-    def on_success(self, data):
-        self._done = True
-        self.results.append(data)
-
-    # Override to determine when the state in which the callback should be called and the process ended
-    # By default this uses a simple internal boolean that is set in the default on_success function.
-    def is_done(self):
-        return self._done
-
-    # Override to determine what you want the function to do when it finishes
-    # By default this calls the provided callback function
-    def finish(self):
-        if self._callback:
-            self._callback(*self._callback_args,**self._callback_kwargs)
-
-    def _wrap(self, func, queue):
-        def _function(*args, **kwargs):
-            ret = func(*args, **kwargs)
-            queue.put(ret)
-            #
-            # This prevents the race condition detailed here:
-            #    1. After putting an object on an empty queue there may be an infinitesimal
-            #        delay before the queue's empty() method returns False and get_nowait()
-            #        can return without raising Queue.Empty. 
-            # See: https://docs.python.org/2/library/multiprocessing.html#pipes-and-queues
-            #
-            # Instead we sleep for 100ms and then terminate the process. This allows us to
-            # get all data returned from the queue before we terminate.
-            time.sleep(0.1)
-        return _function
-
-    def _check_queue(self):
-        delay = max(self._start_time + (self._count+2)*self._interval - time.time(),0)
+class Return(Exception):
+    """Raise Return(value) to end a coroutine with a result (Python 2 generators can't return one)."""
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+def _outcome(future):
+    # (value, exception) of a finished future
+    if future.cancelled():
+        return (None, CancelledError())
+    exception = future.exception()
+    if exception is not None:
+        return (None, exception)
+    return (future.result(), None)
+
+def gather(futures):
+    """Returns an APIFuture for the list of results of futures, once they are all done."""
+    futures = list(futures)
+    result = APIFuture()
+    result._set_running()
+    if not futures:
+        result._set_result([])
+        return result
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def finished(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for future in futures:
+            value, exception = _outcome(future)
+            if exception is not None:
+                result._set_exception(exception)
+                return
+        result._set_result([future.result() for future in futures])
+
+    for future in futures:
+        future.add_done_callback(finished)
+    return result
+
+def coroutine(function):
+    """
+    Lets a generator function wait for APIFutures without blocking the thread:
+
+        @coroutine
+        def runAnalysis(self):
+            success, err, _ = yield async_api.analysis(get_identifier())
+
+    Each yield of a future (or a list of futures, which waits for all of them)
+    suspends the function until it is done and resumes it with the result, or
+    raises the future's exception at the yield. It resumes wherever done
+    callbacks are dispatched to, the Qt main thread in the GUI. Calling the
+    function returns an APIFuture for its result, set with raise Return(value).
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        result = APIFuture()
+        result._set_running()
         try:
-            return_val = self._q.get_nowait()
-            self.on_success(data=return_val)
-        except EmptyQueue:
-            pass
-        finally:
-            if not self.is_done() and (self._timeout==0 or self._count<self._timeout) and self._p.is_alive():
-                self._count+=1
-                Timer(delay, self._check_queue).start()
-            else:
-                self._end_process()
-                self._q.close()
-                self.finish()
-
-    def _end_process(self):
-        if self._p.is_alive():
-            if self._count>=self._timeout and self._timeout!=0:
-                print "Timeout Warning: Process terminating, returned data could be corrupted."
+            generator = function(*args, **kwargs)
+        except Return as r:
+            result._set_result(r.value)
+            return result
+        except Exception as e:
+            _report_coroutine_error(function, e)
+            result._set_exception(e)
+            return result
+        if not isinstance(generator, types.GeneratorType):
+            result._set_result(generator)
+            return result
+        _step(function, generator, result, None, None)
+        return result
+    return wrapper
+
+def _step(function, generator, result, value, exception):
+    # Runs generator up to its next yield of an unfinished future, then waits
+    # for that future with a callback that continues from there
+    while True:
+        try:
+            if exception is not None:
+                yielded = generator.throw(exception)
             else:
-                print "Warning: Process terminating but was still alive and timeout was not reached, returned data could be corrupted."
-            self._p.terminate()
-        elif self._p.exitcode == signal.SIGTERM:
-            print "Warning: Process was terminated (SIGTERM)"
-        elif self._p.exitcode == signal.SIGSEGV:
-            print "Warning: Process was terminated (SIGSEGV)"
-        elif self._p.exitcode == 0:
-            print "Process Exited Cleanly"
-
-class SingleAPICallbackProcess(CallbackProcess):
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs={},
-                        callback=None, callback_args=(), callback_kwargs={},
-                        return_data=False, return_error=False, interval=1, timeout=0):
-
-        super(SingleAPICallbackProcess, self).__init__(
-                        group=group, target=target, name=name, args=args, kwargs=kwargs,
-                        callback=callback, callback_args=callback_args, callback_kwargs=callback_kwargs,
-                        interval=interval, timeout=timeout)
-
-        self._return_data = return_data
-        self._return_error = return_error
+                yielded = generator.send(value)
+        except StopIteration:
+            result._set_result(None)
+            return
+        except Return as r:
+            result._set_result(r.value)
+            return
+        except Exception as e:
+            _report_coroutine_error(function, e)
+            result._set_exception(e)
+            return
 
-    def finish(self):
-        if self._callback:
-            if self._return_data:
-                try:
-                    self._callback(queue=self.results, *self._callback_args, **self._callback_kwargs)
-                except TypeError:
-                    print "Callback function does not have queue argument. This is required to return data"
-            elif self._return_error:
-                try:
-                    self._callback(error_message=self._get_single_error(), *self._callback_args, **self._callback_kwargs)
-                except TypeError:
-                    print "Callback function does not have error_message argument. This is required to return the first error message"
+        future = gather(yielded) if isinstance(yielded, (list, tuple)) else yielded
+        if not future.done():
+            future.add_done_callback(lambda f: _step(function, generator, result, *_outcome(f)))
+            return
+        value, exception = _outcome(future)
+
+def _report_coroutine_error(function, exception):
+    # Nobody may be waiting on the coroutine's future, so don't let errors vanish
+    if not isinstance(exception, CancelledError):
+        print "Coroutine {} raised: {}".format(function.__name__, exception)
+        traceback.print_exc()
+
+class AsyncCloudWizard(object):
+    """
+    Non-blocking version of a CloudWizard with the same methods. Each API call
+    runs on an APIExecutor and immediately returns an APIFuture for its
+    (success, err, data) tuple, to be yielded from a @coroutine or given a
+    done callback, which runs on the Qt main thread in the GUI.
+
+    Calls whose first argument is a project identifier run under an Operation
+    for it, so api.cancel_all(identifier) stops them, and run one after the
+    other in the order they were made, so that e.g. saving a configuration
+    still happens before the test that uses it. Long-lived calls in
+    _UNORDERED_METHODS are left out of that order, since everything made for
+    the project after them would wait until they end.
+
+    This is a thread-pool stand-in for an asyncio client, which Python 2 and
+    the blocking requests library don't allow.
+    """
+    # Methods that don't talk to the server and are passed straight through
+    _LOCAL_METHODS = ('operation', 'connectionError', 'writeToPath', 'parse_error',\
+                      'set_url', 'cancel_all', 'has_pending_upload', 'knownVideoHash',\
+                      'rememberVideoHash', 'ip_and_port_from_url_string',\
+                      'protocol_from_url_string')
+    # Project calls that last as long as something watches the project, and
+    # so run (still under an Operation) alongside its other calls
+    _UNORDERED_METHODS = ('streamProjectStatus',)
+
+    def __init__(self, wizard, executor):
+        self._wizard = wizard
+        self._executor = executor
+        self._lock = Lock()
+        self._last = {}     # identifier -> future of the latest unfinished call for it
+
+    def __getattr__(self, name):
+        attribute = getattr(self._wizard, name)
+        if not callable(attribute) or name.startswith('_') or name in self._LOCAL_METHODS:
+            return attribute
+
+        try:
+            arg_names = inspect.getargspec(attribute).args
+        except TypeError:
+            arg_names = []
+        by_project = len(arg_names) > 1 and arg_names[1] == 'identifier'
+
+        def call(*args, **kwargs):
+            if by_project:
+                identifier = args[0] if args else kwargs['identifier']
+                if name in self._UNORDERED_METHODS:
+                    return self._executor.submit_for_project(identifier, attribute, *args, **kwargs)
+                return self._submit_in_order(identifier, attribute, args, kwargs)
+            return self._executor.submit(attribute, *args, **kwargs)
+        call.__name__ = name
+        call.__doc__ = attribute.__doc__
+        return call
+
+    def _submit_in_order(self, identifier, method, args, kwargs):
+        # The call is only handed to the executor once the previous call for
+        # identifier is done, so no worker sits waiting for it. Until then the
+        # returned future is pending, and cancel_all(identifier) cancels it.
+        operation = Operation(identifier)
+        future = APIFuture()
+        operation.add_future(future)
+
+        def start(_=None):
+            if not future._set_running():
+                # Cancelled while waiting its turn
+                operation.finish()
+                return
+            call = self._executor.submit(operation.run, method, *args, **kwargs)
+            operation.add_future(call)
+            call._add_listener(finished)
+
+        def finished(call):
+            value, exception = _outcome(call)
+            if exception is not None:
+                future._set_exception(exception)
             else:
-                try:
-                    self._callback(*self._callback_args,**self._callback_kwargs)
-                except Exception as e:
-                    print str(e)
+                future._set_result(value)
+
+        def forget(_):
+            with self._lock:
+                if self._last.get(identifier) is future:
+                    del self._last[identifier]
+
+        with self._lock:
+            previous = self._last.get(identifier)
+            self._last[identifier] = future
+        future._add_listener(forget)
+        if previous is None:
+            start()
+        else:
+            previous._add_listener(start)
+        return future
 
-    def _get_single_error(self, index=0):
-        if index>=0 and index<len(self.results):
-            ret = self.results[index]
-            if not ret==None:
-                return ret[1]
-        return None
+# Non-blocking access to api, for the GUI
+async_api = AsyncCloudWizard(api, api_executor)
@@ -1,11 +1,22 @@
 # homography.py
-from PyQt5 import QtGui, QtWidgets
+from PyQt5 import QtGui, QtWidgets, QtCore
 from PyQt5.QtCore import Qt
+import numpy as np
+
+from utils.point_index import PointGrid
+from utils.homography_solver import projectArray, find_homography, reprojection_errors, HomographyError
+from utils.tile_pyramid import TilePyramid, open_large_image, pyramid_dir, TILED_IMAGE_MIN_SIZE,\
+                               is_current as pyramid_is_current
+from utils.raw_image import RawImage, raw_image_path, is_current as raw_image_is_current
+from custom.tiled_image import TiledImageItem, raw_qimage
 
 
 class HomographyView(QtWidgets.QGraphicsView):
     """QGraphicsView used for manipulating and computing image-based homographies.
     """
+    # Emitted when a point is added, moved or deleted in the current scene
+    points_changed = QtCore.pyqtSignal()
+
     def __init__(self, parent):
         super(HomographyView, self).__init__(parent)
         self.cursor_default = QtGui.QCursor(Qt.CrossCursor)
@@ -13,8 +24,13 @@ class HomographyView(QtWidgets.QGraphicsView):
         self.cursor_drag = QtGui.QCursor(Qt.ClosedHandCursor)
 
         self.image_loaded = False
+        # Runs tile pyramid builds in the background when set, an APIExecutor
+        # or anything else with the same submit()
+        self.tile_executor = None
 
         self.status_label = None
+        self.point_count = 0
+        self.fit_error = None
 
     def load_image(self, image):
         """
@@ -23,17 +39,86 @@ class HomographyView(QtWidgets.QGraphicsView):
         be placed at (0,0) in the scene.
         """
         self.scene_image = image
+        self.scene_raw = None
         new_scene = HomographyScene(self)
         pmap = QtGui.QPixmap().fromImage(image)
         pmapitem = new_scene.addPixmap(pmap)
-        new_scene.register_pixmap(pmapitem)
+        self._show_scene(new_scene, pmapitem, pmap.width(), pmap.height())
+
+    def load_tiled_image(self, pyramid):
+        """
+        Like load_image, but for a TilePyramid or a RawImage. Only the tiles
+        needed for the visible part of the image at the current zoom are ever
+        loaded.
+        """
+        self.scene_image = None
+        self.scene_raw = None
+        new_scene = HomographyScene(self)
+        item = TiledImageItem(pyramid)
+        new_scene.addItem(item)
+        self._show_scene(new_scene, item, pyramid.width, pyramid.height)
+
+    def load_tiled_image_later(self, path, width, height):
+        """
+        Like load_tiled_image, for an image whose tile pyramid has to be built
+        first. That takes a while for a big image, so it happens on
+        tile_executor; until then a blank area of the image's size is shown, on
+        which points can already be placed.
+        """
+        self.scene_image = None
+        self.scene_raw = None
+        new_scene = HomographyScene(self)
+        placeholder = new_scene.addRect(0, 0, width, height, QtGui.QPen(Qt.NoPen),\
+                                        QtGui.QBrush(QtGui.QColor(64, 64, 64)))
+        self._show_scene(new_scene, placeholder, width, height)
+
+        def done(future):
+            # Another image may have been loaded in the meantime
+            if self.scene() is not new_scene or future.cancelled():
+                return
+            if future.exception() is not None:
+                print("ERR: load_tiled_image_later(): Couldn't build tiles for {}: {}".format(path, future.exception()))
+                return
+            item = TiledImageItem(future.result())
+            new_scene.removeItem(placeholder)
+            new_scene.addItem(item)
+            new_scene.register_pixmap(item)
+        self.tile_executor.submit(TilePyramid.open, path).add_done_callback(done)
+
+    def _show_scene(self, new_scene, image_item, width, height):
+        new_scene.register_pixmap(image_item)
         new_scene.setBackgroundBrush(QtGui.QBrush(QtGui.QColor(0, 0, 0)))
+        new_scene.points_changed.connect(self.points_changed.emit)
         self.setScene(new_scene)
-        self.fitInView(0, 0, pmap.width(), pmap.height(), Qt.KeepAspectRatio)
+        self.fitInView(0, 0, width, height, Qt.KeepAspectRatio)
         self.show()
         self.image_loaded = True
+        self.points_changed.emit()
 
     def load_image_from_path(self, path):
+        """
+        Loads the image file at path. If it has a raw copy (see RawImage),
+        the pixels are used from there without decoding anything. Otherwise
+        large images are shown from a tile pyramid kept in tiles/ next to the
+        file, which is built in the background if needed.
+        """
+        if raw_image_is_current(path, raw_image_path(path)):
+            raw = RawImage(raw_image_path(path))
+            if max(raw.width, raw.height) >= TILED_IMAGE_MIN_SIZE:
+                self.load_tiled_image(raw)
+            else:
+                # The QImage points into raw's mapping, keep it open with it
+                self.load_image(raw_qimage(raw))
+                self.scene_raw = raw
+            return
+        # Only reads the header
+        width, height = open_large_image(path).size
+        if max(width, height) >= TILED_IMAGE_MIN_SIZE:
+            if self.tile_executor is None or pyramid_is_current(path, pyramid_dir(path)):
+                self.load_tiled_image(TilePyramid.open(path))
+            else:
+                self.load_tiled_image_later(path, width, height)
+            return
         im = QtGui.QImage(path)
         self.load_image(im)
 
@@ -50,9 +135,21 @@ class HomographyView(QtWidgets.QGraphicsView):
         return out_points
 
     def update_point_count_status(self, point_list):
+        self.point_count = len(point_list)
+        self._update_status()
+
+    def update_fit_status(self, mean_error):
+        """Shows the mean error of the previewed homography in this image, None to hide it."""
+        self.fit_error = mean_error
+        self._update_status()
+
+    def _update_status(self):
         if self.status_label is None:
             return
-        self.status_label.setText("{} points selected.".format(len(point_list)))
+        text = "{} points selected.".format(self.point_count)
+        if self.fit_error is not None:
+            text += " Mean error: {:.1f} px.".format(self.fit_error)
+        self.status_label.setText(text)
 
 
 class HomographyResultView(QtWidgets.QGraphicsView):
@@ -108,6 +205,8 @@ class HomographyScene(QtWidgets.QGraphicsScene):
 
     Displays image. Places points on image on click.
     """
+    points_changed = QtCore.pyqtSignal()
+
     def __init__(self, parent):
         super(HomographyScene, self).__init__(parent)
         self.points = []
@@ -119,6 +218,10 @@ class HomographyScene(QtWidgets.QGraphicsScene):
         self.point_pen = QtGui.QPen(self.point_pen_color, 6)
         self.point_brush_color = QtGui.QColor(195, 13, 255, 20)  # R, G, B, A
         self.point_brush = QtGui.QBrush(self.point_brush_color)
+        # A click this close to a point's center hits it: the circle including its outline
+        self.point_hit_rad = self.point_rad + self.point_pen.widthF() / 2
+        # Point centers, for finding the clicked point without testing them all
+        self.point_index = PointGrid(self.point_hit_rad)
         self.point_selected = False
         self.selected_point = None
 
@@ -131,6 +234,14 @@ class HomographyScene(QtWidgets.QGraphicsScene):
         self.label_brush_color = QtGui.QColor(255, 255, 255)  # R, G, B
         self.label_brush = QtGui.QBrush(self.label_brush_color)
 
+        # Homography preview configuration. Cosmetic pens keep their width at any zoom.
+        self.preview_pen = QtGui.QPen(QtGui.QColor(0, 114, 178, 230), 2)
+        self.preview_pen.setCosmetic(True)
+        self.preview_error_pen = QtGui.QPen(QtGui.QColor(255, 255, 0, 230), 2)
+        self.preview_error_pen.setCosmetic(True)
+        self.preview_markers = None
+        self.preview_errors = None
+
     def add_point(self, loc):
         """
         Adds a point (QEllipseItem) with a child QSimpleTextItem displaying a numerical index to the
@@ -153,9 +264,12 @@ class HomographyScene(QtWidgets.QGraphicsScene):
         new_text.setParentItem(new_point)
         new_point.setCursor(self.parent().cursor_hover)
         new_point.setFlag(QtWidgets.QGraphicsItem.ItemIsMovable)
+        new_point.setZValue(2)  # Above the homography preview
 
         self.points.append(new_point)
+        self.point_index.insert(new_point, loc[0], loc[1])
         self.update_point_list_status()
+        self.points_changed.emit()
 
     def delete_point(self, point, index):
         """
@@ -164,26 +278,31 @@ class HomographyScene(QtWidgets.QGraphicsScene):
         following points with new labels.
         """
         self.removeItem(point)
+        self.point_index.remove(point)
         del self.points[index]
         # Amend following points' indices
-        need_update = self.points[index:]
-        offset = 0
-        for pt in need_update:
+        redraw_box = QtCore.QRectF()
+        for (offset, pt) in enumerate(self.points[index:]):
             pt.homography_index = index + offset
             text_box = pt.childItems()[0]
-            redraw_box = text_box.boundingRect()
-            pt.childItems()[0].setText("{}".format(pt.homography_index + 1))
-            self.update(redraw_box)  # Get rid of text artifacts. These can occur when changing from 10 to 9, for example.
-            offset += 1
+            redraw_box |= text_box.sceneBoundingRect()  # Old extent, the new label can be narrower
+            text_box.setText("{}".format(pt.homography_index + 1))
+        if not redraw_box.isNull():
+            # One repaint for all labels. Gets rid of text artifacts, which can
+            # occur when changing from 10 to 9, for example.
+            self.update(redraw_box)
         self.update_point_list_status()
+        self.points_changed.emit()
 
     def mouseReleaseEvent(self, event):
         super(HomographyScene, self).mouseReleaseEvent(event)
         if self.point_selected:
+            self._index_point(self.selected_point)
             # Note that we are no longer moving a point.
             self.selected_point.setCursor(self.parent().cursor_hover)
             self.point_selected = False
             self.selected_point = None
+            self.points_changed.emit()
 
     def mousePressEvent(self, event):
         super(HomographyScene, self).mousePressEvent(event)
@@ -202,16 +321,24 @@ class HomographyScene(QtWidgets.QGraphicsScene):
 
     def mouseMoveEvent(self, event):
         super(HomographyScene, self).mousePressEvent(event)
+        if self.point_selected:
+            self._index_point(self.selected_point)
+            self.points_changed.emit()
 
     def find_clicked_point(self, click_loc):
         """
-        Searches placed points and returns a point if the user has clicked it.
-        Else returns False.
+        Returns the point clicked at click_loc (x, y) with its index in self.points,
+        the nearest one if points overlap. Else returns False, None.
         """
-        for i, point in enumerate(self.points):
-            if point.isUnderMouse():
-                return point, i
-        return False, None
+        point = self.point_index.nearest(click_loc[0], click_loc[1], self.point_hit_rad)
+        if point is None:
+            return False, None
+        return point, point.homography_index
+
+    def _index_point(self, point):
+        # Points are positioned by the corner of their bounding box
+        pos = point.pos()
+        self.point_index.move(point, pos.x() + self.point_rad, pos.y() + self.point_rad)
 
     def update_point_list_status(self):
         """
@@ -223,6 +350,39 @@ class HomographyScene(QtWidgets.QGraphicsScene):
     def register_pixmap(self, pixmap):
         self.main_pixmap_item = pixmap
 
+    def show_preview(self, actual, predicted):
+        """
+        Draws a marker where each point is predicted to be and a line to it from
+        the point's actual position. Both are lists of (x, y) in the coordinates
+        returned by HomographyView.list_points().
+        """
+        if self.preview_markers is None:
+            # Two path items however many points there are
+            self.preview_errors = self.addPath(QtGui.QPainterPath(), self.preview_error_pen)
+            self.preview_markers = self.addPath(QtGui.QPainterPath(), self.preview_pen)
+            for item in (self.preview_errors, self.preview_markers):
+                item.setZValue(1)
+                item.setAcceptedMouseButtons(Qt.NoButton)
+
+        # Points are positioned by the corner of their bounding box
+        marker_rad = self.point_rad / 2.0
+        markers = QtGui.QPainterPath()
+        errors = QtGui.QPainterPath()
+        for ((ax, ay), (px, py)) in zip(actual, predicted):
+            if not np.isfinite([px, py]).all():
+                continue  # Sent to infinity by a bad fit
+            ax, ay, px, py = ax + self.point_rad, ay + self.point_rad, px + self.point_rad, py + self.point_rad
+            markers.addEllipse(QtCore.QPointF(px, py), marker_rad, marker_rad)
+            errors.moveTo(ax, ay)
+            errors.lineTo(px, py)
+        self.preview_markers.setPath(markers)
+        self.preview_errors.setPath(errors)
+
+    def clear_preview(self):
+        if self.preview_markers is not None:
+            self.preview_markers.setPath(QtGui.QPainterPath())
+            self.preview_errors.setPath(QtGui.QPainterPath())
+
     @staticmethod
     def click_is_within(ellipse_rect, click):
         """
@@ -239,3 +399,62 @@ class HomographyScene(QtWidgets.QGraphicsScene):
                 return False
         else:
             return False
+
+
+class HomographyPreview(QtCore.QObject):
+    """Keeps a homography between the points of two HomographyViews up to date.
+
+    Every time a point is added, moved or deleted in either view, the homography
+    from the camera points to the aerial points is fitted again, at most once
+    per frame. Each view then shows where the other view's points land in it,
+    with a line to the point they should match, and its mean error in pixels.
+    """
+    # Milliseconds between refits while points are being dragged
+    FRAME_INTERVAL = 16
+
+    def __init__(self, camera_view, aerial_view, parent=None):
+        super(HomographyPreview, self).__init__(parent)
+        self.camera_view = camera_view
+        self.aerial_view = aerial_view
+        self.homography = None  # Maps camera image pixels to aerial image pixels
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.FRAME_INTERVAL)
+        self.timer.timeout.connect(self.refit)
+        camera_view.points_changed.connect(self.schedule_refit)
+        aerial_view.points_changed.connect(self.schedule_refit)
+
+    def schedule_refit(self):
+        # Changes arriving before the timer fires share one refit
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def refit(self):
+        if not (self.camera_view.image_loaded and self.aerial_view.image_loaded):
+            return
+        camera_pts = np.array(self.camera_view.list_points(), dtype=np.float64).reshape(-1, 2)
+        aerial_pts = np.array(self.aerial_view.list_points(), dtype=np.float64).reshape(-1, 2)
+
+        self.homography = None
+        if len(camera_pts) == len(aerial_pts) and len(camera_pts) >= 4:
+            try:
+                self.homography, aerial_errors, _ = find_homography(camera_pts, aerial_pts)
+                inverse = np.linalg.inv(self.homography)
+            except (HomographyError, np.linalg.LinAlgError):
+                self.homography = None
+        if self.homography is None:
+            self.clear()
+            return
+
+        camera_errors = reprojection_errors(inverse, aerial_pts, camera_pts)
+        self.camera_view.scene().show_preview(camera_pts, projectArray(inverse, aerial_pts.T).T)
+        self.aerial_view.scene().show_preview(aerial_pts, projectArray(self.homography, camera_pts.T).T)
+        self.camera_view.update_fit_status(camera_errors.mean())
+        self.aerial_view.update_fit_status(aerial_errors.mean())
+
+    def clear(self):
+        for view in (self.camera_view, self.aerial_view):
+            if view.image_loaded:
+                view.scene().clear_preview()
+            view.update_fit_status(None)
@@ -0,0 +1,44 @@
+"""
+Hands work from worker threads to the Qt main thread, where widgets may be
+touched. install() makes the done callbacks of API futures run there.
+"""
+from threading import Lock
+from PyQt5 import QtCore
+
+from cloud_api import APIExecutor
+
+
+class _MainThreadInvoker(QtCore.QObject):
+    """Runs functions on the thread that owns the QApplication via a queued signal."""
+    invoke = QtCore.pyqtSignal(object)
+
+    def __init__(self):
+        super(_MainThreadInvoker, self).__init__()
+        self.invoke.connect(self._run)
+
+    def _run(self, function):
+        function()
+
+_invoker = None
+_invoker_lock = Lock()
+
+def call_on_main_thread(function, *args, **kwargs):
+    """
+    Calls function on the Qt main thread. When called from the main thread this
+    calls it immediately. Without a running QApplication (e.g. scripts) it is
+    called on the current thread.
+    """
+    global _invoker
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        function(*args, **kwargs)
+        return
+    with _invoker_lock:
+        if _invoker is None:
+            _invoker = _MainThreadInvoker()
+            _invoker.moveToThread(app.thread())
+    _invoker.invoke.emit(lambda: function(*args, **kwargs))
+
+def install():
+    """Runs the done callbacks of every APIFuture on the Qt main thread."""
+    APIExecutor.set_callback_dispatcher(call_on_main_thread)
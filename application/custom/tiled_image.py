@@ -0,0 +1,69 @@
+# tiled_image.py
+import ctypes
+from PyQt5 import QtGui, QtWidgets, QtCore
+try:
+    from PyQt5 import sip
+except ImportError:
+    import sip
+
+from utils.raw_image import RawImage
+from utils.tile_pyramid import TileCache
+
+
+def raw_qimage(raw, level=0, x=0, y=0, width=None, height=None):
+    """
+    QImage of the (x, y, width, height) area of level of a RawImage (the
+    whole level by default) that points into the mapped file: nothing is
+    decoded or copied. raw must stay open while the QImage is used.
+    """
+    level_width, level_height = raw.level_size(level)
+    width = level_width - x if width is None else width
+    height = level_height - y if height is None else height
+    address = ctypes.addressof(ctypes.c_char.from_buffer(raw.mmap)) + raw.offset(level, x, y)
+    return QtGui.QImage(sip.voidptr(address), width, height, raw.bytes_per_line(level),
+                        QtGui.QImage.Format_RGBA8888)
+
+
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    """QGraphicsItem drawing a TilePyramid or a RawImage in place of a
+    QGraphicsPixmapItem.
+
+    The item is as big as the full image, with its top left corner at (0,0),
+    but only the tiles of the exposed area are drawn, taken from the level
+    whose resolution matches the current zoom. Tiles are loaded when first
+    drawn: decoded from their files for a TilePyramid, copied straight out of
+    the mapped file for a RawImage.
+    """
+    def __init__(self, pyramid, cache=None, parent=None):
+        super(TiledImageItem, self).__init__(parent)
+        self.pyramid = pyramid
+        self.cache = cache or TileCache()
+        # Needed for option.exposedRect
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def width(self):
+        return self.pyramid.width
+
+    def height(self):
+        return self.pyramid.height
+
+    def boundingRect(self):
+        return QtCore.QRectF(0, 0, self.pyramid.width, self.pyramid.height)
+
+    def paint(self, painter, option, widget=None):
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.pyramid.level_for_scale(scale)
+        exposed = option.exposedRect
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, True)
+        for (col, row, (x, y, w, h)) in self.pyramid.tiles_in(level, exposed.left(), exposed.top(),\
+                                                             exposed.right(), exposed.bottom()):
+            pixmap = self.cache.get((level, col, row), lambda: self._load_tile(level, col, row, w, h))
+            painter.drawPixmap(QtCore.QRectF(x, y, w, h), pixmap, QtCore.QRectF(pixmap.rect()))
+
+    def _load_tile(self, level, col, row, w, h):
+        if isinstance(self.pyramid, RawImage):
+            scale = 2 ** level
+            size = self.pyramid.tile_size
+            return QtGui.QPixmap.fromImage(raw_qimage(self.pyramid, level, col * size, row * size,
+                                                      int(w // scale), int(h // scale)))
+        return QtGui.QPixmap(self.pyramid.tile_path(level, col, row))
@@ -9,7 +9,7 @@ import re
 from ConfigParser import SafeConfigParser, NoSectionError, NoOptionError
 import time
 import datetime
-from shutil import copy, rmtree
+from shutil import rmtree
 try:
     from PIL import Image
 except:
@@ -17,10 +17,16 @@ except:
 import numpy as np
 
 from app_config import AppConfig as ac
-from app_config import get_default_project_dir, get_project_path, get_config_path, config_section_exists, get_config_with_sections, update_config_with_sections
-from cloud_api import api
+from app_config import get_default_project_dir, get_project_path, get_config_path, get_identifier, config_section_exists, get_config_with_sections, update_config_with_sections, get_video_storage_modes, get_project_video_path, config_transaction, write_config, flush_config
+from cloud_api import api, api_executor, async_api, coroutine, UPLOAD_CHUNK_SIZE
+from custom.main_thread import call_on_main_thread
 import message_helper
 from video import save_video_frame
+from utils.file_copy import store_file
+from utils.tee_reader import TeeReader, HashConsumer, FileConsumer
+from utils.tile_pyramid import open_large_image, build_pyramid, pyramid_dir
+from utils.raw_image import write_raw_image, RAW_IMAGE_MAX_PIXELS
+from threading import Lock
 
 class ProjectWizard(QtWidgets.QWizard):
 
@@ -43,10 +49,12 @@ class ProjectWizard(QtWidgets.QWizard):
         # Don't show 'Cancel' button
         self.setOption(QtWidgets.QWizard.NoCancelButton)
 
-        self.ui.newp_start_creation.clicked.connect(self.start_create_project)
+        self.ui.newp_start_creation.clicked.connect(self.creation_button_clicked)
         self.config_parser = SafeConfigParser()
 
         self.creating_project = False
+        self.creation = None
+        self.cancel_requested = False
 
         self.ui.newp_p1.registerField("project_name*", self.ui.newp_projectname_input)
 
@@ -151,7 +159,29 @@ class ProjectWizard(QtWidgets.QWizard):
             self.config_parser = SafeConfigParser()
             self.create_project_dir()
 
+    def creation_button_clicked(self):
+        # The same button starts project creation and cancels it
+        if self.creating_project:
+            self.cancel_create_project()
+        else:
+            self.start_create_project()
+
+    def cancel_create_project(self):
+        if self.creating_project and self.creation is not None and not self.creation.cancelled:
+            self.cancel_requested = True
+            self.ui.newp_creation_status.setText("Cancelling...")
+            self.creation.cancel()
+
+    def reject(self):
+        # Closing the wizard stops a project that is being created
+        self.cancel_create_project()
+        super(ProjectWizard, self).reject()
+
+    @coroutine
     def create_project_dir(self):
+        # Stop downloads and status polling for the project being closed
+        api.cancel_all(get_identifier())
+
         project_name = str(self.ui.newp_projectname_input.text())
         ac.CURRENT_PROJECT_PATH = os.path.join(get_default_project_dir(), project_name)
         directory_names = ["homography", "results"]
@@ -160,46 +190,86 @@ class ProjectWizard(QtWidgets.QWizard):
         progress_msg = self.ui.newp_creation_status
         progress_bar = self.ui.newp_creation_progress
 
+        self.creation = None
+        self.cancel_requested = False
+
         # Update UI while creating
         self._update_ui_for_project_creation()
 
-        if not os.path.exists(pr_path):
+        # A previous attempt that was interrupted mid-upload can be picked up again
+        resuming = os.path.exists(pr_path) and api.has_pending_upload(pr_path, self.videopath)
+
+        if not os.path.exists(pr_path) or resuming:
+            # Everything below stops when this is cancelled
+            self.creation = api.operation(pr_path)
+
             # Set URL to use before doing anything
             server = str(self.ui.newp_video_server_input.text())
             update_api(server)
 
-            progress_msg.setText("Creating project directories...")
-            progress_bar.show()
-            for new_dir in directory_names:
-                progress_bar.setValue(progress_bar.value() + 5)
-                os.makedirs(os.path.join(pr_path, new_dir))
-
-            progress_bar.setValue(progress_bar.value() + 5)
-            progress_msg.setText("Writing configuration files...")
-            self._write_to_project_config()
-
-            progress_msg.setText("Copying video file...")
             video_extension = self.videopath.split('.')[-1]
             video_dest = os.path.join(pr_path, 'video.' + video_extension)
-            copy(self.videopath, video_dest)
 
-            progress_msg.setText("Uploading video file...")
-            success, err, identifier = api.uploadVideo(self.videopath)
-            if not success:
-                self._project_creation_error(err, project_name_to_delete=project_name)
+            progress_bar.show()
+            if not resuming:
+                progress_msg.setText("Creating project directories...")
+                for new_dir in directory_names:
+                    progress_bar.setValue(progress_bar.value() + 5)
+                    os.makedirs(os.path.join(pr_path, new_dir))
+
+                progress_bar.setValue(progress_bar.value() + 5)
+                progress_msg.setText("Writing configuration files...")
+                yield self._write_to_project_config()
+                if self.cancel_requested:
+                    self._project_creation_cancelled(project_name)
+                    return
+            progress_bar.setValue(15)
+
+            # Storing and uploading the video and extracting the camera image
+            # don't depend on each other, so they run at the same time on the
+            # API worker threads
+            progress = CreationProgress(progress_bar, progress_msg, 15, 95)
+            steps = {
+                'upload': (self._upload_video, (pr_path, video_dest, progress)),
+                'frame': (self._extract_camera_image, (os.path.join(pr_path, "homography", "camera.png"), progress)),
+                'aerial': (self._save_aerial_image, (os.path.join(pr_path, "homography", "aerial.png"), progress))
+            }
+            futures = dict((name, self._start_step(name, function, args, progress))\
+                           for (name, (function, args)) in steps.iteritems())
+
+            try:
+                yield futures.values()
+            except Exception:
+                # Every step has stopped by now, their errors are looked at below
+                pass
+
+            if self.cancel_requested:
+                self._project_creation_cancelled(project_name)
+                return
+
+            errors = dict((name, _step_error(future)) for (name, future) in futures.iteritems())
+            if errors['upload'] is None and not futures['upload'].result()[0]:
+                errors['upload'] = futures['upload'].result()[1]
+            if any(errors.values()):
+                # Steps stopped because another one failed only report being cancelled
+                failed = [name for name in sorted(errors) if errors[name] not in (None, 'Operation cancelled')]
+                failed = failed or [name for name in sorted(errors) if errors[name] is not None]
+                if 'upload' in failed and api.has_pending_upload(pr_path, self.videopath):
+                    # Keep the project directory so the confirmed parts are not sent again
+                    err = "{}\n\nThe upload was interrupted. Create the project again with the same name and video to resume it.".format(errors['upload'])
+                    self._project_creation_error(err)
+                else:
+                    self._project_creation_error(errors[failed[0]], project_name_to_delete=project_name)
                 return
-            update_config_with_sections(get_config_path(), 'info', 'identifier', identifier)
-            progress_bar.setValue(80)
-
-            progress_msg.setText("Extracting camera image...")
-            out_path = os.path.join(pr_path, "homography", "camera.png")
-            save_video_frame(video_dest, out_path)
-            progress_bar.setValue(90)
-
-            progress_msg.setText("Copying aerial image...")
-            im = Image.open(self.aerialpath)
-            aerial_dest = os.path.join(pr_path, "homography", "aerial.png")
-            im.save(aerial_dest)
+
+            _, _, identifier, content_hash, storage = futures['upload'].result()
+            with config_transaction(get_config_path()):
+                if storage is not None:
+                    self._write_video_storage(storage)
+                update_config_with_sections(get_config_path(), 'video', 'sha256', content_hash)
+                update_config_with_sections(get_config_path(), 'info', 'identifier', identifier)
+            # Without the identifier the project is lost, so don't wait for it to be written
+            flush_config(get_config_path())
             progress_bar.setValue(95)
             progress_msg.setText("Complete.")
 
@@ -217,6 +287,117 @@ class ProjectWizard(QtWidgets.QWizard):
             self._project_creation_error("Project exists. No new project created.")
             return
 
+    def _start_step(self, name, function, args, progress):
+        progress.set_running(name, True)
+        future = api_executor.submit(self.creation.run, function, *args)
+        self.creation.add_future(future)
+
+        def done(future):
+            progress.set_running(name, False)
+            failed = _step_error(future) is not None or (name == 'upload' and not future.result()[0])
+            if failed:
+                # No point finishing the other steps
+                self.creation.cancel()
+        future.add_done_callback(done)
+        return future
+
+    # The steps below run on worker threads. They report progress through
+    # progress, which may be called from any thread, and stop when
+    # self.creation is cancelled.
+
+    def _upload_video(self, pr_path, video_dest, progress):
+        """
+        Returns (success, err, identifier, content_hash, storage), storage being
+        the mode the video was stored with or None if it already was.
+
+        The video is read once: the same pass hashes it, sends the upload parts
+        and, if it can't be linked or referenced, writes the project copy.
+        """
+        consumers = []
+        storage = None
+        # An interrupted copy leaves no file behind, so this also covers resuming
+        if not os.path.exists(video_dest):
+            modes = get_video_storage_modes()
+            try:
+                storage = store_file(self.videopath, video_dest, modes=[m for m in modes if m != 'copy'])
+                print("Stored project video as a {} at {}".format(storage,\
+                    self.videopath if storage == 'reference' else video_dest))
+            except ValueError:
+                # Only when 'reference' isn't one of the modes
+                if 'copy' not in modes:
+                    raise
+                storage = 'copy'
+                consumers.append(FileConsumer(video_dest, mode_from=self.videopath))
+        if not consumers:
+            progress.update('copy', 1)
+
+        def read_progress(read, total):
+            self.creation.check()
+            fraction = float(read) / max(total, 1)
+            progress.update('hash', fraction)
+            if consumers:
+                progress.update('copy', fraction)
+
+        def upload_progress(sent, total):
+            progress.update('upload', float(sent) / max(total, 1))
+
+        reader = TeeReader(self.videopath, block_size=UPLOAD_CHUNK_SIZE,\
+                           consumers=[HashConsumer()] + consumers,\
+                           progress_callback=read_progress)
+        try:
+            # Footage uploaded before doesn't have to be read to be recognised:
+            # with its hash, a server that already has it makes a new project
+            # on its stored copy instead of receiving it again
+            content_hash = api.knownVideoHash(self.videopath)
+            success, err, identifier = api.uploadVideoChunked(self.videopath, pr_path,\
+                                            progress_callback=upload_progress,\
+                                            content_hash=content_hash,\
+                                            reader=reader)
+            # The server may know the video without having been sent any of it,
+            # the copy still needs the rest of the file
+            if success and consumers and not reader.closed:
+                reader.read_all()
+        finally:
+            reader.close()
+
+        content_hash = content_hash or reader.hexdigest
+        if success and content_hash:
+            api.rememberVideoHash(self.videopath, content_hash)
+        return (success, err, identifier, content_hash, storage)
+
+    def _extract_camera_image(self, out_path, progress):
+        # The source video can be read while it is being uploaded
+        save_video_frame(self.videopath, out_path)
+        self.creation.check()
+        write_raw_image(out_path)
+        progress.update('frame', 1)
+
+    def _save_aerial_image(self, aerial_dest, progress):
+        im = open_large_image(self.aerialpath)
+        im.save(aerial_dest)
+        # Written now, from the already decoded image, so the aerial image is
+        # never decoded again when the project is opened. Images too big for a
+        # raw copy get their tile pyramid instead.
+        progress.update('aerial', 0.5)
+        def level_progress(done, levels):
+            self.creation.check()
+            progress.update('aerial', 0.5 + 0.5 * done / levels)
+        width, height = im.size
+        if width * height <= RAW_IMAGE_MAX_PIXELS:
+            write_raw_image(aerial_dest, progress_callback=level_progress, image=im)
+        else:
+            build_pyramid(aerial_dest, pyramid_dir(aerial_dest), progress_callback=level_progress, image=im)
+        progress.update('aerial', 1)
+
+    def _write_video_storage(self, mode):
+        config_path = get_config_path()
+        update_config_with_sections(config_path, 'video', 'storage', mode)
+        if mode == 'reference':
+            # Lets the project notice if the original video changes or goes away
+            stat = os.stat(self.videopath)
+            update_config_with_sections(config_path, 'video', 'source', os.path.abspath(self.videopath))
+            update_config_with_sections(config_path, 'video', 'size', str(stat.st_size))
+            update_config_with_sections(config_path, 'video', 'mtime', str(int(stat.st_mtime)))
 
     def _update_ui_for_project_creation(self):
         progress_bar = self.ui.newp_creation_progress
@@ -225,7 +406,10 @@ class ProjectWizard(QtWidgets.QWizard):
         progress_msg = self.ui.newp_creation_status
         progress_msg.setHidden(not self.creating_project)
         creation_button = self.ui.newp_start_creation
-        creation_button.setHidden(self.creating_project)
+        if self.creating_project:
+            creation_button.setText("Cancel project creation")
+        else:
+            creation_button.setText("Click to send project to server")
 
     def _project_creation_error(self, error, project_name_to_delete=None):
         ac.CURRENT_PROJECT_PATH = None
@@ -237,6 +421,15 @@ class ProjectWizard(QtWidgets.QWizard):
             path = os.path.join(get_default_project_dir(), project_name_to_delete)
             rmtree(path)
 
+    def _project_creation_cancelled(self, project_name):
+        ac.CURRENT_PROJECT_PATH = None
+        self.creating_project = False
+        self._update_ui_for_project_creation()
+        path = os.path.join(get_default_project_dir(), project_name)
+        if os.path.exists(path):
+            rmtree(path)
+
+    @coroutine
     def _write_to_project_config(self):
         ts = time.time()
         vid_ts = self.ui.newp_video_start_time_input.dateTime().toPyDateTime()
@@ -257,20 +450,92 @@ class ProjectWizard(QtWidgets.QWizard):
         self.config_parser.set("video", "start", video_timestamp)
 
         self.config_parser.add_section("config")
-        success, _, config = api.defaultConfig()
+        success, _, config = yield async_api.defaultConfig()
 
         # If we can't get defaults, don't worry. Server fills them in anyway.
         if success:
             for (key, value) in config.iteritems():
                 self.config_parser.set("config", key, str(value))
 
-        with open(os.path.join(get_config_path()), 'wb') as configfile:
-            self.config_parser.write(configfile)
+        write_config(get_config_path(), self.config_parser)
 
     def load_new_project(self):
         load_project(ac.CURRENT_PROJECT_PATH, self.parent())
 
+def _step_error(future):
+    # Error message of a finished project creation step, or None
+    if future.cancelled():
+        return 'Operation cancelled'
+    exception = future.exception()
+    if exception is not None:
+        return str(exception) or exception.__class__.__name__
+    return None
+
+class CreationProgress(object):
+    """
+    Shows the combined progress of project creation steps that run at the same
+    time as one bar between start and end. Steps may report from any thread;
+    the bar and message are updated on the main thread.
+    """
+    # Share of the bar each step gets
+    WEIGHTS = {'copy': 20, 'hash': 10, 'upload': 55, 'frame': 5, 'aerial': 5}
+    MESSAGES = {
+        'upload': 'uploading video file',
+        'frame': 'extracting camera image',
+        'aerial': 'copying aerial image'
+    }
+
+    def __init__(self, progress_bar, progress_msg, start, end):
+        self.progress_bar = progress_bar
+        self.progress_msg = progress_msg
+        self.start = start
+        self.end = end
+        self._done = dict((step, 0.0) for step in self.WEIGHTS)
+        self._running = set()
+        self._lock = Lock()
+        self._refresh_pending = False
+
+    def update(self, step, fraction):
+        with self._lock:
+            self._done[step] = min(1.0, fraction)
+        self._schedule_refresh()
+
+    def set_running(self, step, running):
+        with self._lock:
+            if running:
+                self._running.add(step)
+            else:
+                self._running.discard(step)
+                self._done[step] = 1.0
+                if step == 'upload':
+                    # Hashing and copying happen while uploading
+                    self._done['hash'] = self._done['copy'] = 1.0
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        # At most one refresh waits in the event queue however often steps report
+        with self._lock:
+            if self._refresh_pending:
+                return
+            self._refresh_pending = True
+        call_on_main_thread(self._refresh)
+
+    def _refresh(self):
+        with self._lock:
+            self._refresh_pending = False
+            total = sum(self.WEIGHTS.values())
+            done = sum(weight * self._done[step] for (step, weight) in self.WEIGHTS.iteritems())
+            running = [self.MESSAGES[step] for step in sorted(self._running) if step in self.MESSAGES]
+        self.progress_bar.setValue(self.start + int((self.end - self.start) * done / total))
+        if running:
+            message = ', '.join(running)
+            self.progress_msg.setText(message[0].upper() + message[1:] + '...')
+
 def load_project(project_path, main_window):
+    # Stop downloads and status polling for the project being closed
+    if ac.CURRENT_PROJECT_PATH and ac.CURRENT_PROJECT_PATH != project_path:
+        api.cancel_all(get_identifier())
+
     ac.CURRENT_PROJECT_PATH = project_path
 
     load_homography(main_window)
@@ -281,6 +546,23 @@ def load_project(project_path, main_window):
 
     load_config(main_window)
 
+    check_project_video(project_path, main_window)
+
+def check_project_video(project_path, main_window):
+    """
+    Warns if the project's video is gone. A project that references the
+    original video instead of holding a copy breaks when it is moved or edited.
+    Checked on a worker thread, since a touched video is hashed again.
+    """
+    future = api_executor.submit(get_project_video_path, project_path)
+
+    def done(future):
+        if ac.CURRENT_PROJECT_PATH != project_path or future.exception() is not None:
+            return
+        if future.result() is None:
+            main_window.show_message("The video of this project is missing or has changed since the project was created.", error=True)
+    future.add_done_callback(done)
+
 def loadPointCorrespondences(filename):
     '''Loads and returns the corresponding points in world (first 2 lines) and image spaces (last 2 lines)'''
     points = np.loadtxt(filename, dtype=np.float32)
@@ -0,0 +1,61 @@
+"""
+Base class for tests that run the API client against utils.stub_server.
+
+Run the tests from this directory with:
+    python -m unittest discover -p 'test_*.py'
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from app_config import AppConfig
+from cloud_api import CloudWizard, RetryPolicy
+from utils.stub_server import StubServer
+
+
+class StubServerTestCase(unittest.TestCase):
+    """
+    Starts a StubServer on a free port for every test, with self.wizard, a
+    CloudWizard talking to it. The upload index and artifact cache live in
+    self.tmp_dir instead of the user's Documents folder. Retries back off for
+    milliseconds rather than seconds.
+
+    Subclasses can set server_options to keyword arguments for StubServer.
+    """
+    server_options = {}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='santos_test_')
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+
+        saved = (AppConfig.UPLOAD_INDEX_PATH, AppConfig.ARTIFACT_CACHE_DIR)
+        def restore():
+            AppConfig.UPLOAD_INDEX_PATH, AppConfig.ARTIFACT_CACHE_DIR = saved
+        self.addCleanup(restore)
+        AppConfig.UPLOAD_INDEX_PATH = os.path.join(self.tmp_dir, 'upload_index.json')
+        AppConfig.ARTIFACT_CACHE_DIR = os.path.join(self.tmp_dir, 'artifact_cache')
+
+        self.server = StubServer(0, **self.server_options)
+        self.server.start_in_thread()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.state = self.server.state
+
+        self.wizard = self.make_wizard()
+        self.addCleanup(self.wizard.close)
+
+    def make_wizard(self, **kwargs):
+        kwargs.setdefault('retry_policy', RetryPolicy(base_delay=0.01, max_delay=0.05))
+        return CloudWizard('127.0.0.1', port=self.server.server_address[1], **kwargs)
+
+    def make_file(self, name, size):
+        """Writes size random bytes to name in self.tmp_dir and returns its path."""
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
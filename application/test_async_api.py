@@ -0,0 +1,132 @@
+import time
+import threading
+import unittest
+
+from cloud_api import AsyncCloudWizard, APIExecutor, CancelledError, Operation
+
+TIMEOUT = 5
+
+
+class FakeWizard(object):
+    """Records the order calls ran in. Calls to a blocked identifier wait until it's released."""
+
+    def __init__(self):
+        self.calls = []
+        self.blocked = {}
+
+    def block(self, identifier):
+        self.blocked[identifier] = threading.Event()
+
+    def release(self, identifier):
+        self.blocked.pop(identifier).set()
+
+    def wait_for_call(self, name):
+        deadline = time.time() + TIMEOUT
+        while name not in self.calls and time.time() < deadline:
+            time.sleep(0.01)
+
+    def work(self, identifier, name):
+        self.calls.append(name)
+        event = self.blocked.get(identifier)
+        if event is not None:
+            event.wait(TIMEOUT)
+        return (True, None, name)
+
+    def streamProjectStatus(self, identifier, on_status):
+        self.calls.append('stream')
+        event = self.blocked.get('stream')
+        if event is not None:
+            event.wait(TIMEOUT)
+        return (True, None, 'stream')
+
+    def fail(self, identifier):
+        raise ValueError('failed')
+
+    def cancel_all(self, identifier):
+        for operation in Operation.for_identifier(identifier):
+            operation.cancel()
+
+    def check_url(self):
+        return (True, None, 'checked')
+
+
+class AsyncCloudWizardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = APIExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+        self.wizard = FakeWizard()
+        self.addCleanup(lambda: [event.set() for event in self.wizard.blocked.values()])
+        self.async_api = AsyncCloudWizard(self.wizard, self.executor)
+
+    def test_calls_for_a_project_run_in_order(self):
+        futures = [self.async_api.work('a', i) for i in range(5)]
+
+        results = [future.result(TIMEOUT) for future in futures]
+
+        self.assertEqual([data for (_, _, data) in results], range(5))
+        self.assertEqual(self.wizard.calls, range(5))
+
+    def test_waiting_calls_dont_hold_a_worker(self):
+        self.wizard.block('a')
+        first = self.async_api.work('a', 'first')
+        second = self.async_api.work('a', 'second')
+        self.wizard.wait_for_call('first')
+
+        # One worker is busy with first, and second waits without taking the
+        # other one
+        other = self.async_api.work('b', 'other')
+        self.assertEqual(other.result(TIMEOUT)[2], 'other')
+        self.assertFalse(second.running() or second.done())
+
+        self.wizard.release('a')
+        self.assertEqual(second.result(TIMEOUT)[2], 'second')
+        self.assertEqual(self.wizard.calls, ['first', 'other', 'second'])
+        self.assertTrue(first.done())
+
+    def test_failed_call_doesnt_stop_the_next(self):
+        failed = self.async_api.fail('a')
+        after = self.async_api.work('a', 'after')
+
+        self.assertEqual(after.result(TIMEOUT)[2], 'after')
+        self.assertIsInstance(failed.exception(), ValueError)
+
+    def test_cancelled_call_never_runs(self):
+        self.wizard.block('a')
+        first = self.async_api.work('a', 'first')
+        second = self.async_api.work('a', 'second')
+        self.wizard.wait_for_call('first')
+
+        self.async_api.cancel_all('a')
+        self.wizard.release('a')
+
+        first.result(TIMEOUT)
+        self.assertTrue(second.cancelled())
+        self.assertRaises(CancelledError, second.result, TIMEOUT)
+        # Later calls still run
+        self.assertEqual(self.async_api.work('a', 'third').result(TIMEOUT)[2], 'third')
+        self.assertEqual(self.wizard.calls, ['first', 'third'])
+
+    def test_status_stream_doesnt_hold_up_the_project(self):
+        self.wizard.block('stream')
+        stream = self.async_api.streamProjectStatus('watched', None)
+        self.wizard.wait_for_call('stream')
+
+        # Calls made while the stream runs don't wait for it to end
+        self.assertEqual(self.async_api.work('watched', 'work').result(TIMEOUT)[2], 'work')
+        self.assertFalse(stream.done())
+        # It still runs under an Operation for the project
+        self.assertEqual(len(Operation.for_identifier('watched')), 1)
+
+        self.wizard.release('stream')
+        self.assertEqual(stream.result(TIMEOUT)[2], 'stream')
+        self.assertEqual(self.wizard.calls, ['stream', 'work'])
+
+    def test_local_methods_are_called_directly(self):
+        self.assertEqual(self.async_api.cancel_all, self.wizard.cancel_all)
+        # Other methods with an underscore in their name still run on the executor
+        self.assertEqual(self.async_api.check_url().result(TIMEOUT), (True, None, 'checked'))
+
+
+if __name__ == '__main__':
+    unittest.main()
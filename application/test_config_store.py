@@ -0,0 +1,344 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from ConfigParser import SafeConfigParser
+
+from app_config import update_config_with_sections, get_config_with_sections,\
+    config_transaction, flush_config
+from utils import config_store as config_store_module
+from utils.config_store import ConfigStore, config_store, flush_all
+
+WRITE_DELAY = 0.05
+TIMEOUT = 5
+
+
+def read_file(path):
+    parser = SafeConfigParser()
+    parser.read(path)
+    return parser
+
+
+def edit_file(path, section, option, value):
+    """Changes path the way another program would, making sure its mtime moves."""
+    parser = read_file(path)
+    if not parser.has_section(section):
+        parser.add_section(section)
+    parser.set(section, option, value)
+    mtime = os.path.getmtime(path) + 1 if os.path.exists(path) else time.time()
+    with open(path, 'w') as f:
+        parser.write(f)
+    os.utime(path, (mtime, mtime))
+
+
+class ConfigStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='santos_test_')
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.path = os.path.join(self.tmp_dir, 'config.cfg')
+        with open(self.path, 'w') as f:
+            f.write('[info]\nname = project\n')
+
+    def make_store(self, write_delay=WRITE_DELAY):
+        """A store that counts its writes in self.writes."""
+        store = ConfigStore(self.path, write_delay=write_delay)
+        self.addCleanup(store.flush)
+        self.writes = []
+        write = store._write
+        def counting_write():
+            self.writes.append(time.time())
+            write()
+        store._write = counting_write
+        return store
+
+    def wait_for_write(self, count=1):
+        deadline = time.time() + TIMEOUT
+        while len(self.writes) < count and time.time() < deadline:
+            time.sleep(0.01)
+        # Give a second write the chance to happen if there was going to be one
+        time.sleep(WRITE_DELAY * 3)
+
+    def tmp_files(self):
+        return [name for name in os.listdir(self.tmp_dir) if name.endswith('.tmp')]
+
+
+class ConfigStoreTest(ConfigStoreTestCase):
+
+    def test_reads_come_from_the_file(self):
+        store = self.make_store()
+
+        self.assertEqual(store.get('info', 'name'), 'project')
+        self.assertIsNone(store.get('info', 'missing'))
+        self.assertIsNone(store.get('missing', 'name'))
+        self.assertTrue(store.has_section('info'))
+
+    def test_changes_share_one_write(self):
+        store = self.make_store()
+
+        store.set('video', 'name', 'video.mp4')
+        store.set('video', 'storage', 'hardlink')
+        store.set('info', 'identifier', 'abc')
+        # Served from memory before they're written
+        self.assertEqual(store.get('video', 'storage'), 'hardlink')
+        self.wait_for_write()
+
+        self.assertEqual(len(self.writes), 1)
+        parser = read_file(self.path)
+        self.assertEqual(parser.get('video', 'name'), 'video.mp4')
+        self.assertEqual(parser.get('video', 'storage'), 'hardlink')
+        self.assertEqual(parser.get('info', 'identifier'), 'abc')
+        self.assertEqual(parser.get('info', 'name'), 'project')
+
+    def test_flush_writes_right_away(self):
+        store = self.make_store(write_delay=60)
+        store.set('info', 'identifier', 'abc')
+
+        store.flush()
+
+        self.assertEqual(read_file(self.path).get('info', 'identifier'), 'abc')
+        store.flush()
+        self.assertEqual(len(self.writes), 1)
+
+    def test_failed_write_leaves_the_old_file(self):
+        store = self.make_store(write_delay=60)
+        with open(self.path, 'r') as f:
+            before = f.read()
+        store.set('info', 'identifier', 'abc')
+
+        def broken_write(f):
+            f.write('[info]\nident')
+            raise IOError('disk full')
+        store._parser.write = broken_write
+        self.assertRaises(IOError, store.flush)
+
+        with open(self.path, 'r') as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(self.tmp_files(), [])
+
+        # The change is still pending and written by the next flush
+        del store._parser.write
+        store.flush()
+        self.assertEqual(read_file(self.path).get('info', 'identifier'), 'abc')
+        self.assertEqual(self.tmp_files(), [])
+
+    def test_write_keeps_the_file_mode(self):
+        os.chmod(self.path, 0o600)
+        store = self.make_store(write_delay=60)
+        store.set('info', 'identifier', 'abc')
+
+        store.flush()
+
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_external_edit_is_read_again(self):
+        store = self.make_store()
+        self.assertEqual(store.get('info', 'name'), 'project')
+
+        edit_file(self.path, 'info', 'name', 'renamed')
+
+        self.assertEqual(store.get('info', 'name'), 'renamed')
+
+    def test_external_edit_merges_with_unwritten_changes(self):
+        store = self.make_store(write_delay=60)
+        store.set('info', 'identifier', 'ours')
+        store.set('info', 'name', 'ours')
+
+        edit_file(self.path, 'info', 'server', 'theirs')
+        edit_file(self.path, 'info', 'name', 'theirs')
+
+        # Their options are kept, ours win where both changed the same one
+        self.assertEqual(store.get('info', 'server'), 'theirs')
+        self.assertEqual(store.get('info', 'identifier'), 'ours')
+        self.assertEqual(store.get('info', 'name'), 'ours')
+        store.flush()
+        parser = read_file(self.path)
+        self.assertEqual(parser.get('info', 'server'), 'theirs')
+        self.assertEqual(parser.get('info', 'identifier'), 'ours')
+
+    def test_deleted_project_drops_changes(self):
+        store = self.make_store(write_delay=60)
+        store.set('info', 'identifier', 'abc')
+        shutil.rmtree(self.tmp_dir)
+
+        store.flush()
+
+        self.assertFalse(os.path.exists(self.tmp_dir))
+
+    def test_replace(self):
+        store = self.make_store(write_delay=60)
+        parser = SafeConfigParser()
+        parser.add_section('video')
+        parser.set('video', 'name', 'video.mp4')
+
+        store.replace(parser)
+
+        self.assertFalse(read_file(self.path).has_section('info'))
+        self.assertEqual(store.get('video', 'name'), 'video.mp4')
+
+
+class ConfigTransactionTest(ConfigStoreTestCase):
+
+    def test_transaction_is_one_write(self):
+        store = self.make_store()
+
+        with store.transaction():
+            store.set('video', 'storage', 'reference')
+            time.sleep(WRITE_DELAY * 2)
+            store.set('video', 'sha256', 'f' * 64)
+            # Nothing is written in the middle of the block
+            self.assertEqual(self.writes, [])
+        self.wait_for_write()
+
+        self.assertEqual(len(self.writes), 1)
+        parser = read_file(self.path)
+        self.assertEqual(parser.get('video', 'storage'), 'reference')
+        self.assertEqual(parser.get('video', 'sha256'), 'f' * 64)
+
+    def test_failed_transaction_keeps_nothing(self):
+        store = self.make_store()
+        store.set('info', 'identifier', 'old')
+
+        try:
+            with store.transaction():
+                store.set('info', 'identifier', 'new')
+                store.set('video', 'storage', 'reference')
+                raise ValueError()
+        except ValueError:
+            pass
+        store.flush()
+
+        self.assertEqual(store.get('info', 'identifier'), 'old')
+        self.assertFalse(store.has_section('video'))
+        parser = read_file(self.path)
+        self.assertEqual(parser.get('info', 'identifier'), 'old')
+        self.assertFalse(parser.has_section('video'))
+
+    def test_other_threads_wait_for_the_transaction(self):
+        store = self.make_store()
+        seen = []
+        reader = threading.Thread(target=lambda: seen.append(\
+            (store.get('video', 'storage'), store.get('video', 'sha256'))))
+
+        with store.transaction():
+            store.set('video', 'storage', 'reference')
+            reader.start()
+            time.sleep(0.1)
+            self.assertEqual(seen, [])
+            store.set('video', 'sha256', 'f' * 64)
+        reader.join(TIMEOUT)
+
+        self.assertEqual(seen, [('reference', 'f' * 64)])
+
+
+class SharedStoresTestCase(ConfigStoreTestCase):
+
+    def setUp(self):
+        super(SharedStoresTestCase, self).setUp()
+        # config_store() keeps one store per path for the whole process
+        saved = dict(config_store_module._stores)
+        def restore():
+            config_store_module._stores.clear()
+            config_store_module._stores.update(saved)
+        self.addCleanup(restore)
+
+
+class SharedStoresTest(SharedStoresTestCase):
+
+    def test_one_store_per_file(self):
+        self.assertIs(config_store(self.path), config_store(os.path.join(self.tmp_dir, '.', 'config.cfg')))
+
+    def test_flush_all_writes_pending_changes(self):
+        store = config_store(self.path)
+        store.write_delay = 60
+        store.set('info', 'identifier', 'abc')
+
+        flush_all()
+
+        self.assertEqual(read_file(self.path).get('info', 'identifier'), 'abc')
+
+
+class ProjectConfigTest(SharedStoresTestCase):
+    """The app_config functions the GUI saves projects through."""
+
+    def setUp(self):
+        super(ProjectConfigTest, self).setUp()
+        self.store = config_store(self.path)
+        self.store.write_delay = 60
+        self.addCleanup(self.store.flush)
+        self.writes = []
+        write = self.store._write
+        def counting_write():
+            self.writes.append(time.time())
+            write()
+        self.store._write = counting_write
+
+    def save_upload(self, fail=False):
+        # What project creation writes once the upload is done
+        with config_transaction(self.path):
+            update_config_with_sections(self.path, 'video', 'storage', 'reference')
+            update_config_with_sections(self.path, 'video', 'sha256', 'f' * 64)
+            if fail:
+                raise IOError('interrupted')
+            update_config_with_sections(self.path, 'info', 'identifier', 'abc')
+        flush_config(self.path)
+
+    def test_upload_results_are_saved_together(self):
+        self.save_upload()
+
+        self.assertEqual(len(self.writes), 1)
+        parser = read_file(self.path)
+        self.assertEqual(parser.get('video', 'storage'), 'reference')
+        self.assertEqual(parser.get('video', 'sha256'), 'f' * 64)
+        self.assertEqual(parser.get('info', 'identifier'), 'abc')
+
+    def test_interrupted_save_keeps_nothing(self):
+        self.assertRaises(IOError, self.save_upload, fail=True)
+        flush_config(self.path)
+
+        self.assertEqual(self.writes, [])
+        self.assertIsNone(get_config_with_sections(self.path, 'video', 'storage'))
+        self.assertIsNone(get_config_with_sections(self.path, 'info', 'identifier'))
+        self.assertFalse(read_file(self.path).has_section('video'))
+
+    def test_readers_see_all_or_nothing(self):
+        seen = []
+        def read():
+            seen.append(tuple(get_config_with_sections(self.path, section, option) for (section, option)\
+                              in [('video', 'storage'), ('video', 'sha256'), ('info', 'identifier')]))
+        reader = threading.Thread(target=read)
+
+        with config_transaction(self.path):
+            update_config_with_sections(self.path, 'video', 'storage', 'reference')
+            reader.start()
+            update_config_with_sections(self.path, 'video', 'sha256', 'f' * 64)
+            update_config_with_sections(self.path, 'info', 'identifier', 'abc')
+        reader.join(TIMEOUT)
+
+        self.assertEqual(seen, [('reference', 'f' * 64, 'abc')])
+
+    def test_saved_settings_are_one_write(self):
+        # Like the saveConfig_* methods
+        with config_transaction(self.path):
+            for (option, value) in [('frame_start', '0'), ('num_frames', '100'),\
+                                    ('max_connection_distance', '1.0')]:
+                update_config_with_sections(self.path, 'config', option, value)
+        flush_config(self.path)
+
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(read_file(self.path).get('config', 'num_frames'), '100')
+
+    def test_no_project(self):
+        self.assertEqual(update_config_with_sections(None, 'info', 'name', 'x'), -1)
+        missing = os.path.join(self.tmp_dir, 'missing.cfg')
+        self.assertEqual(update_config_with_sections(missing, 'info', 'name', 'x'), -1)
+        self.assertFalse(os.path.exists(missing))
+        with config_transaction(None):
+            pass
+        flush_config(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import unittest
+
+from cloud_api import RetryPolicy, DOWNLOAD_PART_SUFFIX
+from stub_test_case import StubServerTestCase
+
+ARTIFACT_SIZE = 1024 * 1024
+FILE_NAME = 'road_user_icon_counts.jpg'
+
+
+class ArtifactTestCase(StubServerTestCase):
+    """Serves a random file as the project's road user counts."""
+
+    def setUp(self):
+        super(ArtifactTestCase, self).setUp()
+        self.identifier = self.state.add_video(None)
+        self.artifact = self.make_file('artifact.jpg', ARTIFACT_SIZE)
+        self.state.add_artifact(self.identifier, 'roadUserCounts', self.artifact)
+        self.dest_dir = os.path.join(self.tmp_dir, 'results')
+        self.dest = os.path.join(self.dest_dir, FILE_NAME)
+        self.part = self.dest + DOWNLOAD_PART_SUFFIX
+
+    def download(self, wizard=None):
+        return (wizard or self.wizard).roadUserCounts(self.identifier, self.dest_dir)
+
+
+class DownloadTest(ArtifactTestCase):
+
+    def test_download(self):
+        success, err, _ = self.download()
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.read(self.dest), self.read(self.artifact))
+        self.assertFalse(os.path.exists(self.part))
+
+    def test_dropped_connection_is_resumed_with_a_range(self):
+        self.state.inject_fault('roadUserCounts', ('drop', 300000))
+
+        success, err, _ = self.download()
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.read(self.dest), self.read(self.artifact))
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 206])
+
+    def test_failed_download_is_continued_by_the_next_call(self):
+        self.state.inject_fault('roadUserCounts', ('drop', 300000))
+        wizard = self.make_wizard(retry_policy=RetryPolicy(max_attempts=1))
+        self.addCleanup(wizard.close)
+
+        success, err, _ = self.download(wizard)
+
+        self.assertFalse(success)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertTrue(os.path.exists(self.part + '.json'))
+
+        success, err, _ = self.download(wizard)
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.read(self.dest), self.read(self.artifact))
+        # The second call only asked for what was missing
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 200, 206])
+        self.assertFalse(os.path.exists(self.part))
+        self.assertFalse(os.path.exists(self.part + '.json'))
+
+    def test_changed_artifact_starts_over(self):
+        self.state.inject_fault('roadUserCounts', ('drop', 300000))
+        wizard = self.make_wizard(retry_policy=RetryPolicy(max_attempts=1))
+        self.addCleanup(wizard.close)
+        success, _, _ = self.download(wizard)
+        self.assertFalse(success)
+
+        # New contents, and with them a new ETag
+        new_artifact = self.make_file('artifact2.jpg', ARTIFACT_SIZE)
+        mtime = os.path.getmtime(self.artifact) + 10
+        os.utime(new_artifact, (mtime, mtime))
+        self.state.add_artifact(self.identifier, 'roadUserCounts', new_artifact)
+
+        success, err, _ = self.download(wizard)
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.read(self.dest), self.read(new_artifact))
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 200])
+
+
+class ArtifactCacheTest(ArtifactTestCase):
+
+    def test_unchanged_artifact_comes_from_the_cache(self):
+        self.download()
+        success, err, _ = self.download()
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.read(self.dest), self.read(self.artifact))
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 304])
+
+    def test_deleted_file_is_restored_from_the_cache(self):
+        self.download()
+        os.remove(self.dest)
+
+        success, err, _ = self.download()
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.read(self.dest), self.read(self.artifact))
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 304])
+
+    def test_other_file_in_its_place_is_replaced(self):
+        self.download()
+        stat = os.stat(self.dest)
+        os.remove(self.dest)
+        # Same size and mtime, different contents
+        self.make_file(os.path.join('results', FILE_NAME), ARTIFACT_SIZE)
+        os.utime(self.dest, (stat.st_atime, stat.st_mtime))
+
+        success, err, _ = self.download()
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.read(self.dest), self.read(self.artifact))
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 304])
+
+    def test_rerun_drops_cached_results(self):
+        self.download()
+        self.state.set_status(self.identifier, 'homography', 2)
+
+        success, err, _ = self.wizard.objectTracking(self.identifier)
+
+        self.assertTrue(success, err)
+        success, err, _ = self.download()
+        self.assertTrue(success, err)
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 200])
+
+    def test_failed_rerun_keeps_cached_results(self):
+        self.download()
+        self.state.set_status(self.identifier, 'homography', 2)
+        self.state.inject_fault('objectTracking', 500)
+
+        success, _, _ = self.wizard.objectTracking(self.identifier)
+
+        self.assertFalse(success)
+        self.download()
+        self.assertEqual(self.state.response_codes('roadUserCounts'), [200, 304])
+
+
+if __name__ == '__main__':
+    unittest.main()
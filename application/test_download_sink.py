@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from utils.download_sink import DownloadSink, preallocate
+
+DATA = os.urandom(1000)
+
+
+class ChunkedSource(object):
+    """In-memory stream whose readinto returns odd sized pieces, like a socket."""
+
+    def __init__(self, data, chunk_sizes=(1, 7, 13, 64, 3, 250)):
+        self.data = data
+        self.position = 0
+        self.chunk_sizes = chunk_sizes
+        self.reads = []     # (position, bytes asked for) of every readinto
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.chunk_sizes[len(self.reads) % len(self.chunk_sizes)])
+        self.reads.append((self.position, len(buffer)))
+        data = self.data[self.position:self.position + size]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def copy(sink, source, limit=None):
+    # Like CloudWizard._download_segment: until the limit or the end of the stream
+    copied = 0
+    while limit is None or copied < limit:
+        n = sink.write_from(source, None if limit is None else limit - copied)
+        if not n:
+            break
+        copied += n
+    return copied
+
+
+class DownloadSinkTest(unittest.TestCase):
+
+    def test_copies_the_whole_stream(self):
+        f = BytesIO()
+        sink = DownloadSink(f, buffer_size=100)
+
+        self.assertEqual(copy(sink, ChunkedSource(DATA)), len(DATA))
+
+        self.assertEqual(f.getvalue(), DATA)
+        self.assertEqual(sink.bytes_written, len(DATA))
+        # The end of the stream reads as 0
+        self.assertEqual(sink.write_from(ChunkedSource('')), 0)
+
+    def test_reads_are_at_most_one_buffer(self):
+        source = ChunkedSource(DATA, chunk_sizes=(1000,))
+
+        copy(DownloadSink(BytesIO(), buffer_size=64), source)
+
+        self.assertEqual(set(size for (_, size) in source.reads), set([64]))
+
+    def test_parts_end_at_their_boundary(self):
+        # Two parts of one file, each filled from its own stream
+        f = BytesIO(bytearray(len(DATA)))
+        boundary = 371
+        first = ChunkedSource(DATA[:boundary] + 'past the boundary')
+        second = ChunkedSource(DATA[boundary:], chunk_sizes=(5, 99, 2))
+
+        f.seek(boundary)
+        self.assertEqual(copy(DownloadSink(f, buffer_size=100), second), len(DATA) - boundary)
+        f.seek(0)
+        self.assertEqual(copy(DownloadSink(f, buffer_size=100), first, limit=boundary), boundary)
+
+        self.assertEqual(f.getvalue(), DATA)
+        # Nothing past the boundary was read, or asked for
+        self.assertEqual(first.position, boundary)
+        self.assertTrue(all(position + size <= boundary for (position, size) in first.reads))
+        self.assertTrue(all(size <= 100 for (_, size) in first.reads))
+
+    def test_nothing_is_read_past_the_limit(self):
+        source = ChunkedSource(DATA)
+        sink = DownloadSink(BytesIO(), buffer_size=100)
+
+        self.assertEqual(sink.write_from(source, limit=0), 0)
+        self.assertEqual(source.reads, [])
+        self.assertEqual(sink.write_from(source, limit=-5), 0)
+        copy(sink, source, limit=10)
+        self.assertTrue(all(position + size <= 10 for (position, size) in source.reads))
+        self.assertEqual(source.position, 10)
+
+    def test_write(self):
+        f = BytesIO()
+        sink = DownloadSink(f, buffer_size=100)
+        sink.write_from(ChunkedSource(DATA, chunk_sizes=(10,)))
+
+        self.assertEqual(sink.write(DATA[10:30]), 20)
+
+        self.assertEqual(f.getvalue(), DATA[:30])
+        self.assertEqual(sink.bytes_written, 30)
+        self.assertGreaterEqual(sink.throughput, 0)
+
+
+class PreallocateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='santos_test_')
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.path = os.path.join(self.tmp_dir, 'video.mp4.part')
+
+    def test_part_file_is_extended(self):
+        with open(self.path, 'wb'):
+            pass
+
+        preallocate(self.path, 5000)
+
+        self.assertEqual(os.path.getsize(self.path), 5000)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), '\0' * 5000)
+
+    def test_written_data_is_kept(self):
+        with open(self.path, 'wb') as f:
+            f.write('abc')
+
+        preallocate(self.path, 10)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), 'abc' + '\0' * 7)
+
+    def test_larger_file_is_not_cut(self):
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+
+        preallocate(self.path, 10)
+
+        self.assertEqual(os.path.getsize(self.path), len(DATA))
+
+    def test_sink_writes_into_the_preallocated_file(self):
+        with open(self.path, 'wb'):
+            pass
+        preallocate(self.path, len(DATA))
+        boundary = 600
+
+        # Second part first, the way parallel segments can finish
+        for (start, end) in [(boundary, len(DATA)), (0, boundary)]:
+            with open(self.path, 'r+b') as f:
+                f.seek(start)
+                copy(DownloadSink(f, buffer_size=128), ChunkedSource(DATA[start:end]))
+
+        self.assertEqual(os.path.getsize(self.path), len(DATA))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+
+
+if __name__ == '__main__':
+    unittest.main()
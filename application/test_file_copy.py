@@ -0,0 +1,272 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+from app_config import AppConfig, get_project_video_path, get_config_with_sections, update_config_with_sections,\
+    flush_config
+from utils import config_store as config_store_module
+from utils.file_copy import store_file, copy_file
+from utils.file_hash import hash_file
+try:
+    import pm
+except ImportError:
+    # Needs PyQt5 and OpenCV
+    pm = None
+
+VIDEO_SIZE = 300 * 1024 + 7
+TIMEOUT = 5
+
+
+class FileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='santos_test_')
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.src = self.make_file('source.mp4', VIDEO_SIZE)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def part_files(self):
+        return [name for name in os.listdir(self.tmp_dir) if name.endswith('.part')]
+
+
+class StoreFileTest(FileTestCase):
+
+    def setUp(self):
+        super(StoreFileTest, self).setUp()
+        self.dst = os.path.join(self.tmp_dir, 'video.mp4')
+
+    def test_hardlink_shares_the_file(self):
+        self.assertEqual(store_file(self.src, self.dst, modes=('hardlink',)), 'hardlink')
+
+        self.assertEqual(os.stat(self.dst).st_ino, os.stat(self.src).st_ino)
+        self.assertEqual(os.stat(self.src).st_nlink, 2)
+
+    def test_hardlink_replaces_an_old_file(self):
+        with open(self.dst, 'wb') as f:
+            f.write('old')
+
+        store_file(self.src, self.dst, modes=('hardlink',))
+
+        self.assertEqual(os.stat(self.dst).st_ino, os.stat(self.src).st_ino)
+
+    def test_copy_is_the_same_bytes(self):
+        os.chmod(self.src, 0o640)
+        progress = []
+
+        self.assertEqual(store_file(self.src, self.dst, modes=('copy',),\
+                                    progress_callback=lambda *args: progress.append(args)), 'copy')
+
+        self.assertEqual(self.read(self.dst), self.read(self.src))
+        self.assertNotEqual(os.stat(self.dst).st_ino, os.stat(self.src).st_ino)
+        self.assertEqual(os.stat(self.dst).st_mode & 0o777, 0o640)
+        self.assertEqual(progress[-1], (VIDEO_SIZE, VIDEO_SIZE))
+        self.assertEqual(self.part_files(), [])
+
+    def test_interrupted_copy_leaves_nothing(self):
+        def interrupt(copied, total):
+            raise IOError('cancelled')
+
+        self.assertRaises(IOError, copy_file, self.src, self.dst, block_size=1024, progress_callback=interrupt)
+
+        self.assertFalse(os.path.exists(self.dst))
+        self.assertEqual(self.part_files(), [])
+
+    def test_reference_always_succeeds(self):
+        self.assertEqual(store_file(self.src, self.dst, modes=('reference', 'copy')), 'reference')
+
+        # Nothing is written, and the modes after it are never tried
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_reflink_clones_or_falls_back(self):
+        # Whether it works depends on the filesystem of the temp dir
+        mode = store_file(self.src, self.dst, modes=('reflink', 'copy'))
+
+        self.assertIn(mode, ('reflink', 'copy'))
+        self.assertEqual(self.read(self.dst), self.read(self.src))
+        self.assertEqual(self.part_files(), [])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'reflinks are made with an ioctl on Linux')
+    def test_failed_reflink_falls_back(self):
+        import fcntl
+        def unsupported(*args):
+            raise IOError(95, 'Operation not supported')
+        ioctl = fcntl.ioctl
+        fcntl.ioctl = unsupported
+        self.addCleanup(setattr, fcntl, 'ioctl', ioctl)
+
+        self.assertEqual(store_file(self.src, self.dst, modes=('reflink', 'hardlink')), 'hardlink')
+        self.assertEqual(self.part_files(), [])
+
+    def test_no_mode_works(self):
+        self.assertRaises(ValueError, store_file, self.src, os.path.join(self.tmp_dir, 'missing', 'video.mp4'),\
+                          modes=('hardlink',))
+
+
+class ProjectVideoTestCase(FileTestCase):
+
+    def setUp(self):
+        super(ProjectVideoTestCase, self).setUp()
+        # config_store() keeps one store per path for the whole process
+        saved = dict(config_store_module._stores)
+        def restore():
+            config_store_module._stores.clear()
+            config_store_module._stores.update(saved)
+        self.addCleanup(restore)
+
+        self.project_path = os.path.join(self.tmp_dir, 'project')
+        os.makedirs(self.project_path)
+        self.config_path = os.path.join(self.project_path, 'config.cfg')
+        with open(self.config_path, 'w') as f:
+            f.write('[video]\nname = video.mp4\n')
+        self.addCleanup(flush_config, self.config_path)
+
+    def set_video(self, option, value):
+        update_config_with_sections(self.config_path, 'video', option, value)
+
+    def store(self, mode):
+        # What project creation records for each storage mode
+        store_file(self.src, os.path.join(self.project_path, 'video.mp4'), modes=(mode,))
+        self.set_video('storage', mode)
+        if mode == 'reference':
+            stat = os.stat(self.src)
+            self.set_video('source', os.path.abspath(self.src))
+            self.set_video('size', str(stat.st_size))
+            self.set_video('mtime', str(int(stat.st_mtime)))
+        self.set_video('sha256', hash_file(self.src))
+
+    def touch(self, path):
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+
+    def edit(self, path, size=VIDEO_SIZE):
+        mtime = os.path.getmtime(path)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        os.utime(path, (mtime + 10, mtime + 10))
+
+
+class ProjectVideoPathTest(ProjectVideoTestCase):
+
+    def test_linked_video(self):
+        self.store('hardlink')
+
+        self.assertEqual(get_project_video_path(self.project_path), os.path.join(self.project_path, 'video.mp4'))
+
+    def test_copied_video(self):
+        self.store('copy')
+
+        self.assertEqual(get_project_video_path(self.project_path), os.path.join(self.project_path, 'video.mp4'))
+
+    def test_stored_video_is_missing(self):
+        self.store('copy')
+        os.remove(os.path.join(self.project_path, 'video.mp4'))
+
+        self.assertIsNone(get_project_video_path(self.project_path))
+
+    def test_current_project_by_default(self):
+        self.store('hardlink')
+        self.addCleanup(setattr, AppConfig, 'CURRENT_PROJECT_PATH', AppConfig.CURRENT_PROJECT_PATH)
+        AppConfig.CURRENT_PROJECT_PATH = self.project_path
+
+        self.assertEqual(get_project_video_path(), os.path.join(self.project_path, 'video.mp4'))
+
+    def test_referenced_video(self):
+        self.store('reference')
+
+        self.assertEqual(get_project_video_path(self.project_path), os.path.abspath(self.src))
+
+    def test_moved_referenced_video(self):
+        self.store('reference')
+        os.rename(self.src, os.path.join(self.tmp_dir, 'moved.mp4'))
+
+        self.assertIsNone(get_project_video_path(self.project_path))
+
+    def test_touched_referenced_video(self):
+        self.store('reference')
+        self.touch(self.src)
+
+        # Same contents, so the video is still the project's, and the new
+        # mtime is remembered so it isn't hashed every time
+        self.assertEqual(get_project_video_path(self.project_path), os.path.abspath(self.src))
+        self.assertEqual(get_config_with_sections(self.config_path, 'video', 'mtime'),\
+                         str(int(os.path.getmtime(self.src))))
+
+    def test_edited_referenced_video(self):
+        self.store('reference')
+        self.edit(self.src)
+
+        self.assertIsNone(get_project_video_path(self.project_path))
+
+    def test_resized_referenced_video(self):
+        self.store('reference')
+        self.edit(self.src, size=VIDEO_SIZE + 1)
+
+        self.assertIsNone(get_project_video_path(self.project_path))
+
+
+class MainWindow(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def show_message(self, message, error=False):
+        self.messages.append((message, error))
+
+    def wait_for_message(self, timeout=TIMEOUT):
+        deadline = time.time() + timeout
+        while not self.messages and time.time() < deadline:
+            time.sleep(0.01)
+
+
+@unittest.skipIf(pm is None, 'pm needs PyQt5 and OpenCV')
+class CheckProjectVideoTest(ProjectVideoTestCase):
+
+    def setUp(self):
+        super(CheckProjectVideoTest, self).setUp()
+        self.addCleanup(setattr, AppConfig, 'CURRENT_PROJECT_PATH', AppConfig.CURRENT_PROJECT_PATH)
+        AppConfig.CURRENT_PROJECT_PATH = self.project_path
+        self.main_window = MainWindow()
+
+    def test_moved_video_is_reported(self):
+        self.store('reference')
+        os.rename(self.src, os.path.join(self.tmp_dir, 'moved.mp4'))
+
+        pm.check_project_video(self.project_path, self.main_window)
+        self.main_window.wait_for_message()
+
+        self.assertEqual(len(self.main_window.messages), 1)
+        self.assertTrue(self.main_window.messages[0][1])
+
+    def test_edited_video_is_reported(self):
+        self.store('reference')
+        self.edit(self.src)
+
+        pm.check_project_video(self.project_path, self.main_window)
+        self.main_window.wait_for_message()
+
+        self.assertEqual(len(self.main_window.messages), 1)
+
+    def test_unchanged_video_is_not_reported(self):
+        self.store('reference')
+        self.touch(self.src)
+
+        pm.check_project_video(self.project_path, self.main_window)
+        self.main_window.wait_for_message(timeout=0.5)
+
+        self.assertEqual(self.main_window.messages, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+
+import numpy as np
+
+from utils.homography_solver import find_homography, reprojection_errors, projectArray, HomographyError
+
+# Camera pixels to aerial pixels, with some perspective
+H = np.array([[1.2, 0.1, 30.0],
+              [-0.05, 0.9, 12.0],
+              [1e-4, 2e-4, 1.0]])
+
+
+def project(homography, points):
+    return projectArray(homography, np.asarray(points, dtype=np.float64).T).T
+
+
+class HomographySolverTest(unittest.TestCase):
+
+    def setUp(self):
+        # RANSAC draws random samples
+        np.random.seed(0)
+        self.camera_pts = np.array([[10, 20], [600, 40], [580, 420], [30, 400],\
+                                    [300, 200], [150, 320], [450, 100], [250, 50]], dtype=np.float64)
+        self.aerial_pts = project(H, self.camera_pts)
+
+    def assertSameHomography(self, actual, expected):
+        np.testing.assert_allclose(actual / actual[2, 2], expected / expected[2, 2], rtol=1e-6, atol=1e-8)
+
+    def test_four_points_are_recovered_exactly(self):
+        homography, errors, inliers = find_homography(self.camera_pts[:4], self.aerial_pts[:4])
+
+        self.assertSameHomography(homography, H)
+        self.assertLess(errors.max(), 1e-6)
+        self.assertTrue(inliers.all())
+
+    def test_more_points_are_recovered_exactly(self):
+        homography, errors, inliers = find_homography(self.camera_pts, self.aerial_pts, ransac_threshold=2)
+
+        self.assertSameHomography(homography, H)
+        self.assertLess(errors.max(), 1e-6)
+        self.assertTrue(inliers.all())
+
+    def test_noisy_points_are_fit(self):
+        noisy = self.aerial_pts + np.random.normal(0, 0.5, self.aerial_pts.shape)
+
+        homography, errors, _ = find_homography(self.camera_pts, noisy)
+
+        # Refined to the least squares fit, which is no worse than the true one
+        self.assertLessEqual(np.sum(errors ** 2), np.sum(reprojection_errors(H, self.camera_pts, noisy) ** 2) + 1e-9)
+        self.assertLess(np.abs(project(homography, self.camera_pts) - self.aerial_pts).max(), 2)
+
+    def test_ransac_flags_outliers(self):
+        aerial_pts = self.aerial_pts.copy()
+        aerial_pts[2] += [80, -40]
+        aerial_pts[5] += [-30, 60]
+
+        homography, errors, inliers = find_homography(self.camera_pts, aerial_pts, ransac_threshold=2)
+
+        self.assertEqual(list(np.flatnonzero(~inliers)), [2, 5])
+        self.assertSameHomography(homography, H)
+        # Errors are reported for every point, outliers included
+        self.assertGreater(errors[2], 50)
+        self.assertGreater(errors[5], 50)
+        self.assertLess(errors[inliers].max(), 1e-6)
+
+    def test_without_ransac_every_point_is_used(self):
+        aerial_pts = self.aerial_pts.copy()
+        aerial_pts[2] += [80, -40]
+
+        _, errors, inliers = find_homography(self.camera_pts, aerial_pts)
+
+        self.assertTrue(inliers.all())
+        self.assertGreater(errors[inliers].max(), 1)
+
+    def test_collinear_points_are_rejected(self):
+        camera_pts = np.array([[0, 0], [10, 10], [20, 20], [30, 30], [40, 40]], dtype=np.float64)
+
+        self.assertRaises(HomographyError, find_homography, camera_pts, project(H, camera_pts))
+
+    def test_three_collinear_of_four_are_rejected(self):
+        camera_pts = np.array([[0, 0], [10, 0], [20, 0], [5, 30]], dtype=np.float64)
+
+        self.assertRaises(HomographyError, find_homography, camera_pts, project(H, camera_pts))
+
+    def test_points_in_one_place_are_rejected(self):
+        camera_pts = np.array([[5, 5]] * 4, dtype=np.float64)
+
+        self.assertRaises(HomographyError, find_homography, camera_pts, camera_pts)
+
+    def test_point_counts_are_checked(self):
+        self.assertRaises(HomographyError, find_homography, self.camera_pts[:3], self.aerial_pts[:3])
+        self.assertRaises(HomographyError, find_homography, self.camera_pts[:5], self.aerial_pts[:4])
+
+    def test_reprojection_errors(self):
+        aerial_pts = self.aerial_pts.copy()
+        aerial_pts[0] += [3, 4]
+        aerial_pts[1] += [-6, 8]
+
+        errors = reprojection_errors(H, self.camera_pts, aerial_pts)
+
+        np.testing.assert_allclose(errors, [5, 10] + [0] * (len(aerial_pts) - 2), atol=1e-9)
+
+    def test_points_sent_to_infinity_have_infinite_error(self):
+        # Maps x = 100 onto the line at infinity
+        homography = np.array([[1, 0, 0], [0, 1, 0], [-0.01, 0, 1]], dtype=np.float64)
+
+        errors = reprojection_errors(homography, [[100, 5], [0, 0]], [[0, 0], [0, 0]])
+
+        self.assertEqual(errors[0], np.inf)
+        self.assertEqual(errors[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import random
+import unittest
+
+from utils.point_index import PointGrid
+
+CELL_SIZE = 10
+
+
+class PointGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = PointGrid(CELL_SIZE)
+
+    def test_insert(self):
+        self.grid.insert('a', 5, 5)
+        self.grid.insert('b', -3, 42)
+
+        self.assertEqual(len(self.grid), 2)
+        self.assertIn('a', self.grid)
+        self.assertEqual(self.grid.nearest(5, 5, 1), 'a')
+        self.assertEqual(self.grid.nearest(-3, 42, 1), 'b')
+
+    def test_insert_again_moves(self):
+        self.grid.insert('a', 5, 5)
+        self.grid.insert('a', 55, 5)
+
+        self.assertEqual(len(self.grid), 1)
+        self.assertIsNone(self.grid.nearest(5, 5, CELL_SIZE))
+        self.assertEqual(self.grid.nearest(55, 5, 1), 'a')
+
+    def test_move_within_a_cell(self):
+        self.grid.insert('a', 1, 1)
+
+        self.grid.move('a', 8, 8)
+
+        self.assertIsNone(self.grid.nearest(1, 1, 2))
+        self.assertEqual(self.grid.nearest(8, 8, 1), 'a')
+        self.assertEqual(self.grid.cells, {(0, 0): set(['a'])})
+
+    def test_move_to_another_cell(self):
+        self.grid.insert('a', 1, 1)
+
+        self.grid.move('a', 31, -12)
+
+        self.assertIsNone(self.grid.nearest(1, 1, CELL_SIZE))
+        self.assertEqual(self.grid.nearest(31, -12, 1), 'a')
+        # The old cell is dropped once empty
+        self.assertEqual(self.grid.cells, {(3, -2): set(['a'])})
+
+    def test_move_a_new_point_inserts_it(self):
+        self.grid.move('a', 3, 3)
+
+        self.assertEqual(self.grid.nearest(3, 3, 1), 'a')
+
+    def test_remove(self):
+        self.grid.insert('a', 5, 5)
+        self.grid.insert('b', 6, 6)
+
+        self.grid.remove('a')
+
+        self.assertNotIn('a', self.grid)
+        self.assertEqual(self.grid.nearest(5, 5, 3), 'b')
+        self.grid.remove('b')
+        self.assertEqual(len(self.grid), 0)
+        self.assertEqual(self.grid.cells, {})
+        self.assertRaises(KeyError, self.grid.remove, 'b')
+
+    def test_nearest_across_cell_borders(self):
+        # Just on the other side of the borders of the query's cell
+        self.grid.insert('left', 9.5, 5)
+        self.grid.insert('corner', 20.5, 20.5)
+
+        self.assertEqual(self.grid.nearest(10.5, 5, 2), 'left')
+        self.assertEqual(self.grid.nearest(19.5, 19.5, 2), 'corner')
+        # Negative coordinates have cells too
+        self.grid.insert('negative', -0.5, -0.5)
+        self.assertEqual(self.grid.nearest(0.5, 0.5, 2), 'negative')
+
+    def test_nearest_takes_the_closest(self):
+        self.grid.insert('far', 14, 10)
+        self.grid.insert('near', 8, 10)
+        self.grid.insert('other cell', 10, 18)
+
+        self.assertEqual(self.grid.nearest(9.5, 10, CELL_SIZE), 'near')
+        self.assertEqual(self.grid.nearest(12, 10, CELL_SIZE), 'far')
+        self.assertEqual(self.grid.nearest(10, 16, CELL_SIZE), 'other cell')
+
+    def test_miss_just_outside_the_radius(self):
+        self.grid.insert('a', 10, 10)
+
+        self.assertEqual(self.grid.nearest(13, 14, 5), 'a')
+        self.assertIsNone(self.grid.nearest(13, 14.01, 5))
+        # Diagonally, in the next cell but one
+        self.assertIsNone(self.grid.nearest(10 + CELL_SIZE, 10 + CELL_SIZE, CELL_SIZE))
+
+    def test_radius_larger_than_a_cell(self):
+        self.assertRaises(ValueError, self.grid.nearest, 0, 0, CELL_SIZE + 1)
+
+    def test_matches_a_search_of_every_point(self):
+        rng = random.Random(0)
+        points = dict((i, (rng.uniform(-100, 100), rng.uniform(-100, 100))) for i in range(300))
+        for (key, (x, y)) in points.items():
+            self.grid.insert(key, x, y)
+        for key in range(0, 300, 3):
+            del points[key]
+            self.grid.remove(key)
+        for key in range(1, 300, 3):
+            points[key] = (rng.uniform(-100, 100), rng.uniform(-100, 100))
+            self.grid.move(key, *points[key])
+
+        for _ in range(500):
+            x, y, radius = rng.uniform(-110, 110), rng.uniform(-110, 110), rng.uniform(0, CELL_SIZE)
+            in_radius = [((px - x) ** 2 + (py - y) ** 2, key) for (key, (px, py)) in points.items()\
+                         if (px - x) ** 2 + (py - y) ** 2 <= radius * radius]
+            expected = min(in_radius)[1] if in_radius else None
+            self.assertEqual(self.grid.nearest(x, y, radius), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
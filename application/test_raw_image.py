@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utils import raw_image as raw_image_module
+from utils.raw_image import RawImage, write_raw_image, is_current, open_image, raw_image_path,\
+    RAW_IMAGE_MAGIC, RAW_IMAGE_VERSION, RAW_IMAGE_ALIGNMENT, _HEADER, _LEVEL
+from utils.tile_pyramid import count_levels
+
+
+class RawImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='santos_test_')
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.image_path = os.path.join(self.tmp_dir, 'aerial.png')
+        self.path = raw_image_path(self.image_path)
+        # Odd sizes, so rows and levels don't end on round numbers
+        pixels = np.random.RandomState(0).randint(0, 256, (301, 1100, 4)).astype(np.uint8)
+        self.image = Image.fromarray(pixels, 'RGBA')
+        self.image.save(self.image_path)
+
+    def open(self):
+        raw = RawImage(self.path)
+        self.addCleanup(raw.close)
+        return raw
+
+    def test_raw_image_path(self):
+        self.assertEqual(self.path, os.path.join(self.tmp_dir, 'aerial.raw'))
+
+    def test_header(self):
+        write_raw_image(self.image_path)
+
+        with open(self.path, 'rb') as f:
+            header = f.read(RAW_IMAGE_ALIGNMENT)
+        magic, version, levels, source_size, source_mtime = _HEADER.unpack_from(header)
+        stat = os.stat(self.image_path)
+        self.assertEqual((magic, version), (RAW_IMAGE_MAGIC, RAW_IMAGE_VERSION))
+        self.assertEqual(levels, count_levels(1100, 301))
+        self.assertEqual((source_size, source_mtime), (stat.st_size, int(stat.st_mtime)))
+        sizes = [_LEVEL.unpack_from(header, _HEADER.size + i * _LEVEL.size)[:2] for i in range(levels)]
+        self.assertEqual(sizes, [(1100, 301), (550, 151), (275, 76)])
+
+    def test_levels_start_on_page_boundaries(self):
+        write_raw_image(self.image_path)
+        raw = self.open()
+
+        end = RAW_IMAGE_ALIGNMENT
+        for (level, (width, height, offset)) in enumerate(raw.level_info):
+            self.assertEqual(offset % RAW_IMAGE_ALIGNMENT, 0)
+            # Right after the level before, rounded up to the next page
+            self.assertGreaterEqual(offset, end)
+            self.assertLess(offset - end, RAW_IMAGE_ALIGNMENT)
+            self.assertEqual((width, height), raw.level_size(level))
+            end = offset + width * height * RawImage.channels
+        # The file is padded to a whole page after the last level
+        size = os.path.getsize(self.path)
+        self.assertEqual(size % RAW_IMAGE_ALIGNMENT, 0)
+        self.assertLess(size - end, RAW_IMAGE_ALIGNMENT)
+
+    def test_pixels(self):
+        write_raw_image(self.image_path)
+        raw = self.open()
+
+        self.assertEqual((raw.width, raw.height), (1100, 301))
+        self.assertEqual(raw.bytes_per_line(), 1100 * 4)
+        self.assertEqual(raw.pil_image().tobytes(), self.image.tobytes())
+        pixel = raw.mmap[raw.offset(0, 7, 3):raw.offset(0, 8, 3)]
+        self.assertEqual(tuple(bytearray(pixel)), self.image.getpixel((7, 3)))
+        resample = getattr(Image, 'BOX', Image.ANTIALIAS)
+        level_1 = self.image.resize((550, 151), resample)
+        self.assertEqual(raw.pil_image(1).tobytes(), level_1.tobytes())
+        self.assertEqual(raw.pil_image(2).tobytes(), level_1.resize((275, 76), resample).tobytes())
+
+    def test_opaque_images_get_an_alpha_channel(self):
+        Image.new('RGB', (20, 10), (1, 2, 3)).save(self.image_path)
+
+        write_raw_image(self.image_path)
+
+        self.assertEqual(self.open().pil_image().getpixel((19, 9)), (1, 2, 3, 255))
+
+    def test_progress(self):
+        progress = []
+
+        write_raw_image(self.image_path, progress_callback=lambda *args: progress.append(args))
+
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+
+    def test_failed_write_leaves_nothing(self):
+        def broken_progress(done, levels):
+            raise IOError('disk full')
+
+        self.assertRaises(IOError, write_raw_image, self.image_path, progress_callback=broken_progress)
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_not_a_raw_image(self):
+        with open(self.path, 'wb') as f:
+            f.write('\0' * RAW_IMAGE_ALIGNMENT)
+
+        self.assertFalse(is_current(self.image_path, self.path))
+        self.assertRaises(ValueError, RawImage, self.path)
+
+    def test_changed_image_is_written_again(self):
+        self.assertFalse(is_current(self.image_path, self.path))
+        RawImage.open(self.image_path).close()
+        self.assertTrue(is_current(self.image_path, self.path))
+
+        mtime = os.path.getmtime(self.image_path)
+        os.utime(self.image_path, (mtime + 10, mtime + 10))
+        self.assertFalse(is_current(self.image_path, self.path))
+        raw = RawImage.open(self.image_path)
+        self.addCleanup(raw.close)
+
+        self.assertEqual(raw.source_mtime, int(mtime + 10))
+        self.assertTrue(is_current(self.image_path, self.path))
+
+    def test_open_image_copies_and_closes(self):
+        write_raw_image(self.image_path)
+        opened = []
+        class RecordingRawImage(RawImage):
+            def __init__(self, path):
+                super(RecordingRawImage, self).__init__(path)
+                opened.append(self)
+        raw_image_module.RawImage = RecordingRawImage
+        self.addCleanup(setattr, raw_image_module, 'RawImage', RawImage)
+
+        image = open_image(self.image_path)
+
+        self.assertEqual(len(opened), 1)
+        # A closed mmap refuses to be read
+        self.assertRaises(ValueError, opened[0].mmap.read, 1)
+        self.assertEqual(image.tobytes(), self.image.tobytes())
+        ImageDraw.Draw(image).point((0, 0), (1, 2, 3, 4))
+        self.assertEqual(image.getpixel((0, 0)), (1, 2, 3, 4))
+
+    def test_open_image_without_a_raw_copy(self):
+        image = open_image(self.image_path)
+
+        self.assertEqual(image.tobytes(), self.image.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
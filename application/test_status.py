@@ -0,0 +1,253 @@
+import time
+import random
+import threading
+import unittest
+
+import cloud_api
+from cloud_api import StatusScheduler, StatusPoller, PollingPolicy, register_polling_policy, polling_policy_for
+from stub_test_case import StubServerTestCase
+
+TIMEOUT = 5
+
+
+def wait_for(predicate, timeout=TIMEOUT):
+    """Waits until predicate() is true. Returns False if it wasn't after timeout seconds."""
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class StatusTestCase(StubServerTestCase):
+    """Runs a StatusScheduler of its own against the stub server."""
+
+    def setUp(self):
+        super(StatusTestCase, self).setUp()
+        self.identifier = self.state.add_video(None)
+        self.scheduler = StatusScheduler(num_threads=1)
+
+        # The scheduler and cancel_all use the module's api and status_scheduler
+        saved = (cloud_api.api, cloud_api.status_scheduler)
+        def restore():
+            cloud_api.api, cloud_api.status_scheduler = saved
+        self.addCleanup(restore)
+        cloud_api.api = self.wizard
+        cloud_api.status_scheduler = self.scheduler
+
+        self.results = []
+        self.done = threading.Event()
+
+    def start_poller(self, status_name='homography'):
+        def callback(err):
+            self.results.append(err)
+            self.done.set()
+        poller = StatusPoller(self.identifier, status_name, 0.05, callback, scheduler=self.scheduler)
+        self.addCleanup(poller.stop)
+        poller.start()
+        return poller
+
+    def stream_opened(self):
+        return 200 in self.state.response_codes('status/stream')
+
+
+class StatusStreamTest(StatusTestCase):
+    server_options = {'heartbeat_interval': 0.05}
+
+    def stream(self, on_status, **kwargs):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(\
+            self.wizard.streamProjectStatus(self.identifier, on_status, **kwargs)))
+        thread.daemon = True
+        thread.start()
+        return thread, result
+
+    def test_stream_reports_changes(self):
+        seen = []
+        def on_status(status_dict):
+            seen.append(status_dict['object_tracking']['status'])
+            return seen[-1] != 2
+
+        thread, result = self.stream(on_status)
+        self.assertTrue(wait_for(lambda: seen))
+        self.state.set_status(self.identifier, 'object_tracking', 1, progress=0.5)
+        self.assertTrue(wait_for(lambda: seen[-1] == 1))
+        self.state.set_status(self.identifier, 'object_tracking', 2)
+        thread.join(TIMEOUT)
+
+        self.assertEqual(result, [(True, None, None)])
+        self.assertEqual(seen, [0, 1, 2])
+        self.assertTrue(self.wizard.supports_status_stream)
+        # Streamed statuses are cached for everyone else
+        self.assertEqual(self.wizard.status_cache.get(self.identifier, 10)['object_tracking']['status'], 2)
+
+    def test_heartbeats_let_the_listener_stop(self):
+        stop = threading.Event()
+        thread, result = self.stream(lambda status_dict: None, should_stop=stop.is_set)
+        self.assertTrue(wait_for(self.stream_opened))
+
+        stop.set()
+        thread.join(TIMEOUT)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(result, [(True, None, None)])
+
+    def test_silent_stream_times_out(self):
+        self.server.heartbeat_interval = 60
+        started = time.time()
+        thread, result = self.stream(lambda status_dict: None, read_timeout=0.3)
+        thread.join(TIMEOUT)
+
+        self.assertEqual(result, [(False, 'Status stream was interrupted', None)])
+        self.assertLess(time.time() - started, TIMEOUT)
+
+    def test_poller_is_called_back_from_the_stream(self):
+        self.state.set_status(self.identifier, 'homography', 1)
+        self.start_poller()
+        self.assertTrue(wait_for(self.stream_opened))
+
+        self.state.set_status(self.identifier, 'homography', 2)
+
+        self.assertTrue(self.done.wait(TIMEOUT))
+        self.assertEqual(self.results, [None])
+        self.assertEqual(self.state.response_codes('status'), [])
+
+    def test_poller_polls_when_the_stream_fails(self):
+        self.state.inject_fault('status/stream', 500)
+        self.state.set_status(self.identifier, 'homography', 1)
+        self.start_poller()
+        self.assertTrue(wait_for(lambda: self.state.response_codes('status')))
+
+        self.state.set_status(self.identifier, 'homography', 2)
+
+        self.assertTrue(self.done.wait(TIMEOUT))
+        self.assertEqual(self.results, [None])
+        self.assertEqual(self.state.response_codes('status/stream'), [500])
+
+    def test_cancel_all_closes_the_stream(self):
+        self.state.set_status(self.identifier, 'homography', 1)
+        poller = self.start_poller()
+        self.assertTrue(wait_for(self.stream_opened))
+
+        self.wizard.cancel_all(self.identifier)
+
+        # The stream notices at the next heartbeat
+        self.assertTrue(wait_for(lambda: self.identifier not in self.scheduler._streams))
+        self.assertFalse(poller.is_running)
+        self.state.set_status(self.identifier, 'homography', 2)
+        self.assertFalse(self.done.wait(0.3))
+        self.assertEqual(self.state.response_codes('status'), [])
+
+
+class StatusWithoutStreamTest(StatusTestCase):
+    server_options = {'enable_status_stream': False}
+
+    def test_poller_falls_back_to_polling(self):
+        self.state.set_status(self.identifier, 'homography', 1)
+        self.start_poller()
+        self.assertTrue(wait_for(lambda: self.state.response_codes('status')))
+
+        self.state.set_status(self.identifier, 'homography', 2)
+
+        self.assertTrue(self.done.wait(TIMEOUT))
+        self.assertEqual(self.results, [None])
+        self.assertIs(self.wizard.supports_status_stream, False)
+        self.assertEqual(self.state.response_codes('status/stream'), [404])
+
+    def test_later_pollers_dont_try_the_stream_again(self):
+        self.state.set_status(self.identifier, 'homography', 1)
+        self.start_poller()
+        self.assertTrue(wait_for(lambda: self.wizard.supports_status_stream is False))
+        self.start_poller('object_tracking')
+
+        self.assertTrue(wait_for(lambda: len(self.state.response_codes('status')) >= 2))
+        self.assertEqual(self.state.response_codes('status/stream'), [404])
+
+
+class HighRandom(object):
+    """Always draws the top of the range, so jittered waits are known exactly."""
+
+    def uniform(self, a, b):
+        return b
+
+
+class PollingPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        saved = dict(cloud_api.POLLING_POLICIES)
+        def restore():
+            cloud_api.POLLING_POLICIES.clear()
+            cloud_api.POLLING_POLICIES.update(saved)
+        self.addCleanup(restore)
+
+    def intervals(self, policy, changes):
+        return [policy.next_interval(changed) for changed in changes]
+
+    def test_backoff_schedule(self):
+        policy = PollingPolicy(initial=2, maximum=10, factor=1.5, jitter=0)
+
+        self.assertEqual(self.intervals(policy, [False] * 6), [3, 4.5, 6.75, 10, 10, 10])
+
+    def test_change_resets_the_wait(self):
+        policy = PollingPolicy(initial=2, maximum=10, factor=2, jitter=0)
+
+        self.assertEqual(self.intervals(policy, [False, False, True, False, True, True]), [4, 8, 2, 4, 2, 2])
+
+    def test_jitter_stays_in_bounds(self):
+        policy = PollingPolicy(initial=2, maximum=10, factor=1.5, jitter=0.2, random_source=random.Random(0))
+        unjittered = PollingPolicy(initial=2, maximum=10, factor=1.5, jitter=0)
+        changes = [i % 7 == 0 for i in range(500)]
+
+        for (jittered, interval) in zip(self.intervals(policy, changes), self.intervals(unjittered, changes)):
+            self.assertGreaterEqual(jittered, interval * 0.8)
+            self.assertLessEqual(jittered, interval * 1.2)
+
+    def test_jitter_comes_from_the_random_source(self):
+        policy = PollingPolicy(initial=2, maximum=10, factor=1.5, jitter=0.2, random_source=HighRandom())
+
+        self.assertEqual(self.intervals(policy, [False, False, True]), [3 * 1.2, 4.5 * 1.2, 2 * 1.2])
+
+    def test_seeded_policies_agree(self):
+        changes = [False, False, True, False, False, False, True]
+        first, second = [self.intervals(PollingPolicy(jitter=0.2, random_source=random.Random(42)), changes)\
+                         for _ in range(2)]
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(set(first)), len(first))
+
+    def test_eta_caps_the_wait(self):
+        policy = PollingPolicy(initial=2, maximum=60, factor=4, jitter=0)
+        policy.next_interval(False)
+
+        self.assertEqual(policy.next_interval(False, {'eta': 5}), 5)
+        # Never below initial
+        self.assertEqual(policy.next_interval(False, {'eta': 0.1}), 2)
+        self.assertEqual(policy.next_interval(False, {'eta': 'soon'}), 60)
+
+    def test_registered_policies(self):
+        register_polling_policy('seeded', {'initial': 1, 'maximum': 4, 'factor': 2,\
+                                           'random_source': HighRandom(), 'jitter': 0.5})
+        register_polling_policy('custom', lambda: PollingPolicy(initial=7, jitter=0))
+
+        self.assertEqual(self.intervals(polling_policy_for('seeded', 3), [False] * 3), [3, 6, 6])
+        self.assertEqual(polling_policy_for('custom', 3).next_interval(True), 7)
+        # Unregistered statuses poll at their poller's fixed interval
+        self.assertEqual(self.intervals(polling_policy_for('unknown', 3), [False, True, False]), [3, 3, 3])
+
+    def test_poller_resets_when_the_status_changes(self):
+        register_polling_policy('homography', {'initial': 1, 'maximum': 8, 'factor': 2, 'jitter': 0})
+        poller = StatusPoller('project', 'homography', 1, lambda err: None, scheduler=StatusScheduler())
+        poller.is_running = True
+        running = {'status': 1, 'progress': None}
+        intervals = []
+
+        for status in [running, running, running, dict(running, step='tracking'), running]:
+            poller._handle_status(True, None, {'homography': dict(status)})
+            intervals.append(poller.interval)
+
+        self.assertEqual(intervals, [1, 2, 4, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
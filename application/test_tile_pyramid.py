@@ -0,0 +1,220 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from utils.tile_pyramid import PyramidGeometry, TilePyramid, TileCache, count_levels, build_pyramid,\
+    is_current, pyramid_dir, PYRAMID_META_FILE
+
+
+class Geometry(PyramidGeometry):
+
+    def __init__(self, width, height, tile_size=512):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.levels = count_levels(width, height, tile_size)
+
+
+class PyramidGeometryTest(unittest.TestCase):
+
+    def test_count_levels(self):
+        self.assertEqual(count_levels(512, 512), 1)
+        self.assertEqual(count_levels(513, 10), 2)
+        self.assertEqual(count_levels(1024, 1024), 2)
+        self.assertEqual(count_levels(1025, 300), 3)
+        self.assertEqual(count_levels(10, 20000), 7)
+        self.assertEqual(count_levels(100, 100, tile_size=16), 4)
+
+    def test_level_size_rounds_up(self):
+        geometry = Geometry(1025, 301)
+
+        self.assertEqual(geometry.level_size(0), (1025, 301))
+        self.assertEqual(geometry.level_size(1), (513, 151))
+        self.assertEqual(geometry.level_size(2), (257, 76))
+        # The last level fits in a single tile
+        self.assertLessEqual(max(geometry.level_size(geometry.levels - 1)), geometry.tile_size)
+
+    def test_level_for_scale(self):
+        geometry = Geometry(5000, 5000)
+
+        self.assertEqual(geometry.levels, 5)
+        self.assertEqual(geometry.level_for_scale(4), 0)
+        self.assertEqual(geometry.level_for_scale(1), 0)
+        self.assertEqual(geometry.level_for_scale(0.6), 0)
+        self.assertEqual(geometry.level_for_scale(0.5), 1)
+        self.assertEqual(geometry.level_for_scale(0.3), 1)
+        self.assertEqual(geometry.level_for_scale(0.25), 2)
+        self.assertEqual(geometry.level_for_scale(0.001), 4)
+        self.assertEqual(geometry.level_for_scale(0), 4)
+
+    def test_tiles_in(self):
+        geometry = Geometry(1100, 600)
+
+        tiles = geometry.tiles_in(0, 0, 0, 1099, 599)
+        self.assertEqual([(col, row) for (col, row, _) in tiles],\
+                         [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)])
+        # Edge tiles are cut to the image
+        self.assertEqual(dict(((col, row), area) for (col, row, area) in tiles)[(2, 1)],\
+                         (1024, 512, 76, 88))
+
+        # A small area only needs the tiles it touches
+        self.assertEqual([(col, row) for (col, row, _) in geometry.tiles_in(0, 600, 100, 700, 200)], [(1, 0)])
+
+        # Tiles of coarser levels cover more of the full image
+        self.assertEqual(geometry.tiles_in(1, 0, 0, 1099, 599), [(0, 0, (0, 0, 1024, 600)), (1, 0, (1024, 0, 76, 600))])
+
+    def test_tiles_in_is_clipped_to_the_image(self):
+        geometry = Geometry(1100, 600)
+
+        tiles = geometry.tiles_in(0, -500, -500, 5000, 5000)
+
+        self.assertEqual(len(tiles), 6)
+        self.assertEqual(geometry.tiles_in(0, 2000, 2000, 3000, 3000), [])
+
+
+class BuildPyramidTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='santos_test_')
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.image_path = os.path.join(self.tmp_dir, 'aerial.png')
+        self.directory = pyramid_dir(self.image_path)
+        self.save_image((100, 60), (255, 0, 0))
+
+    def save_image(self, size, color, mtime=None):
+        Image.new('RGB', size, color).save(self.image_path)
+        if mtime is not None:
+            os.utime(self.image_path, (mtime, mtime))
+
+    def test_pyramid_dir(self):
+        self.assertEqual(self.directory, os.path.join(self.tmp_dir, 'tiles', 'aerial'))
+
+    def test_build(self):
+        build_pyramid(self.image_path, self.directory, tile_size=32)
+        pyramid = TilePyramid(self.directory)
+
+        self.assertEqual((pyramid.width, pyramid.height), (100, 60))
+        self.assertEqual(pyramid.levels, count_levels(100, 60, 32))
+        # Opaque images are cut into JPEG tiles
+        self.assertEqual(pyramid.format, 'jpg')
+        for level in range(pyramid.levels):
+            level_width, level_height = pyramid.level_size(level)
+            for (col, row, _) in pyramid.tiles_in(level, 0, 0, 99, 59):
+                tile = Image.open(pyramid.tile_path(level, col, row))
+                self.assertEqual(tile.size, (min(32, level_width - col * 32), min(32, level_height - row * 32)))
+        self.assertTrue(is_current(self.image_path, self.directory))
+
+    def test_transparent_images_get_png_tiles(self):
+        Image.new('RGBA', (40, 40), (0, 0, 0, 0)).save(self.image_path)
+
+        build_pyramid(self.image_path, self.directory, tile_size=32)
+
+        pyramid = TilePyramid(self.directory)
+        self.assertEqual(pyramid.format, 'png')
+        self.assertEqual(Image.open(pyramid.tile_path(0, 1, 1)).mode, 'RGBA')
+
+    def test_progress(self):
+        progress = []
+
+        build_pyramid(self.image_path, self.directory, tile_size=32, progress_callback=lambda *args: progress.append(args))
+
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+
+    def test_not_current_without_a_pyramid(self):
+        self.assertFalse(is_current(self.image_path, self.directory))
+
+        os.makedirs(self.directory)
+        with open(os.path.join(self.directory, PYRAMID_META_FILE), 'w') as f:
+            f.write('{"size": [10')
+        self.assertFalse(is_current(self.image_path, self.directory))
+
+    def test_changed_image_is_cut_again(self):
+        mtime = os.path.getmtime(self.image_path)
+        TilePyramid.open(self.image_path)
+        first_tile = TilePyramid(self.directory).tile_path(0, 0, 0)
+        with open(os.path.join(self.directory, PYRAMID_META_FILE), 'r') as f:
+            self.assertEqual(json.load(f)['source_mtime'], int(mtime))
+
+        # Same size on disk, only the mtime moved
+        os.utime(self.image_path, (mtime + 10, mtime + 10))
+        self.assertFalse(is_current(self.image_path, self.directory))
+        os.remove(first_tile)
+        pyramid = TilePyramid.open(self.image_path)
+
+        self.assertTrue(os.path.exists(first_tile))
+        self.assertEqual(pyramid.meta['source_mtime'], int(mtime + 10))
+        self.assertTrue(is_current(self.image_path, self.directory))
+
+    def test_current_pyramid_is_kept(self):
+        TilePyramid.open(self.image_path)
+        meta_path = os.path.join(self.directory, PYRAMID_META_FILE)
+        os.utime(meta_path, (0, 0))
+
+        TilePyramid.open(self.image_path)
+
+        self.assertEqual(os.path.getmtime(meta_path), 0)
+
+    def test_resized_image_is_cut_again(self):
+        mtime = os.path.getmtime(self.image_path)
+        TilePyramid.open(self.image_path)
+
+        self.save_image((2000, 60), (0, 0, 255), mtime=mtime)
+        pyramid = TilePyramid.open(self.image_path)
+
+        self.assertEqual((pyramid.width, pyramid.height), (2000, 60))
+        self.assertEqual(pyramid.levels, count_levels(2000, 60))
+
+
+class TileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+
+    def get(self, cache, key):
+        def load():
+            self.loads.append(key)
+            return 'tile ' + key
+        return cache.get(key, load)
+
+    def test_tiles_are_loaded_once(self):
+        cache = TileCache(max_tiles=2)
+
+        self.assertEqual(self.get(cache, 'a'), 'tile a')
+        self.assertEqual(self.get(cache, 'a'), 'tile a')
+
+        self.assertEqual(self.loads, ['a'])
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TileCache(max_tiles=3)
+        for key in 'abc':
+            self.get(cache, key)
+
+        # Using a makes b the least recently used
+        self.get(cache, 'a')
+        self.get(cache, 'd')
+        self.assertEqual(list(cache.tiles), ['c', 'a', 'd'])
+        self.get(cache, 'e')
+        self.assertEqual(list(cache.tiles), ['a', 'd', 'e'])
+
+        del self.loads[:]
+        self.get(cache, 'b')
+        self.get(cache, 'e')
+        self.assertEqual(self.loads, ['b'])
+        self.assertEqual(list(cache.tiles), ['d', 'b', 'e'])
+
+    def test_clear(self):
+        cache = TileCache(max_tiles=3)
+        self.get(cache, 'a')
+
+        cache.clear()
+        self.get(cache, 'a')
+
+        self.assertEqual(self.loads, ['a', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
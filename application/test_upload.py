@@ -0,0 +1,129 @@
+import os
+import json
+import unittest
+
+from cloud_api import UPLOAD_STATE_FILE
+from utils.file_hash import hash_file
+from utils.tee_reader import TeeReader, HashConsumer
+from stub_test_case import StubServerTestCase
+
+CHUNK_SIZE = 64 * 1024
+VIDEO_SIZE = 5 * CHUNK_SIZE + 1000
+
+
+class ChunkedUploadTest(StubServerTestCase):
+
+    def setUp(self):
+        super(ChunkedUploadTest, self).setUp()
+        self.video_path = self.make_file('video.mp4', VIDEO_SIZE)
+        self.state_dir = os.path.join(self.tmp_dir, 'project')
+        self.parts = -(-VIDEO_SIZE // CHUNK_SIZE)
+
+    def upload(self, **kwargs):
+        kwargs.setdefault('chunk_size', CHUNK_SIZE)
+        return self.wizard.uploadVideoChunked(self.video_path, self.state_dir, **kwargs)
+
+    def uploaded_video(self, identifier):
+        return self.read(self.state.videos[identifier])
+
+    def confirmed_parts(self):
+        with open(os.path.join(self.state_dir, UPLOAD_STATE_FILE), 'r') as f:
+            return json.load(f)['confirmed']
+
+    def test_upload_in_parts(self):
+        progress = []
+        success, err, identifier = self.upload(parallel=3,\
+            progress_callback=lambda sent, total: progress.append((sent, total)))
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.uploaded_video(identifier), self.read(self.video_path))
+        self.assertEqual(self.state.response_codes('uploadVideo/chunk'), [200] * self.parts)
+        self.assertEqual(progress[-1], (VIDEO_SIZE, VIDEO_SIZE))
+        self.assertFalse(self.wizard.has_pending_upload(self.state_dir, self.video_path))
+
+    def test_dropped_connection_is_retried(self):
+        self.state.inject_fault('uploadVideo/chunk', 'close', after=1)
+
+        success, err, identifier = self.upload(parallel=1)
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.uploaded_video(identifier), self.read(self.video_path))
+        # The dropped request got no response
+        self.assertEqual(self.state.response_codes('uploadVideo/chunk'), [200] * self.parts)
+
+    def test_server_errors_are_retried(self):
+        self.state.inject_fault('uploadVideo/chunk', 503, count=2)
+
+        success, err, identifier = self.upload(parallel=1)
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.uploaded_video(identifier), self.read(self.video_path))
+        self.assertEqual(self.state.response_codes('uploadVideo/chunk'), [503, 503] + [200] * self.parts)
+
+    def test_resume_after_failure(self):
+        # 500 isn't retried, so the first call gives up at the third part
+        self.state.inject_fault('uploadVideo/chunk', 500, after=2)
+
+        success, err, _ = self.upload(parallel=1)
+
+        self.assertFalse(success)
+        self.assertTrue(self.wizard.has_pending_upload(self.state_dir, self.video_path))
+        self.assertEqual(sorted(self.confirmed_parts()), [0, CHUNK_SIZE])
+
+        success, err, identifier = self.upload(parallel=2)
+
+        self.assertTrue(success, err)
+        self.assertEqual(self.uploaded_video(identifier), self.read(self.video_path))
+        # Only the parts the first call didn't get confirmed were sent again
+        self.assertEqual(self.state.response_codes('uploadVideo/chunk'), [200, 200, 500] + [200] * (self.parts - 2))
+        self.assertFalse(self.wizard.has_pending_upload(self.state_dir, self.video_path))
+
+    def test_hash_is_checked_at_complete(self):
+        success, err, _ = self.upload(content_hash='0' * 64)
+
+        self.assertFalse(success)
+        self.assertIn('sha256', err)
+        self.assertEqual(self.state.videos, {})
+
+    def test_hash_from_single_read(self):
+        reader = TeeReader(self.video_path, block_size=CHUNK_SIZE, consumers=[HashConsumer()])
+
+        success, err, identifier = self.upload(reader=reader)
+
+        self.assertTrue(success, err)
+        self.assertEqual(reader.hexdigest, hash_file(self.video_path))
+        self.assertEqual(self.uploaded_video(identifier), self.read(self.video_path))
+
+    def test_known_video_makes_a_new_project(self):
+        reader = TeeReader(self.video_path, block_size=CHUNK_SIZE, consumers=[HashConsumer()])
+        success, err, first = self.upload(reader=reader)
+        self.assertTrue(success, err)
+        self.wizard.rememberVideoHash(self.video_path, reader.hexdigest)
+
+        # A second project on the same footage
+        content_hash = self.wizard.knownVideoHash(self.video_path)
+        self.assertEqual(content_hash, reader.hexdigest)
+        success, err, second = self.wizard.uploadVideoChunked(self.video_path,\
+            os.path.join(self.tmp_dir, 'project2'), chunk_size=CHUNK_SIZE, content_hash=content_hash)
+
+        self.assertTrue(success, err)
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.uploaded_video(second), self.read(self.video_path))
+        # Nothing was sent the second time
+        self.assertEqual(len(self.state.response_codes('uploadVideo/chunk')), self.parts)
+        # and the projects are configured separately
+        self.state.set_status(first, 'homography', 2)
+        success, err, status = self.wizard.getProjectStatus(second)
+        self.assertEqual(status['homography']['status'], 0)
+        self.assertEqual(status['upload_video']['status'], 2)
+
+    def test_changed_video_is_hashed_again(self):
+        self.wizard.rememberVideoHash(self.video_path, hash_file(self.video_path))
+        with open(self.video_path, 'ab') as f:
+            f.write('more')
+
+        self.assertIsNone(self.wizard.knownVideoHash(self.video_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
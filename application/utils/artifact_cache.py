@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+ARTIFACT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+class ArtifactCache(object):
+    """
+    Copies of downloaded result files, with the ETag or Last-Modified they were
+    served with, shared by all projects. Entries are keyed by server, route and
+    request parameters (which include the project identifier), so the client can
+    ask the server whether its copy is still current instead of downloading it
+    again. Once the cache grows past max_bytes the least recently used entries
+    are dropped.
+
+    A project's entries are dropped once it is analysed again, see invalidate().
+
+    Files are hard-linked into the cache where possible, so caching an artifact
+    that also lives in a project directory takes no extra space.
+
+    The index is a JSON file in directory mapping key -> {'file', 'identifier',
+    'etag', 'last_modified', 'size', 'mtime', 'last_used'}.
+    """
+    def __init__(self, directory, max_bytes=ARTIFACT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+
+    def key(self, server, route, params):
+        return hashlib.sha1(json.dumps([server, route, params], sort_keys=True)).hexdigest()
+
+    ###########################################################################
+    # Index
+    ###########################################################################
+
+    def _read(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            print("ERR [ArtifactCache]: {} is corrupt, ignoring it.".format(self.index_path))
+            return {}
+
+    def _write(self, data):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        if os.path.exists(self.index_path) and sys.platform == 'win32':
+            os.remove(self.index_path)
+        os.rename(tmp_path, self.index_path)
+
+    def _blob_path(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def _valid(self, entry):
+        # The blob may be a hard link to a project file, so make sure nothing
+        # has written to it since it was cached
+        if entry is None:
+            return False
+        blob = self._blob_path(entry)
+        if not os.path.exists(blob):
+            return False
+        stat = os.stat(blob)
+        return stat.st_size == entry['size'] and int(stat.st_mtime) == entry.get('mtime')
+
+    def _remove_entry(self, data, key):
+        entry = data.pop(key, None)
+        if entry is not None and os.path.exists(self._blob_path(entry)):
+            os.remove(self._blob_path(entry))
+
+    def _evict(self, data):
+        total = sum(entry['size'] for entry in data.itervalues())
+        for key in sorted(data, key=lambda k: data[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= data[key]['size']
+            self._remove_entry(data, key)
+
+    ###########################################################################
+    # Public
+    ###########################################################################
+
+    def validators(self, key):
+        """Returns the conditional request headers for key, empty if it isn't cached."""
+        with self._lock:
+            entry = self._read().get(key)
+        if not self._valid(entry):
+            return {}
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, key, identifier, path, etag=None, last_modified=None):
+        """Caches the file at path under key. Without a validator there is nothing to cache."""
+        size = os.path.getsize(path)
+        with self._lock:
+            data = self._read()
+            self._remove_entry(data, key)
+            if (etag or last_modified) and size <= self.max_bytes:
+                entry = {
+                    'file': key + os.path.splitext(path)[1],
+                    'identifier': identifier,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'size': size,
+                    'last_used': time.time()
+                }
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                _link_or_copy(path, self._blob_path(entry))
+                entry['mtime'] = int(os.stat(self._blob_path(entry)).st_mtime)
+                data[key] = entry
+                self._evict(data)
+            self._write(data)
+
+    def restore(self, key, path):
+        """
+        Puts the cached copy for key at path, unless path already is that copy.
+        Returns False if there is no cached copy.
+        """
+        with self._lock:
+            data = self._read()
+            entry = data.get(key)
+            if not self._valid(entry):
+                return False
+            blob = self._blob_path(entry)
+            if not _same_file(blob, path):
+                directory = os.path.dirname(path)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                _link_or_copy(blob, path)
+            entry['last_used'] = time.time()
+            self._write(data)
+            return True
+
+    def remove(self, key):
+        with self._lock:
+            data = self._read()
+            if key in data:
+                self._remove_entry(data, key)
+                self._write(data)
+
+    def invalidate(self, identifier):
+        """Drops every entry belonging to the project identifier."""
+        with self._lock:
+            data = self._read()
+            keys = [key for (key, entry) in data.iteritems() if entry['identifier'] == identifier]
+            for key in keys:
+                self._remove_entry(data, key)
+            if keys:
+                self._write(data)
+
+def _same_file(a, b):
+    # Only a link to the blob is the blob. A copy, or another file that happens
+    # to have the same size and mtime, gets replaced. Python 2 has no samefile
+    # on Windows, where the cache copies anyway.
+    if not os.path.exists(b) or not hasattr(os.path, 'samefile'):
+        return False
+    return os.path.samefile(a, b)
+
+def _link_or_copy(src, dst):
+    # Replaces dst atomically with a hard link to src, or a copy if links
+    # aren't possible (other filesystem, or Windows on Python 2)
+    tmp_path = dst + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except (AttributeError, OSError):
+        shutil.copy2(src, tmp_path)
+    if os.path.exists(dst) and sys.platform == 'win32':
+        os.remove(dst)
+    os.rename(tmp_path, dst)
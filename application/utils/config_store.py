@@ -0,0 +1,220 @@
+import os
+import sys
+import copy
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+from ConfigParser import SafeConfigParser, NoSectionError, NoOptionError
+
+# Seconds a change may wait so that changes made right after it share its write
+CONFIG_WRITE_DELAY = 0.5
+
+class ConfigStore(object):
+    """
+    In-memory copy of a sectioned config file such as a project's config.cfg.
+
+    The file is parsed once and reads are served from memory. Every access
+    checks the file's mtime and size, so changes made by anything else that
+    writes the file are picked up. Changes of ours that aren't written yet
+    are applied again on top of the new contents, so for an option set on
+    both sides the later write wins and the other options are kept.
+
+    Changes are written at most write_delay seconds after they are made, so
+    a burst of them (a transaction() block, repeated saves, pollers) costs
+    one write. Writes are serialized by the store's lock and go to a new
+    temporary file that is fsynced and renamed over the original: the file
+    on disk always holds one complete version, even if the process dies.
+    """
+    def __init__(self, path, write_delay=CONFIG_WRITE_DELAY):
+        self.path = path
+        self.write_delay = write_delay
+        self._parser = SafeConfigParser()
+        self._stamp = None
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._dirty = False
+        # (section, option, value) set since the last write, or None after
+        # replace(), when all of the parser's contents are ours
+        self._pending = []
+        self._timer = None
+
+    def _revalidate(self):
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime, stat.st_size)
+        except OSError:
+            stamp = None
+        if stamp is not None and stamp == self._stamp:
+            return
+        self._stamp = stamp
+        if self._dirty and (stamp is None or self._pending is None):
+            # Nothing to merge with, what we have gets written as it is
+            return
+        parser = SafeConfigParser()
+        if stamp is not None:
+            parser.read(self.path)
+        for (section, option, value) in self._pending:
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, option, value)
+        self._parser = parser
+
+    def _schedule_flush(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.write_delay, self._delayed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _delayed_flush(self):
+        try:
+            self.flush()
+        except (IOError, OSError) as e:
+            # Kept pending, the next change or flush tries again
+            print("ERR [ConfigStore]: Could not write {}: {}".format(self.path, e))
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            # The project was deleted in the meantime
+            print("ERR [ConfigStore]: {} no longer exists, dropping changes.".format(directory))
+            self._pending = []
+            return
+        mode = os.stat(self.path).st_mode if os.path.exists(self.path) else 0o644
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp', dir=directory)
+        try:
+            os.chmod(tmp_path, mode & 0o777)
+            with os.fdopen(fd, 'wb') as f:
+                self._parser.write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.path) and sys.platform == 'win32':
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        _fsync_directory(directory)
+        stat = os.stat(self.path)
+        self._stamp = (stat.st_mtime, stat.st_size)
+        self._pending = []
+
+    ###########################################################################
+    # Public
+    ###########################################################################
+
+    def get(self, section, option):
+        """Returns the value of option in section, None if either doesn't exist."""
+        with self._lock:
+            self._revalidate()
+            try:
+                return self._parser.get(section, option)
+            except (NoSectionError, NoOptionError):
+                return None
+
+    def items(self, section):
+        """Returns the (option, value) pairs of section. Raises NoSectionError."""
+        with self._lock:
+            self._revalidate()
+            return self._parser.items(section)
+
+    def has_section(self, section):
+        with self._lock:
+            self._revalidate()
+            return self._parser.has_section(section)
+
+    def set(self, section, option, value):
+        """Sets option in section, creating the section if needed."""
+        with self._lock:
+            self._revalidate()
+            if not self._parser.has_section(section):
+                self._parser.add_section(section)
+            self._parser.set(section, option, value)
+            if self._pending is not None:
+                self._pending.append((section, option, value))
+            self._dirty = True
+            if self._depth == 0:
+                self._schedule_flush()
+
+    def replace(self, parser):
+        """Makes the file hold exactly parser's contents, written right away."""
+        with self._lock:
+            self._parser = parser
+            self._pending = None
+            self._dirty = True
+            self.flush()
+
+    def flush(self):
+        """Writes pending changes now."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._dirty and self._depth == 0:
+                self._dirty = False
+                try:
+                    self._write()
+                except:
+                    self._dirty = True
+                    raise
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups writes into one. Other threads can't use the store until the
+        block ends; if it raises, its changes are dropped.
+        """
+        with self._lock:
+            if self._depth == 0:
+                self._revalidate()
+                saved = (copy.deepcopy(self._parser._sections), self._dirty,\
+                         copy.copy(self._pending))
+            self._depth += 1
+            try:
+                yield self
+            except:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._parser._sections, self._dirty, self._pending = saved
+                raise
+            self._depth -= 1
+            if self._depth == 0 and self._dirty:
+                self._schedule_flush()
+
+def _fsync_directory(directory):
+    # Makes the rename itself durable; not possible on Windows
+    if sys.platform == 'win32':
+        return
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def config_store(path):
+    """Returns the shared ConfigStore for the file at path."""
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = ConfigStore(path)
+        return _stores[path]
+
+@atexit.register
+def flush_all():
+    """Writes the pending changes of every store."""
+    with _stores_lock:
+        stores = _stores.values()
+    for store in stores:
+        try:
+            store.flush()
+        except (IOError, OSError) as e:
+            print("ERR [ConfigStore]: Could not write {}: {}".format(store.path, e))
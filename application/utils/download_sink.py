@@ -0,0 +1,61 @@
+import os
+import time
+
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+def preallocate(path, size):
+    """
+    Extends the file at path to size bytes up front, so writes at any offset
+    land in an existing file instead of growing it piece by piece.
+    """
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < size:
+            f.truncate(size)
+
+class DownloadSink(object):
+    """
+    Copies a stream into an open file through one reusable buffer.
+
+    Each read fills up to buffer_size bytes of the same bytearray with readinto,
+    and the filled part is written straight from a memoryview of it, so a large
+    download costs a few thousand Python-level reads instead of hundreds of
+    thousands and allocates no new strings per block.
+    """
+    def __init__(self, f, buffer_size=DOWNLOAD_BUFFER_SIZE):
+        self.f = f
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.bytes_written = 0
+        self.started = time.time()
+
+    def write_from(self, source, limit=None):
+        """
+        Reads one buffer's worth (at most limit bytes) from source, which must
+        have readinto, and writes it at the file's current position. Returns
+        the number of bytes copied, 0 at the end of the stream.
+        """
+        size = len(self.buffer) if limit is None else min(limit, len(self.buffer))
+        if size <= 0:
+            return 0
+        n = source.readinto(self.view[:size])
+        if n:
+            self.f.write(self.view[:n])
+            self.bytes_written += n
+        return n or 0
+
+    def write(self, data):
+        """Writes data that was read some other way, e.g. after decompression."""
+        self.f.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def throughput(self):
+        """Bytes per second since the sink was created."""
+        elapsed = self.elapsed
+        return self.bytes_written / elapsed if elapsed > 0 else 0.0
@@ -0,0 +1,118 @@
+import os
+import sys
+import shutil
+
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+def copy_file(src, dst, block_size=COPY_BLOCK_SIZE, progress_callback=None):
+    """
+    Copies the file at src to dst, like shutil.copy. The data goes to dst.part
+    first and is renamed once complete, so an interrupted copy never looks like
+    a finished one.
+
+    Args:
+        src (str): File to copy.
+        dst (str): Path of the copy.
+        block_size (int): Number of bytes copied per step.
+        progress_callback [Optional(function)]: Called with (bytes_copied, total_bytes)
+            after every block. Anything it raises stops the copy and is re-raised
+            after the partial file is removed.
+    """
+    total = os.path.getsize(src)
+    part_path = dst + '.part'
+    try:
+        with open(src, 'rb') as fsrc, open(part_path, 'wb') as fdst:
+            copied = 0
+            while True:
+                data = fsrc.read(block_size)
+                if not data:
+                    break
+                fdst.write(data)
+                copied += len(data)
+                if progress_callback:
+                    progress_callback(copied, total)
+        shutil.copymode(src, part_path)
+    except:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    if os.path.exists(dst) and sys.platform == 'win32':
+        os.remove(dst)
+    os.rename(part_path, dst)
+
+###############################################################################
+# Copy-free storage
+###############################################################################
+
+# Ways store_file can put a file in place, cheapest first
+STORAGE_MODES = ('reflink', 'hardlink', 'reference', 'copy')
+
+# ioctl that clones a file's extents on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def store_file(src, dst, modes=STORAGE_MODES, progress_callback=None):
+    """
+    Makes the contents of src available at dst, trying each of modes in turn:
+
+        reflink   - copy-on-write clone sharing the data blocks of src
+        hardlink  - second directory entry for src
+        reference - nothing is written; the caller records src instead of dst
+        copy      - full copy with copy_file
+
+    The first three cost next to no I/O. Returns the mode that was used.
+    'reference' can't fail, so modes after it are never tried.
+
+    Args:
+        src (str): File to store.
+        dst (str): Path the file should be available at.
+        modes (tuple): Modes to try, in order.
+        progress_callback [Optional(function)]: Passed on to copy_file.
+    """
+    for mode in modes:
+        if mode == 'reflink' and _reflink(src, dst):
+            return mode
+        if mode == 'hardlink' and _hardlink(src, dst):
+            return mode
+        if mode == 'reference':
+            return mode
+        if mode == 'copy':
+            copy_file(src, dst, progress_callback=progress_callback)
+            return mode
+    raise ValueError("None of the storage modes {} could store {}".format(modes, src))
+
+def _reflink(src, dst):
+    part_path = dst + '.part'
+    try:
+        if sys.platform.startswith('linux'):
+            import fcntl
+            with open(src, 'rb') as fsrc, open(part_path, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        elif sys.platform == 'darwin':
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if libc.clonefile(src, part_path, 0) != 0:
+                raise OSError(ctypes.get_errno(), 'clonefile failed')
+        else:
+            return False
+        shutil.copymode(src, part_path)
+    except (IOError, OSError, AttributeError):
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+
+    if os.path.exists(dst) and sys.platform == 'win32':
+        os.remove(dst)
+    os.rename(part_path, dst)
+    return True
+
+def _hardlink(src, dst):
+    # Fails across filesystems, and on Windows where Python 2 has no os.link
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        return False
+    return True
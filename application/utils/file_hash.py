@@ -0,0 +1,32 @@
+import os
+import mmap
+import hashlib
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+def hash_file(path, algorithm='sha256', block_size=HASH_BLOCK_SIZE, progress_callback=None):
+    """
+    Returns the hex digest of the file at path. The file is memory-mapped and
+    fed to the hash in blocks, so large videos are never fully loaded into memory.
+
+    Args:
+        path (str): File to hash.
+        algorithm (str): Any hashlib algorithm name, e.g. 'sha256'.
+        block_size (int): Number of bytes hashed per step.
+        progress_callback [Optional(function)]: Called with (bytes_hashed, total_bytes).
+    """
+    hasher = hashlib.new(algorithm)
+    size = os.path.getsize(path)
+    if size == 0:
+        return hasher.hexdigest()
+
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(0, size, block_size):
+                hasher.update(buffer(m, offset, block_size))
+                if progress_callback:
+                    progress_callback(min(offset + block_size, size), size)
+        finally:
+            m.close()
+    return hasher.hexdigest()
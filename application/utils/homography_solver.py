@@ -0,0 +1,204 @@
+"""
+Homography estimation from point correspondences, so the GUI can show a
+homography as soon as the points are chosen instead of waiting for the server.
+"""
+import numpy as np
+
+# Random minimal samples tried at most by RANSAC
+RANSAC_MAX_ITERATIONS = 2000
+# Probability of having drawn at least one outlier-free sample before stopping
+RANSAC_CONFIDENCE = 0.995
+REFINE_MAX_ITERATIONS = 50
+
+class HomographyError(ValueError):
+    pass
+
+def projectArray(homography, points):
+    '''Returns the coordinates of the projected points through homography
+    (format: array 2xN points)
+    '''
+    if points.shape[0] != 2:
+        raise Exception('points of dimension {0} {1}'.format(points.shape[0], points.shape[1]))
+
+    if (homography is not None) and homography.size>0:
+        augmentedPoints = np.append(points,[[1]*points.shape[1]], 0)
+        prod = np.dot(homography, augmentedPoints)
+        return prod[0:2]/prod[2]
+    else:
+        return points
+
+def reprojection_errors(homography, src_pts, dst_pts):
+    """
+    Returns the distance between each of dst_pts and the projection of the
+    matching src_pts through homography, in the units of dst_pts.
+
+    Args:
+        homography (np.ndarray): 3x3 matrix mapping src_pts to dst_pts.
+        src_pts (np.ndarray): Nx2 points.
+        dst_pts (np.ndarray): Nx2 points.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        projected = projectArray(homography, np.asarray(src_pts, dtype=np.float64).T).T
+        errors = np.sqrt(np.sum((projected - dst_pts) ** 2, axis=1))
+    # Points projected to infinity are as wrong as they get
+    errors[~np.isfinite(errors)] = np.inf
+    return errors
+
+def find_homography(src_pts, dst_pts, ransac_threshold=None, refine=True):
+    """
+    Estimates the homography mapping src_pts onto dst_pts.
+
+    The direct linear transform is solved on Hartley-normalized points. With
+    ransac_threshold, points further than that from where the homography puts
+    them (in dst_pts units) are left out of the fit as outliers. The result is
+    then refined by minimizing the reprojection error of the inliers.
+
+    Args:
+        src_pts (np.ndarray): Nx2 points, N >= 4.
+        dst_pts (np.ndarray): Nx2 points matching src_pts.
+        ransac_threshold [Optional(float)]: Largest error of an inlier.
+        refine [Optional(bool)]: Whether to refine the linear solution.
+
+    Returns:
+        (homography, errors, inliers): the 3x3 matrix, the reprojection error of
+        every point and a boolean mask of the points used for the fit.
+
+    Raises:
+        HomographyError: If the points don't determine a homography, e.g.
+            because too many of them are on one line.
+    """
+    src_pts = np.asarray(src_pts, dtype=np.float64).reshape(-1, 2)
+    dst_pts = np.asarray(dst_pts, dtype=np.float64).reshape(-1, 2)
+    if len(src_pts) != len(dst_pts):
+        raise HomographyError("Got {} source points but {} destination points".format(len(src_pts), len(dst_pts)))
+    if len(src_pts) < 4:
+        raise HomographyError("At least 4 point pairs are needed, got {}".format(len(src_pts)))
+
+    if ransac_threshold is not None and len(src_pts) > 4:
+        inliers = _ransac(src_pts, dst_pts, ransac_threshold)
+    else:
+        inliers = np.ones(len(src_pts), dtype=bool)
+
+    homography = _dlt(src_pts[inliers], dst_pts[inliers])
+    if refine and inliers.sum() > 4:
+        homography = _refine(homography, src_pts[inliers], dst_pts[inliers])
+
+    return (homography, reprojection_errors(homography, src_pts, dst_pts), inliers)
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def _normalization(points):
+    # Similarity moving the centroid to the origin with a mean distance of sqrt(2)
+    centroid = points.mean(axis=0)
+    distance = np.sqrt(np.sum((points - centroid) ** 2, axis=1)).mean()
+    if distance == 0:
+        raise HomographyError("All points are in the same place")
+    scale = np.sqrt(2) / distance
+    return np.array([[scale, 0, -scale * centroid[0]],
+                     [0, scale, -scale * centroid[1]],
+                     [0, 0, 1]])
+
+def _dlt(src_pts, dst_pts):
+    src_t = _normalization(src_pts)
+    dst_t = _normalization(dst_pts)
+    src = projectArray(src_t, src_pts.T).T
+    dst = projectArray(dst_t, dst_pts.T).T
+
+    # Two rows per correspondence of the system A h = 0
+    n = len(src)
+    x, y = src[:, 0], src[:, 1]
+    u, v = dst[:, 0], dst[:, 1]
+    zeros, ones = np.zeros(n), np.ones(n)
+    a = np.empty((2 * n, 9))
+    a[0::2] = np.column_stack([-x, -y, -ones, zeros, zeros, zeros, u * x, u * y, u])
+    a[1::2] = np.column_stack([zeros, zeros, zeros, -x, -y, -ones, v * x, v * y, v])
+
+    _, singular_values, vt = np.linalg.svd(a)
+    # A second null vector means the points allow more than one homography
+    if singular_values[7] < 1e-10 * singular_values[0]:
+        raise HomographyError("The points don't determine a homography, too many of them are on one line")
+    homography = np.dot(np.linalg.inv(dst_t), np.dot(vt[-1].reshape(3, 3), src_t))
+    if abs(homography[2, 2]) < 1e-12:
+        raise HomographyError("The points map a finite point to infinity")
+    return homography / homography[2, 2]
+
+def _ransac(src_pts, dst_pts, threshold):
+    n = len(src_pts)
+    best = np.zeros(n, dtype=bool)
+    best_error = np.inf
+    iterations = RANSAC_MAX_ITERATIONS
+    i = 0
+    while i < iterations:
+        i += 1
+        sample = np.random.choice(n, 4, replace=False)
+        try:
+            homography = _dlt(src_pts[sample], dst_pts[sample])
+        except HomographyError:
+            continue
+        errors = reprojection_errors(homography, src_pts, dst_pts)
+        inliers = errors <= threshold
+        count = inliers.sum()
+        error = errors[inliers].sum()
+        if count > best.sum() or (count == best.sum() and error < best_error):
+            best, best_error = inliers, error
+            # Fewer samples are needed the more inliers there are
+            ratio = float(count) / n
+            if ratio >= 1:
+                break
+            needed = np.log(1 - RANSAC_CONFIDENCE) / np.log(1 - ratio ** 4)
+            iterations = min(iterations, int(np.ceil(needed)))
+
+    if best.sum() < 4:
+        # No four points agree, so there is nothing to single out
+        return np.ones(n, dtype=bool)
+    return best
+
+def _refine(homography, src_pts, dst_pts):
+    # Levenberg-Marquardt on the 8 free entries (h33 = 1) minimizing the
+    # squared reprojection error in dst_pts
+    x, y = src_pts[:, 0], src_pts[:, 1]
+    h = homography.ravel()[:8].copy()
+
+    def residuals(h):
+        w = h[6] * x + h[7] * y + 1
+        u = (h[0] * x + h[1] * y + h[2]) / w
+        v = (h[3] * x + h[4] * y + h[5]) / w
+        return w, u, v, np.concatenate([u - dst_pts[:, 0], v - dst_pts[:, 1]])
+
+    w, u, v, r = residuals(h)
+    cost = np.dot(r, r)
+    damping = 1e-3
+    for _ in xrange(REFINE_MAX_ITERATIONS):
+        zeros = np.zeros_like(x)
+        ju = np.column_stack([x / w, y / w, 1 / w, zeros, zeros, zeros, -u * x / w, -u * y / w])
+        jv = np.column_stack([zeros, zeros, zeros, x / w, y / w, 1 / w, -v * x / w, -v * y / w])
+        j = np.vstack([ju, jv])
+        jtj = np.dot(j.T, j)
+        gradient = np.dot(j.T, r)
+
+        improved = False
+        while damping < 1e10:
+            try:
+                step = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj)), -gradient)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            candidate = h + step
+            w_c, u_c, v_c, r_c = residuals(candidate)
+            cost_c = np.dot(r_c, r_c)
+            if np.isfinite(cost_c) and cost_c < cost:
+                improved = True
+                break
+            damping *= 10
+        if not improved:
+            break
+
+        converged = cost - cost_c < 1e-12 * max(cost, 1e-300)
+        h, w, u, v, r, cost = candidate, w_c, u_c, v_c, r_c, cost_c
+        damping = max(damping / 10, 1e-12)
+        if converged:
+            break
+
+    return np.append(h, 1).reshape(3, 3)
@@ -0,0 +1,68 @@
+"""
+Spatial index of the points placed on a homography image, so the point under
+the mouse is found without looking at every point.
+"""
+import math
+
+class PointGrid(object):
+    """
+    Points bucketed into square cells of cell_size. The nearest point within
+    a radius of at most cell_size is always in the 3x3 cells around the
+    query, so lookups, inserts, moves and removals take the same time however
+    many points there are (as long as they aren't piled up in one place).
+
+    Points are any hashable keys, each at an (x, y) position.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def insert(self, key, x, y):
+        """Adds key at (x, y), or moves it there if it is already in the grid."""
+        if key in self.positions:
+            self.remove(key)
+        self.positions[key] = (x, y)
+        self.cells.setdefault(self._cell(x, y), set()).add(key)
+
+    def remove(self, key):
+        x, y = self.positions.pop(key)
+        cell = self._cell(x, y)
+        keys = self.cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self.cells[cell]
+
+    def move(self, key, x, y):
+        old = self.positions.get(key)
+        if old is not None and self._cell(*old) == self._cell(x, y):
+            self.positions[key] = (x, y)
+        else:
+            self.insert(key, x, y)
+
+    def nearest(self, x, y, radius):
+        """
+        Returns the key nearest to (x, y) that is at most radius away from it,
+        None if there is none. radius can't be larger than cell_size.
+        """
+        if radius > self.cell_size:
+            raise ValueError("radius {} is larger than the cell size {}".format(radius, self.cell_size))
+        col, row = self._cell(x, y)
+        best, best_distance = None, radius * radius
+        for c in (col - 1, col, col + 1):
+            for r in (row - 1, row, row + 1):
+                for key in self.cells.get((c, r), ()):
+                    px, py = self.positions[key]
+                    distance = (px - x) ** 2 + (py - y) ** 2
+                    if distance <= best_distance:
+                        best, best_distance = key, distance
+        return best
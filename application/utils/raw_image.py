@@ -0,0 +1,176 @@
+import os
+import sys
+import mmap
+import struct
+try:
+    from PIL import Image
+except:
+    import Image
+
+from utils.tile_pyramid import PyramidGeometry, count_levels, open_large_image, TILE_SIZE
+
+RAW_IMAGE_MAGIC = 'SGRAWIMG'
+RAW_IMAGE_VERSION = 1
+# Pixel data starts on a page boundary so levels can be mapped directly
+RAW_IMAGE_ALIGNMENT = 4096
+# Rows written per step while converting, to bound memory for huge images
+RAW_WRITE_ROWS = 256
+# Largest image worth a raw copy. With its levels a copy takes about 5.3 bytes
+# per pixel, 360 MB at this size and over 2 GB for a 20000x20000 image, which
+# are shown from a tile pyramid instead.
+RAW_IMAGE_MAX_PIXELS = 8192 * 8192
+# magic, version, levels, source size, source mtime
+_HEADER = struct.Struct('<8sIIQQ')
+# width, height, offset of each level
+_LEVEL = struct.Struct('<IIQ')
+
+def raw_image_path(image_path):
+    """Where the raw copy of the image at image_path is kept: <name>.raw next to it."""
+    return os.path.splitext(image_path)[0] + '.raw'
+
+class RawImage(PyramidGeometry):
+    """
+    An image and its halved levels (see PyramidGeometry) stored as
+    uncompressed RGBA in one file, which is memory-mapped instead of read.
+
+    Opening one decodes nothing: pixels are only read from disk, through the
+    page cache, when something looks at them, and every view of the same
+    file shares those pages. pil_image() and custom.tiled_image.raw_qimage()
+    hand the mapped pixels to PIL and Qt without copying them.
+
+    The file is a header (RAW_IMAGE_MAGIC, version, level count, size and
+    mtime of the source image, then width, height and offset of each level)
+    followed by the levels' rows, each level starting on a page boundary.
+    """
+    channels = 4
+    tile_size = TILE_SIZE
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(RAW_IMAGE_ALIGNMENT)
+            magic, version, levels, self.source_size, self.source_mtime = _HEADER.unpack_from(header)
+            if magic != RAW_IMAGE_MAGIC or version != RAW_IMAGE_VERSION:
+                raise ValueError("{} is not a raw image".format(path))
+            self.levels = levels
+            self.level_info = [_LEVEL.unpack_from(header, _HEADER.size + i * _LEVEL.size) for i in range(levels)]
+            # Copy-on-write, so the buffer is writable for ctypes while the
+            # file itself is never changed
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.width, self.height = self.level_info[0][:2]
+
+    @classmethod
+    def open(cls, image_path, progress_callback=None):
+        """
+        Returns the raw copy of the image at image_path, writing it first if it
+        doesn't exist or the image changed since.
+        """
+        path = raw_image_path(image_path)
+        if not is_current(image_path, path):
+            write_raw_image(image_path, path, progress_callback=progress_callback)
+        return cls(path)
+
+    def bytes_per_line(self, level=0):
+        return self.level_info[level][0] * self.channels
+
+    def offset(self, level, x=0, y=0):
+        """Position in the file of pixel (x, y) of level."""
+        width, _, offset = self.level_info[level]
+        return offset + (y * width + x) * self.channels
+
+    def pil_image(self, level=0):
+        """
+        A read-only PIL image backed by the mapped file. PIL copies it before
+        anything draws on it.
+        """
+        width, height, offset = self.level_info[level]
+        data = buffer(self.mmap, offset, width * height * self.channels)
+        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'RGBA', 0, 1)
+
+    def close(self):
+        self.mmap.close()
+
+def is_current(image_path, path):
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return False
+    magic, version, _, source_size, source_mtime = _HEADER.unpack(header)
+    stat = os.stat(image_path)
+    return magic == RAW_IMAGE_MAGIC and version == RAW_IMAGE_VERSION and\
+        source_size == stat.st_size and source_mtime == int(stat.st_mtime)
+
+def _align(offset):
+    return (offset + RAW_IMAGE_ALIGNMENT - 1) // RAW_IMAGE_ALIGNMENT * RAW_IMAGE_ALIGNMENT
+
+def write_raw_image(image_path, path=None, progress_callback=None, image=None):
+    """
+    Decodes the image at image_path once and writes it, with all its levels,
+    as a RawImage to path. The file only appears once it is complete.
+
+    Args:
+        image_path (str): Image to convert.
+        path [Optional(str)]: Where to write the raw image, raw_image_path(image_path) by default.
+        progress_callback [Optional(function)]: Called with (levels_done, levels).
+        image [Optional(PIL.Image)]: The contents of image_path if they are
+            already in memory, to skip decoding it again.
+    """
+    path = path or raw_image_path(image_path)
+    if image is None:
+        image = open_large_image(image_path)
+    image = image.convert('RGBA')
+    width, height = image.size
+    levels = count_levels(width, height)
+    if _HEADER.size + levels * _LEVEL.size > RAW_IMAGE_ALIGNMENT:
+        raise ValueError("{} is too large".format(image_path))
+
+    level_info = []
+    offset = RAW_IMAGE_ALIGNMENT
+    w, h = width, height
+    for level in range(levels):
+        level_info.append((w, h, offset))
+        offset = _align(offset + w * h * RawImage.channels)
+        w, h = (w + 1) // 2, (h + 1) // 2
+
+    stat = os.stat(image_path)
+    part_path = path + '.part'
+    try:
+        with open(part_path, 'wb') as f:
+            f.write(_HEADER.pack(RAW_IMAGE_MAGIC, RAW_IMAGE_VERSION, levels, stat.st_size, int(stat.st_mtime)))
+            for info in level_info:
+                f.write(_LEVEL.pack(*info))
+            resample = getattr(Image, 'BOX', Image.ANTIALIAS)
+            for (level, (w, h, level_offset)) in enumerate(level_info):
+                if level > 0:
+                    image = image.resize((w, h), resample)
+                f.seek(level_offset)
+                for y in range(0, h, RAW_WRITE_ROWS):
+                    f.write(image.crop((0, y, w, min(y + RAW_WRITE_ROWS, h))).tobytes())
+                if progress_callback:
+                    progress_callback(level + 1, levels)
+            f.truncate(offset)
+    except:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    if os.path.exists(path) and sys.platform == 'win32':
+        os.remove(path)
+    os.rename(part_path, path)
+
+def open_image(image_path):
+    """
+    PIL image of the file at image_path, taken from its raw copy when there is
+    a current one, so nothing needs decoding. The pixels are copied out of the
+    raw copy, which is closed again, so the image can be drawn on and kept.
+    """
+    path = raw_image_path(image_path)
+    if is_current(image_path, path):
+        raw = RawImage(path)
+        try:
+            return raw.pil_image().copy()
+        finally:
+            raw.close()
+    return open_large_image(image_path)
@@ -0,0 +1,441 @@
+"""
+Local stand-in for the parts of the SantosCloud API that the client relies on
+for transfers. Lets the upload and status code paths be exercised offline.
+
+Run with:
+    python -m utils.stub_server [port]
+and point the project's server at http://localhost:<port>.
+"""
+import os
+import sys
+import json
+import uuid
+import shutil
+import socket
+import tempfile
+import time
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+from utils.file_hash import hash_file
+
+DEFAULT_PORT = 8899
+HEARTBEAT_INTERVAL = 15
+
+STATUS_NAMES = ['upload_video', 'homography', 'feature_test', 'object_test',\
+                'object_tracking', 'safety_analysis', 'highlight_video']
+
+
+class StubState(object):
+    """Everything the stub server remembers between requests."""
+    def __init__(self, storage_dir=None):
+        self.storage_dir = storage_dir or tempfile.mkdtemp(prefix='santos_stub_')
+        # A condition rather than a plain lock so status streams can wait for changes
+        self.lock = threading.Condition()
+        self.uploads = {}   # upload_id -> {'path', 'size', 'chunk_size', 'received'}
+        self.videos = {}    # identifier -> path
+        self.hashes = {}    # sha256 -> identifier
+        self.statuses = {}  # identifier -> {status_name: {'status': int, ...}}
+        self.artifacts = {} # (identifier, artifact name) -> path of file to serve
+        self.faults = {}    # route -> list of faults (see inject_fault), None for requests let through
+        self.responses = [] # (route, status code) of every response sent, oldest first
+
+    def add_video(self, path):
+        identifier = uuid.uuid4().hex
+        self.videos[identifier] = path
+        self.statuses[identifier] = dict((name, {'status': 0}) for name in STATUS_NAMES)
+        return identifier
+
+    def add_artifact(self, identifier, name, path):
+        """
+        Serves the file at path for the download route named name, e.g.
+        'roadUserCounts' or 'testConfig/feature'.
+        """
+        with self.lock:
+            self.artifacts[(identifier, name)] = path
+
+    def inject_fault(self, route, fault, count=1, after=0):
+        """
+        Makes count requests to route fail, once after requests got through.
+        fault is an HTTP status code to answer with, 'close' to hang up without
+        answering, or ('drop', n) to close the connection after sending n bytes
+        of a download.
+        """
+        with self.lock:
+            self.faults.setdefault(route, []).extend([None] * after + [fault] * count)
+
+    def next_fault(self, route):
+        with self.lock:
+            faults = self.faults.get(route)
+            return faults.pop(0) if faults else None
+
+    def record_response(self, route, code):
+        with self.lock:
+            self.responses.append((route, code))
+
+    def response_codes(self, route):
+        """Status codes of the responses sent for route so far, oldest first."""
+        with self.lock:
+            return [code for (r, code) in self.responses if r == route]
+
+    def set_status(self, identifier, status_name, status, **extra):
+        with self.lock:
+            entry = {'status': status}
+            entry.update(extra)
+            self.statuses[identifier][status_name] = entry
+            self.lock.notify_all()
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    # Streaming clients hang up whenever they are done listening, so a broken
+    # connection is not an error here.
+    def handle(self):
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    ###########################################################################
+    # Dispatch
+    ###########################################################################
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def send_response(self, code, message=None):
+        self.server.state.record_response(getattr(self, 'route', None), code)
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        self.route = url.path.strip('/')
+        self.params = dict((k, v[0]) for (k, v) in parse_qs(url.query).iteritems())
+        handler = getattr(self, '{}_{}'.format(method.lower(), self.route.replace('/', '_')), None)
+        self.fault = self.server.state.next_fault(self.route)
+        if isinstance(self.fault, int):
+            self._read_body()
+            self.send_error_message('Injected fault', code=self.fault)
+            return
+        if self.fault == 'close':
+            self._read_body()
+            self.close_connection = True
+            return
+        if self.route == 'status/stream' and not self.server.enable_status_stream:
+            handler = None
+        if self.route == '':
+            handler = self.get_root
+        if handler is None:
+            self._read_body()
+            self.send_json({'error': {'error_message': 'Not found'}}, code=404)
+            return
+        handler()
+
+    ###########################################################################
+    # Helpers
+    ###########################################################################
+
+    def _read_body(self):
+        length = int(self.headers.getheader('content-length', 0))
+        return self.rfile.read(length) if length else ''
+
+    def _read_json(self):
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_message(self, message, code=400):
+        self.send_json({'error': {'error_message': message}}, code=code)
+
+    ###########################################################################
+    # Routes
+    ###########################################################################
+
+    def get_root(self):
+        self.send_json({})
+
+    def send_artifact(self, name):
+        state = self.server.state
+        path = state.artifacts.get((self.params.get('identifier'), name))
+        if path is None:
+            self.send_error_message('No {} for this identifier'.format(name))
+            return
+
+        size = os.path.getsize(path)
+        etag = '"{:x}-{:x}"'.format(int(os.path.getmtime(path) * 1000), size)
+        start, end = 0, size - 1
+        byte_range = self.headers.getheader('range')
+        if_range = self.headers.getheader('if-range')
+        if self.headers.getheader('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if if_range is not None and if_range != etag:
+            # The client's copy is of an older version, send the whole file
+            byte_range = None
+        if byte_range and byte_range.startswith('bytes='):
+            first, _, last = byte_range[len('bytes='):].partition('-')
+            start = int(first) if first else max(0, size - int(last))
+            end = min(int(last), size - 1) if first and last else size - 1
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            self._copy_body(f, end - start + 1)
+
+    def _copy_body(self, f, length):
+        # Optionally throttled, so slow links and interrupted downloads can be simulated
+        rate = self.server.throttle
+        block = 64 * 1024 if not rate else max(1, min(64 * 1024, rate // 10))
+        if isinstance(self.fault, tuple) and self.fault[0] == 'drop':
+            length = min(length, self.fault[1])
+            self.close_connection = True
+        while length > 0:
+            data = f.read(min(block, length))
+            if not data:
+                break
+            self.wfile.write(data)
+            length -= len(data)
+            if rate:
+                time.sleep(float(len(data)) / rate)
+
+    def get_testConfig(self):
+        self.send_artifact('testConfig/' + self.params.get('test_flag', ''))
+
+    def get_highlightVideo(self):
+        self.send_artifact('highlightVideo')
+
+    def get_makeReport(self):
+        self.send_artifact('makeReport')
+
+    def get_retrieveResults(self):
+        self.send_artifact('retrieveResults')
+
+    def get_roadUserCounts(self):
+        self.send_artifact('roadUserCounts')
+
+    def get_speedDistribution(self):
+        self.send_artifact('speedDistribution')
+
+    def get_turningCounts(self):
+        self.send_artifact('turningCounts')
+
+    def get_status(self):
+        state = self.server.state
+        with state.lock:
+            statuses = state.statuses.get(self.params.get('identifier'))
+            if statuses is None:
+                self.send_error_message('Unknown identifier')
+                return
+            self.send_json(statuses)
+
+    def get_status_stream(self):
+        """
+        Server-Sent Events version of get_status. Sends the full status whenever
+        it changes and a comment line every HEARTBEAT_INTERVAL seconds otherwise.
+        """
+        state = self.server.state
+        identifier = self.params.get('identifier')
+        if identifier not in state.statuses:
+            self.send_error_message('Unknown identifier')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        last_sent = None
+        try:
+            while True:
+                with state.lock:
+                    current = json.dumps(state.statuses[identifier])
+                    if current == last_sent:
+                        state.lock.wait(self.server.heartbeat_interval)
+                        current = json.dumps(state.statuses[identifier])
+                if current != last_sent:
+                    self.wfile.write('data: {}\n\n'.format(current))
+                    last_sent = current
+                else:
+                    self.wfile.write(': keep-alive\n\n')
+                self.wfile.flush()
+        except socket.error:
+            # Client went away
+            pass
+
+    def _start_run(self, status_names):
+        # Nothing actually runs, tests move the run along with set_status
+        state = self.server.state
+        identifier = self._read_json().get('identifier')
+        if identifier not in state.statuses:
+            self.send_error_message('Unknown identifier')
+            return
+        for name in status_names:
+            state.set_status(identifier, name, 1)
+        self.send_json({})
+
+    def post_analysis(self):
+        self._start_run(['object_tracking', 'safety_analysis'])
+
+    def post_objectTracking(self):
+        self._start_run(['object_tracking'])
+
+    def post_safetyAnalysis(self):
+        self._start_run(['safety_analysis'])
+
+    def post_uploadVideo_init(self):
+        data = self._read_json()
+        state = self.server.state
+        with state.lock:
+            if data.get('sha256') in state.hashes:
+                # A new project on the stored copy, never the project that
+                # uploaded it, so both can be configured separately
+                identifier = state.add_video(state.videos[state.hashes[data['sha256']]])
+                state.statuses[identifier]['upload_video'] = {'status': 2}
+                self.send_json({'identifier': identifier, 'deduplicated': True})
+                return
+            upload_id = data.get('upload_id')
+            if upload_id not in state.uploads:
+                upload_id = uuid.uuid4().hex
+                path = os.path.join(state.storage_dir, upload_id + '_' + os.path.basename(data['filename']))
+                with open(path, 'wb') as f:
+                    f.truncate(int(data['size']))
+                state.uploads[upload_id] = {
+                    'path': path,
+                    'size': int(data['size']),
+                    'chunk_size': int(data['chunk_size']),
+                    'sha256': data.get('sha256'),
+                    'received': set()
+                }
+            received = sorted(state.uploads[upload_id]['received'])
+        self.send_json({'upload_id': upload_id, 'received': received})
+
+    def post_uploadVideo_chunk(self):
+        body = self._read_body()
+        state = self.server.state
+        upload = state.uploads.get(self.params.get('upload_id'))
+        if upload is None:
+            self.send_error_message('Unknown upload_id')
+            return
+        offset = int(self.params['offset'])
+        if offset % upload['chunk_size'] != 0 or offset + len(body) > upload['size']:
+            self.send_error_message('Invalid offset')
+            return
+        with open(upload['path'], 'r+b') as f:
+            f.seek(offset)
+            f.write(body)
+        with state.lock:
+            upload['received'].add(offset)
+        self.send_json({'offset': offset, 'length': len(body)})
+
+    def post_uploadVideo_complete(self):
+        data = self._read_json()
+        state = self.server.state
+        with state.lock:
+            upload = state.uploads.get(data.get('upload_id'))
+            if upload is None:
+                self.send_error_message('Unknown upload_id')
+                return
+            expected = set(range(0, upload['size'], upload['chunk_size']))
+            if upload['received'] != expected:
+                self.send_error_message('Upload is missing {} parts'.format(len(expected - upload['received'])))
+                return
+            # The client may only know the hash once it has read the whole file
+            sha256 = data.get('sha256') or upload['sha256']
+            if sha256 and hash_file(upload['path']) != sha256:
+                # Forgotten, so the client's next attempt starts over
+                os.remove(upload['path'])
+                del state.uploads[data['upload_id']]
+                self.send_error_message('Uploaded video does not match its sha256')
+                return
+            identifier = state.add_video(upload['path'])
+            state.statuses[identifier]['upload_video'] = {'status': 2}
+            if sha256:
+                state.hashes[sha256] = identifier
+            del state.uploads[data['upload_id']]
+        self.send_json({'identifier': identifier})
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server holding a StubState."""
+    daemon_threads = True
+
+    def __init__(self, port=DEFAULT_PORT, storage_dir=None, verbose=False,\
+                 heartbeat_interval=HEARTBEAT_INTERVAL, enable_status_stream=True,\
+                 throttle=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubRequestHandler)
+        # Download speed limit in bytes per second, or None for no limit
+        self.throttle = throttle
+        self.state = StubState(storage_dir)
+        self.verbose = verbose
+        self.heartbeat_interval = heartbeat_interval
+        # Turn off to test clients against a server without the stream endpoint
+        self.enable_status_stream = enable_status_stream
+        self._owns_storage = storage_dir is None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def start_in_thread(self):
+        """Serves from a daemon thread and returns it. Stop with shutdown()."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if self._owns_storage:
+            shutil.rmtree(self.state.storage_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    server = StubServer(port, verbose=True)
+    print "Stub server listening on {}".format(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
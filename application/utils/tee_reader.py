@@ -0,0 +1,109 @@
+import os
+import sys
+import shutil
+import hashlib
+
+TEE_BLOCK_SIZE = 8 * 1024 * 1024
+
+class TeeReader(object):
+    """
+    Reads a file once, front to back, and hands every block to each of its
+    consumers before passing it on to whoever iterates over the reader. This
+    lets hashing, copying and uploading share a single read of a large video.
+
+    Consumers have update(offset, data), called for every block in order,
+    and close(complete), called once with complete=False if reading stopped
+    before the end of the file.
+
+    Iterating yields (offset, data) tuples of block_size bytes (the last one
+    may be shorter).
+    """
+    def __init__(self, path, block_size=TEE_BLOCK_SIZE, consumers=(), progress_callback=None):
+        self.path = path
+        self.block_size = block_size
+        self.size = os.path.getsize(path)
+        self.consumers = list(consumers)
+        self.progress_callback = progress_callback
+        self.bytes_read = 0
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            with open(self.path, 'rb') as f:
+                while True:
+                    data = f.read(self.block_size)
+                    if not data:
+                        break
+                    offset = self.bytes_read
+                    for consumer in self.consumers:
+                        consumer.update(offset, data)
+                    self.bytes_read += len(data)
+                    if self.progress_callback:
+                        self.progress_callback(self.bytes_read, self.size)
+                    yield (offset, data)
+        except:
+            self.close()
+            raise
+        self.close()
+
+    def read_all(self):
+        """Feeds the rest of the file to the consumers."""
+        for _ in self:
+            pass
+
+    @property
+    def complete(self):
+        return self.bytes_read == self.size
+
+    @property
+    def hexdigest(self):
+        """Digest of the first HashConsumer, None until the whole file was read."""
+        for consumer in self.consumers:
+            if isinstance(consumer, HashConsumer):
+                return consumer.hexdigest
+        return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            for consumer in self.consumers:
+                consumer.close(self.complete)
+
+class HashConsumer(object):
+    """Hashes the blocks of a TeeReader; hexdigest is set once the file is complete."""
+    def __init__(self, algorithm='sha256'):
+        self.hasher = hashlib.new(algorithm)
+        self.hexdigest = None
+
+    def update(self, offset, data):
+        self.hasher.update(data)
+
+    def close(self, complete):
+        if complete:
+            self.hexdigest = self.hasher.hexdigest()
+
+class FileConsumer(object):
+    """
+    Writes the blocks of a TeeReader to dst.part, which is renamed to dst once
+    the whole file has been written and removed if reading stops early.
+    """
+    def __init__(self, dst, mode_from=None):
+        self.dst = dst
+        self.part_path = dst + '.part'
+        self.mode_from = mode_from
+        self.f = open(self.part_path, 'wb')
+
+    def update(self, offset, data):
+        self.f.write(data)
+
+    def close(self, complete):
+        self.f.close()
+        if not complete:
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+            return
+        if self.mode_from is not None:
+            shutil.copymode(self.mode_from, self.part_path)
+        if os.path.exists(self.dst) and sys.platform == 'win32':
+            os.remove(self.dst)
+        os.rename(self.part_path, self.dst)
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import math
+import shutil
+import threading
+from collections import OrderedDict
+try:
+    from PIL import Image
+except:
+    import Image
+
+TILE_SIZE = 512
+# Images at least this wide or tall are shown from a tile pyramid
+TILED_IMAGE_MIN_SIZE = 4096
+TILE_JPEG_QUALITY = 90
+PYRAMID_META_FILE = 'pyramid.json'
+# Decoded tiles kept around; 256 tiles of 512x512 are at most 256 MB
+TILE_CACHE_SIZE = 256
+
+# Held while Image.MAX_IMAGE_PIXELS is switched off, so that threads opening
+# images at the same time don't restore each other's saved value
+_max_pixels_lock = threading.Lock()
+
+def pyramid_dir(image_path):
+    """Where the tiles of the image at image_path are kept: tiles/<name> next to it."""
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(os.path.dirname(image_path), 'tiles', name)
+
+class PyramidGeometry(object):
+    """
+    Layout of an image pyramid: level 0 is width x height and each following
+    level halves the one before (rounding up). Subclasses set width, height,
+    levels and the tile_size the image is drawn in.
+    """
+    def level_size(self, level):
+        scale = 2 ** level
+        return (int(math.ceil(self.width / float(scale))), int(math.ceil(self.height / float(scale))))
+
+    def level_for_scale(self, scale):
+        """Coarsest level with at least one image pixel per screen pixel at this view scale."""
+        if scale <= 0:
+            return self.levels - 1
+        level = int(math.floor(math.log(1.0 / scale, 2)))
+        return max(0, min(self.levels - 1, level))
+
+    def tiles_in(self, level, x0, y0, x1, y1):
+        """
+        Returns (col, row, (x, y, w, h)) for the tiles of level covering the
+        full-resolution rectangle (x0, y0)-(x1, y1), with each tile's area in
+        full-resolution coordinates.
+        """
+        scale = 2 ** level
+        span = self.tile_size * scale
+        level_width, level_height = self.level_size(level)
+        cols = int(math.ceil(level_width / float(self.tile_size)))
+        rows = int(math.ceil(level_height / float(self.tile_size)))
+        first_col, last_col = max(0, int(x0 // span)), min(cols - 1, int(x1 // span))
+        first_row, last_row = max(0, int(y0 // span)), min(rows - 1, int(y1 // span))
+        tiles = []
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                w = min(self.tile_size, level_width - col * self.tile_size) * scale
+                h = min(self.tile_size, level_height - row * self.tile_size) * scale
+                tiles.append((col, row, (col * span, row * span, w, h)))
+        return tiles
+
+def count_levels(width, height, tile_size=TILE_SIZE):
+    """Number of levels needed for the smallest one to fit in a single tile."""
+    levels = 1
+    size = max(width, height)
+    while size > tile_size:
+        size = (size + 1) // 2
+        levels += 1
+    return levels
+
+class TilePyramid(PyramidGeometry):
+    """
+    An image cut into tile_size square tiles at several resolutions. Level 0
+    is the full image and each following level halves the one before, down
+    to a single tile, so any zoom level can be drawn from a few tiles of about
+    screen resolution.
+
+    The tiles live in directory as <level>/<col>_<row>.<format>, described by
+    PYRAMID_META_FILE, which is written last and so only exists for complete
+    pyramids.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, PYRAMID_META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.width, self.height = self.meta['size']
+        self.tile_size = self.meta['tile_size']
+        self.levels = self.meta['levels']
+        self.format = self.meta['format']
+
+    @classmethod
+    def open(cls, image_path, directory=None, progress_callback=None):
+        """
+        Returns the pyramid of the image at image_path, building it first if
+        it doesn't exist or the image changed since.
+        """
+        directory = directory or pyramid_dir(image_path)
+        if not is_current(image_path, directory):
+            build_pyramid(image_path, directory, progress_callback=progress_callback)
+        return cls(directory)
+
+    def tile_path(self, level, col, row):
+        return os.path.join(self.directory, str(level), '{}_{}.{}'.format(col, row, self.format))
+
+def is_current(image_path, directory):
+    meta_path = os.path.join(directory, PYRAMID_META_FILE)
+    if not os.path.exists(meta_path):
+        return False
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except ValueError:
+        return False
+    stat = os.stat(image_path)
+    return meta.get('source_size') == stat.st_size and meta.get('source_mtime') == int(stat.st_mtime)
+
+def build_pyramid(image_path, directory, tile_size=TILE_SIZE, progress_callback=None, image=None):
+    """
+    Cuts the image at image_path into a TilePyramid in directory, replacing
+    whatever was there. Opaque images get JPEG tiles, others PNG.
+
+    Args:
+        image_path (str): Image to cut.
+        directory (str): Where to put the tiles.
+        tile_size (int): Width and height of a tile in pixels.
+        progress_callback [Optional(function)]: Called with (levels_done, levels).
+        image [Optional(PIL.Image)]: The contents of image_path if they are
+            already in memory, to skip decoding it again.
+    """
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    if image is None:
+        image = open_large_image(image_path)
+    width, height = image.size
+    if 'A' in image.mode or 'transparency' in image.info:
+        image, fmt, options = image.convert('RGBA'), 'png', {}
+    else:
+        image, fmt, options = image.convert('RGB'), 'jpg', {'quality': TILE_JPEG_QUALITY}
+
+    levels = count_levels(width, height, tile_size)
+    resample = getattr(Image, 'BOX', Image.ANTIALIAS)
+    for level in range(levels):
+        level_dir = os.path.join(directory, str(level))
+        os.makedirs(level_dir)
+        w, h = image.size
+        for y in range(0, h, tile_size):
+            for x in range(0, w, tile_size):
+                tile = image.crop((x, y, min(x + tile_size, w), min(y + tile_size, h)))
+                path = os.path.join(level_dir, '{}_{}.{}'.format(x // tile_size, y // tile_size, fmt))
+                tile.save(path, 'JPEG' if fmt == 'jpg' else 'PNG', **options)
+        if level + 1 < levels:
+            image = image.resize(((w + 1) // 2, (h + 1) // 2), resample)
+        if progress_callback:
+            progress_callback(level + 1, levels)
+
+    stat = os.stat(image_path)
+    meta = {
+        'size': [width, height],
+        'tile_size': tile_size,
+        'levels': levels,
+        'format': fmt,
+        'source_size': stat.st_size,
+        'source_mtime': int(stat.st_mtime)
+    }
+    meta_path = os.path.join(directory, PYRAMID_META_FILE)
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.exists(meta_path) and sys.platform == 'win32':
+        os.remove(meta_path)
+    os.rename(tmp_path, meta_path)
+
+class TileCache(object):
+    """Least recently used cache of decoded tiles (QPixmaps when drawn by a
+    TiledImageItem).
+    """
+    def __init__(self, max_tiles=TILE_CACHE_SIZE):
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+
+    def get(self, key, load):
+        """
+        Returns the tile cached under key, calling load() to make it only if
+        it isn't cached already.
+        """
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            tile = load()
+            if len(self.tiles) >= self.max_tiles:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = tile
+        return tile
+
+    def clear(self):
+        self.tiles.clear()
+
+def open_large_image(image_path):
+    """
+    Image.open without PIL's decompression bomb check, which aerial images
+    are legitimately big enough to trip.
+    """
+    if not hasattr(Image, 'MAX_IMAGE_PIXELS'):
+        return Image.open(image_path)
+    with _max_pixels_lock:
+        max_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            return Image.open(image_path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_pixels
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import threading
+
+class UploadIndex(object):
+    """
+    Local record of the content hashes of uploaded videos, stored as JSON
+    under FILES_KEY as path -> {'size', 'mtime', 'sha256'}. Footage that was
+    hashed before can be looked up without reading it again, and its hash
+    sent with the upload init, so a server that already has it doesn't need
+    to be sent it again.
+    """
+    FILES_KEY = 'files'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            print("ERR [UploadIndex]: {} is corrupt, ignoring it.".format(self.path))
+            return {}
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        if os.path.exists(self.path) and sys.platform == 'win32':
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+    def file_hash(self, path):
+        """Returns the recorded hash of the file at path, None if it is unknown or changed."""
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._read().get(self.FILES_KEY, {}).get(os.path.abspath(path))
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != int(stat.st_mtime):
+            return None
+        return entry['sha256']
+
+    def add_file_hash(self, path, content_hash):
+        stat = os.stat(path)
+        with self._lock:
+            data = self._read()
+            data.setdefault(self.FILES_KEY, {})[os.path.abspath(path)] = {
+                'size': stat.st_size,
+                'mtime': int(stat.st_mtime),
+                'sha256': content_hash
+            }
+            self._write(data)